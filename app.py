@@ -1,32 +1,120 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response
 import boto3
 import os
 from osgeo import gdal
 import rasterio
+import rasterio.shutil
+from rasterio.session import AWSSession
+from rasterio.windows import Window
 from rasterio.warp import calculate_default_transform, reproject, Resampling, transform_bounds
-from rasterio.transform import from_bounds
+from rasterio.transform import Affine, from_bounds
+from rasterio.windows import from_bounds as window_from_bounds
 import traceback
 import subprocess
 import json
+import multiprocessing
+import io
+import math
+import hashlib
+import struct
+import threading
+import time
+from contextlib import contextmanager
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from PIL import Image
 import uuid
 import numpy as np
+from rasterio.io import MemoryFile
+from jobs import JobQueue, QueueFullError, timed
+from raster_io import read_s3_object, open_s3_memfile, upload_fileobj
+from s3_transfer import make_s3_client, run_concurrently, s3_latency
+from product_index import PRODUCT_DEDUP, copy_object, get_combined_digest, get_source_digest, lookup_products, record_products, restore_products
+from completion import completion_event, notify_completion
+from reprojection import REPROJECT_GRID_CACHE, reproject_with_cached_grid
+from tiff_export import (EXPORT_CODEC, EXPORT_CODECS, EXPORT_PREDICTOR, export_file_name, export_product, parse_predictor,
+                         read_png_labels, write_label_cog)
 
 app = Flask(__name__)
 
 S3_BUCKET = "dutta007bucket"
 AWS_REGION = "eu-west-2"
-s3_client = boto3.client('s3', region_name=AWS_REGION)
+s3_client = make_s3_client(AWS_REGION)
+
+# Tiled output settings; OUTPUT_MODE is 'png' (single overlay) or 'tiles' (COG + XYZ pyramid)
+OUTPUT_MODE = os.environ.get('OUTPUT_MODE', 'png')
+TILE_SIZE = 256
+TILE_FORMAT = os.environ.get('TILE_FORMAT', 'png')
+TILE_UPLOAD_WORKERS = 16
+WEB_MERCATOR_ORIGIN = 20037508.342789244
+
+# Dynamic tile server settings
+TILE_SOURCE_PREFIXES = ['cog-export/', 'tiff-uploads/']
+TILE_SOURCE_EXTENSIONS = ('.tif', '.tiff')
+# Seconds a raw-upload fallback is trusted before checking again for a COG
+TILE_SOURCE_FALLBACK_TTL = int(os.environ.get('TILE_SOURCE_FALLBACK_TTL', '60'))
+TILE_MEMORY_CACHE_ENTRIES = int(os.environ.get('TILE_MEMORY_CACHE_ENTRIES', '2048'))
+TILE_DISK_CACHE_DIR = os.environ.get('TILE_DISK_CACHE_DIR', '/tmp/tile-cache')
+TILE_DISK_CACHE_BYTES = int(os.environ.get('TILE_DISK_CACHE_BYTES', str(512 * 1024 * 1024)))
+TILE_CACHE_CONTROL = 'public, max-age=86400'
+
+# Background job settings; GDAL work runs in worker processes
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', str(os.cpu_count() or 1)))
+JOB_QUEUE_LIMIT = int(os.environ.get('JOB_QUEUE_LIMIT', '32'))
+JOB_RETRY_AFTER_SECONDS = 5
+
+# Reprojection settings; REPROJECT_CHUNK_WORKERS > 1 splits a GDAL warp across processes.
+# The cached reprojection grids (REPROJECT_GRID_CACHE=1) are opt-in and bypass the GDAL warp.
+REPROJECT_NUM_THREADS = int(os.environ.get('REPROJECT_NUM_THREADS', str(os.cpu_count() or 1)))
+REPROJECT_WARP_MEM_MB = int(os.environ.get('REPROJECT_WARP_MEM_MB', '512'))
+REPROJECT_CHUNK_WORKERS = int(os.environ.get('REPROJECT_CHUNK_WORKERS', '0'))
+
+# /gdal_Test re-encoding settings; GDAL_NUM_THREADS is used for decoding and compression alike
+GDAL_NUM_THREADS = os.environ.get('GDAL_NUM_THREADS', 'ALL_CPUS')
+GDAL_BLOCK_SIZE = int(os.environ.get('GDAL_BLOCK_SIZE', '256'))
+TIFFTAG_TILEWIDTH = 322
+
+def reproject_chunk(tiff_path, dst_transform, window):
+    # Runs in a worker process: warps one block of destination rows
+    with rasterio.open(tiff_path) as src:
+        destination = np.zeros((src.count, window.height, window.width), dtype=src.dtypes[0])
+        reproject(
+            source=rasterio.band(src, list(range(1, src.count + 1))),
+            destination=destination,
+            src_transform=src.transform,
+            src_crs=src.crs,
+            src_nodata=src.nodata,
+            dst_transform=rasterio.windows.transform(window, dst_transform),
+            dst_crs='EPSG:4326',
+            dst_nodata=src.nodata,
+            resampling=Resampling.nearest,
+            warp_mem_limit=REPROJECT_WARP_MEM_MB
+        )
+    return window, destination
+
+def reproject_chunked(tiff_path, dst, dst_transform, workers):
+    # Splits the output into row blocks (a few per worker) that a process pool warps in
+    # parallel. Workers are forked so they can read /vsimem inputs from the parent.
+    rows_per_chunk = max(1, math.ceil(dst.height / (workers * 4)))
+    windows = [Window(0, row_off, dst.width, min(rows_per_chunk, dst.height - row_off))
+               for row_off in range(0, dst.height, rows_per_chunk)]
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork')) as executor:
+        for window, data in executor.map(reproject_chunk, [tiff_path] * len(windows),
+                                         [dst_transform] * len(windows), windows):
+            dst.write(data, window=window)
+
+def convert_tiff_to_png(tiff_path, png_path, chunk_workers=REPROJECT_CHUNK_WORKERS,
+                        use_grid_cache=REPROJECT_GRID_CACHE, cache_info=None):
+    with rasterio.open(tiff_path) as src:
+        if use_grid_cache and chunk_workers <= 1:
+            # Repeated CRS/grid pairs reuse a cached coordinate mapping and go straight to resampling
+            bounds_dict, info = reproject_with_cached_grid(src, png_path, 'EPSG:4326', dict(
+                src.meta, driver='PNG', compress='DEFLATE', zlevel=9))
+            if cache_info is not None:
+                cache_info.update(info)
+            return bounds_dict
 
-def download_file(s3_client, bucket, s3_key, local_path):
-    s3_client.download_file(bucket, s3_key, local_path)
-
-def upload_file(s3_client, local_path, bucket, s3_key, content_type=None):
-    extra_args = {'ContentType': content_type} if content_type else {}
-    s3_client.upload_file(local_path, bucket, s3_key, ExtraArgs=extra_args)
-
-def convert_tiff_to_png(local_tiff_path, local_png_path):
-    with rasterio.open(local_tiff_path) as src:
         bounds = transform_bounds(src.crs, 'EPSG:4326', *src.bounds)
         bounds_dict = {'left': bounds[0], 'bottom': bounds[1], 'right': bounds[2], 'top': bounds[3]}
         transform, width, height = calculate_default_transform(src.crs, 'EPSG:4326', src.width, src.height, *src.bounds)
@@ -40,47 +128,325 @@ def convert_tiff_to_png(local_tiff_path, local_png_path):
             'compress': 'DEFLATE',  # Use DEFLATE compression
             'zlevel': 9  # Maximum compression level
         })
-        with rasterio.open(local_png_path, 'w', **kwargs) as dst:
-            for i in range(1, src.count + 1):
+        with rasterio.open(png_path, 'w', **kwargs) as dst:
+            if chunk_workers > 1:
+                reproject_chunked(tiff_path, dst, transform, chunk_workers)
+            else:
+                # All bands in one multithreaded warp
+                bands = list(range(1, src.count + 1))
                 reproject(
-                    source=rasterio.band(src, i),
-                    destination=rasterio.band(dst, i),
+                    source=rasterio.band(src, bands),
+                    destination=rasterio.band(dst, bands),
                     src_transform=src.transform,
                     src_crs=src.crs,
                     dst_transform=transform,
                     dst_crs='EPSG:4326',
-                    resampling=Resampling.nearest
+                    resampling=Resampling.nearest,
+                    num_threads=REPROJECT_NUM_THREADS,
+                    warp_mem_limit=REPROJECT_WARP_MEM_MB
                 )
     return bounds_dict
 
-def verify_png(local_png_path):
+def convert_tiff_to_cog(tiff_path, cog_path):
+    # Web-mercator COG whose internal tiles and overviews line up with the XYZ grid
+    with rasterio.open(tiff_path) as src:
+        bounds = transform_bounds(src.crs, 'EPSG:4326', *src.bounds)
+    rasterio.shutil.copy(
+        tiff_path,
+        cog_path,
+        driver='COG',
+        tiling_scheme='GoogleMapsCompatible',
+        blocksize=TILE_SIZE,
+        overviews='AUTO',
+        resampling='BILINEAR',
+        compress='DEFLATE',
+        predictor=2
+    )
+    return {'left': bounds[0], 'bottom': bounds[1], 'right': bounds[2], 'top': bounds[3]}
+
+def tile_bounds(x, y, z):
+    tile_span = 2 * WEB_MERCATOR_ORIGIN / 2 ** z
+    left = -WEB_MERCATOR_ORIGIN + x * tile_span
+    top = WEB_MERCATOR_ORIGIN - y * tile_span
+    return left, top - tile_span, left + tile_span, top
+
+def lonlat_to_tile(lon, lat, z):
+    n = 2 ** z
+    lat = max(min(lat, 85.0511287798), -85.0511287798)
+    x = int((lon + 180.0) / 360.0 * n)
+    y = int((1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+def get_zoom_range(src):
+    # maxzoom matches the COG's native resolution; minzoom fits the whole image in about one tile
+    maxzoom = round(math.log2(2 * WEB_MERCATOR_ORIGIN / (TILE_SIZE * src.res[0])))
+    minzoom = max(0, maxzoom - math.ceil(math.log2(max(src.width, src.height) / TILE_SIZE)))
+    return minzoom, maxzoom
+
+def render_xyz_tiles(cog_path, tile_format=TILE_FORMAT):
+    # Yields (z, x, y, encoded tile) for every non-empty tile; lower zooms are read from overviews
+    with rasterio.open(cog_path) as src:
+        west, south, east, north = transform_bounds(src.crs, 'EPSG:4326', *src.bounds)
+        minzoom, maxzoom = get_zoom_range(src)
+        bands = [1, 2, 3] if src.count >= 3 else [1, 1, 1]
+        for z in range(minzoom, maxzoom + 1):
+            x0, y0 = lonlat_to_tile(west, north, z)
+            x1, y1 = lonlat_to_tile(east, south, z)
+            for x in range(x0, x1 + 1):
+                for y in range(y0, y1 + 1):
+                    window = window_from_bounds(*tile_bounds(x, y, z), transform=src.transform)
+                    alpha = src.dataset_mask(window=window, out_shape=(TILE_SIZE, TILE_SIZE), boundless=True)
+                    if not alpha.any():
+                        continue
+                    rgb = src.read(bands, window=window, out_shape=(3, TILE_SIZE, TILE_SIZE), boundless=True,
+                                   fill_value=0, resampling=Resampling.bilinear)
+                    rgba = np.dstack([rgb[0], rgb[1], rgb[2], alpha]).astype(np.uint8)
+                    buffer = io.BytesIO()
+                    Image.fromarray(rgba).save(buffer, format=tile_format.upper())
+                    yield z, x, y, buffer.getvalue()
+
+def upload_xyz_tiles(s3_client, cog_path, bucket, prefix, tile_format=TILE_FORMAT):
+    content_type = f'image/{tile_format}'
+
+    def upload_tile(tile):
+        z, x, y, content = tile
+        s3_client.put_object(Bucket=bucket, Key=f'{prefix}/{z}/{x}/{y}.{tile_format}', Body=content,
+                             ContentType=content_type, CacheControl='public, max-age=31536000, immutable')
+
+    # Keep only a few tiles per worker in flight so the pyramid is never held in memory
+    tile_count = 0
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=TILE_UPLOAD_WORKERS) as executor:
+        for tile in render_xyz_tiles(cog_path, tile_format):
+            pending.append(executor.submit(upload_tile, tile))
+            if len(pending) >= TILE_UPLOAD_WORKERS * 2:
+                pending.popleft().result()
+                tile_count += 1
+        for future in pending:
+            future.result()
+            tile_count += 1
+    with rasterio.open(cog_path) as src:
+        minzoom, maxzoom = get_zoom_range(src)
+    return tile_count, minzoom, maxzoom
+
+def select_overview_level(src, target_resolution):
+    # Coarsest overview that is still at least as fine as the requested resolution
+    level = None
+    for i, factor in enumerate(src.overviews(1)):
+        if src.res[0] * factor <= target_resolution:
+            level = i
+    return level
+
+def render_tile(source_path, z, x, y):
+    # Renders one web-mercator tile by reading only the matching source window from the
+    # closest overview and reprojecting that window alone. Returns None for empty tiles.
+    # Sources without fine enough overviews are decimated on read to about twice the tile size.
+    dst_bounds = tile_bounds(x, y, z)
+    dst_transform = from_bounds(*dst_bounds, TILE_SIZE, TILE_SIZE)
+    with rasterio.open(source_path) as src:
+        src_crs = src.crs
+        src_bounds = transform_bounds('EPSG:3857', src_crs, *dst_bounds)
+        level = select_overview_level(src, (src_bounds[2] - src_bounds[0]) / TILE_SIZE)
+    with rasterio.open(source_path, overview_level=level) as src:
+        window = window_from_bounds(*src_bounds, transform=src.transform)
+        # A small margin keeps bilinear resampling continuous across tile edges
+        window = Window(window.col_off - 2, window.row_off - 2, window.width + 4, window.height + 4)
+        try:
+            window = window.round_offsets().round_lengths().intersection(Window(0, 0, src.width, src.height))
+        except rasterio.errors.WindowError:
+            return None
+        bands = [1, 2, 3] if src.count >= 3 else [1, 1, 1]
+        scale = max(window.width, window.height) / (2 * TILE_SIZE)
+        if scale > 1:
+            out_shape = (max(1, round(window.height / scale)), max(1, round(window.width / scale)))
+        else:
+            out_shape = (window.height, window.width)
+        data = src.read(bands, window=window, out_shape=(3, *out_shape), resampling=Resampling.average)
+        mask = src.dataset_mask(window=window, out_shape=out_shape)
+        src_transform = src.window_transform(window) * Affine.scale(window.width / out_shape[1],
+                                                                    window.height / out_shape[0])
+
+    rgba = np.zeros((4, TILE_SIZE, TILE_SIZE), dtype=np.uint8)
+    reproject(source=data, destination=rgba[:3], src_transform=src_transform, src_crs=src_crs,
+              dst_transform=dst_transform, dst_crs='EPSG:3857', resampling=Resampling.bilinear)
+    reproject(source=mask, destination=rgba[3], src_transform=src_transform, src_crs=src_crs,
+              dst_transform=dst_transform, dst_crs='EPSG:3857', resampling=Resampling.nearest)
+    if not rgba[3].any():
+        return None
+    buffer = io.BytesIO()
+    Image.fromarray(np.moveaxis(rgba, 0, -1)).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+class TileCache:
+    # Two-tier tile cache: an in-memory LRU in front of a disk cache evicted by total size.
+    # Empty tiles are cached as b''.
+    def __init__(self, max_entries=TILE_MEMORY_CACHE_ENTRIES, cache_dir=TILE_DISK_CACHE_DIR,
+                 max_disk_bytes=TILE_DISK_CACHE_BYTES):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.memory = OrderedDict()
+        self.disk = OrderedDict()  # file name -> size, least recently used first
+        self.disk_bytes = 0
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        for entry in sorted(os.scandir(cache_dir), key=lambda e: e.stat().st_atime):
+            self.disk[entry.name] = entry.stat().st_size
+            self.disk_bytes += entry.stat().st_size
+
+    def _file_name(self, key):
+        return '_'.join(str(part) for part in key) + '.png'
+
+    def get(self, key):
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                return self.memory[key]
+            file_name = self._file_name(key)
+            if file_name not in self.disk:
+                return None
+            self.disk.move_to_end(file_name)
+        try:
+            with open(os.path.join(self.cache_dir, file_name), 'rb') as f:
+                content = f.read()
+        except FileNotFoundError:
+            return None
+        self._remember(key, content)
+        return content
+
+    def put(self, key, content):
+        self._remember(key, content)
+        file_name = self._file_name(key)
+        with open(os.path.join(self.cache_dir, file_name), 'wb') as f:
+            f.write(content)
+        with self.lock:
+            self.disk_bytes += len(content) - self.disk.pop(file_name, 0)
+            self.disk[file_name] = len(content)
+            while self.disk_bytes > self.max_disk_bytes and self.disk:
+                evicted, size = self.disk.popitem(last=False)
+                self.disk_bytes -= size
+                try:
+                    os.remove(os.path.join(self.cache_dir, evicted))
+                except FileNotFoundError:
+                    pass
+
+    def _remember(self, key, content):
+        with self.lock:
+            self.memory[key] = content
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.max_entries:
+                self.memory.popitem(last=False)
+
+tile_cache = TileCache()
+
+def init_job_worker():
+    # Forked workers must not share the parent's S3 connection pool
+    global s3_client
+    s3_client = make_s3_client(AWS_REGION)
+
+job_queue = JobQueue(JOB_WORKERS, JOB_QUEUE_LIMIT, initializer=init_job_worker)
+tile_sources = {}  # image_id -> (prefix, source path, expiry time or None)
+
+def find_tile_source_key(prefix, image_id):
+    # Uploads keep their original file name, so the extension may be .tif, .tiff or upper case
+    response = s3_client.list_objects_v2(Bucket=S3_BUCKET, Prefix=f'{prefix}{image_id}.')
+    for obj in response.get('Contents', []):
+        stem, ext = os.path.splitext(obj['Key'][len(prefix):])
+        if stem == image_id and ext.lower() in TILE_SOURCE_EXTENSIONS:
+            return obj['Key']
+    return None
+
+def get_tile_source(image_id):
+    # Prefer the COG written by the tiled output mode, falling back to the raw upload. Returns
+    # (prefix, source path) or None. Only a COG is remembered for good; the raw upload is
+    # re-checked after TILE_SOURCE_FALLBACK_TTL so a COG written later takes over.
+    cached = tile_sources.get(image_id)
+    if cached is not None and (cached[2] is None or cached[2] > time.time()):
+        return cached[:2]
+    for prefix in TILE_SOURCE_PREFIXES:
+        key = find_tile_source_key(prefix, image_id)
+        if key is None:
+            continue
+        expires = None if prefix == TILE_SOURCE_PREFIXES[0] else time.time() + TILE_SOURCE_FALLBACK_TTL
+        tile_sources[image_id] = (prefix, f'/vsis3/{S3_BUCKET}/{key}', expires)
+        return tile_sources[image_id][:2]
+    tile_sources.pop(image_id, None)
+    return None
+
+def verify_png(png_file):
     try:
-        with Image.open(local_png_path) as img:
+        with Image.open(png_file) as img:
             img.verify()
         print("PNG file is valid")
     except Exception as e:
         print(f"PNG file is invalid: {str(e)}")
         raise
 
-def clean_up(files):
-    for file in files:
-        try:
-            os.remove(file)
-        except Exception as e:
-            print(f"Error removing file {file}: {str(e)}")
+def read_gdal_memfile(vsimem_path):
+    # Reads a file written to GDAL's in-memory filesystem and releases it
+    handle = gdal.VSIFOpenL(vsimem_path, 'rb')
+    try:
+        gdal.VSIFSeekL(handle, 0, 2)
+        size = gdal.VSIFTellL(handle)
+        gdal.VSIFSeekL(handle, 0, 0)
+        return gdal.VSIFReadL(1, size, handle)
+    finally:
+        gdal.VSIFCloseL(handle)
+        gdal.Unlink(vsimem_path)
+
+@contextmanager
+def gdal_thread_config(**options):
+    # GDAL config options for the calling thread only, so concurrent jobs don't see each other's
+    previous = {key: gdal.GetThreadLocalConfigOption(key, None) for key in options}
+    for key, value in options.items():
+        gdal.SetThreadLocalConfigOption(key, str(value))
+    try:
+        yield
+    finally:
+        for key, value in previous.items():
+            gdal.SetThreadLocalConfigOption(key, value)
+
+def has_tiff_tiles(tiff_path):
+    # A one-tile-wide tiled TIFF has blocks as wide as the raster, just like strips, so the
+    # layout is read from the TileWidth tag of the first IFD instead
+    handle = gdal.VSIFOpenL(tiff_path, 'rb')
+    if handle is None:
+        raise ValueError("Unable to open TIFF file.")
+    try:
+        header = gdal.VSIFReadL(1, 16, handle)
+        order = '<' if header[:2] == b'II' else '>'
+        if struct.unpack(order + 'H', header[2:4])[0] == 43:  # BigTIFF
+            count_format, entry_size, ifd_offset = 'Q', 20, struct.unpack(order + 'Q', header[8:16])[0]
+        else:
+            count_format, entry_size, ifd_offset = 'H', 12, struct.unpack(order + 'I', header[4:8])[0]
+        gdal.VSIFSeekL(handle, ifd_offset, 0)
+        count = struct.unpack(order + count_format, gdal.VSIFReadL(1, struct.calcsize(count_format), handle))[0]
+        entries = gdal.VSIFReadL(1, count * entry_size, handle)
+    finally:
+        gdal.VSIFCloseL(handle)
+    tags = {struct.unpack(order + 'H', entries[i:i + 2])[0] for i in range(0, len(entries) - 1, entry_size)}
+    return TIFFTAG_TILEWIDTH in tags
 
 def extract_tiff_properties(input_tiff_path):
     dataset = gdal.Open(input_tiff_path)
     if not dataset:
         raise ValueError("Unable to open TIFF file.")
-    
+
+    # Encoding details live in the IMAGE_STRUCTURE metadata domain
+    band = dataset.GetRasterBand(1)
     driver = dataset.GetDriver().ShortName
-    compression = dataset.GetMetadataItem('COMPRESSION') or 'UNKNOWN'
-    photometric = dataset.GetMetadataItem('PHOTOMETRIC') or 'UNKNOWN'
-    interleave = dataset.GetMetadataItem('INTERLEAVE') or 'UNKNOWN'
-    tiled = dataset.GetMetadataItem('TILED') or 'NO'
-    bits_per_sample = dataset.GetRasterBand(1).GetMetadataItem('NBITS') or 'UNKNOWN'
-    
+    compression = dataset.GetMetadataItem('COMPRESSION', 'IMAGE_STRUCTURE') or 'NONE'
+    photometric = dataset.GetMetadataItem('SOURCE_COLOR_SPACE', 'IMAGE_STRUCTURE') or 'UNKNOWN'
+    if compression == 'YCbCr JPEG':
+        compression, photometric = 'JPEG', 'YCBCR'
+    interleave = dataset.GetMetadataItem('INTERLEAVE', 'IMAGE_STRUCTURE') or 'UNKNOWN'
+    block_x, block_y = band.GetBlockSize()
+    if driver == 'GTiff':
+        tiled = 'YES' if has_tiff_tiles(input_tiff_path) else 'NO'
+    else:
+        tiled = 'YES' if block_x < dataset.RasterXSize else 'NO'  # Strips span the full width
+    bits_per_sample = band.GetMetadataItem('NBITS', 'IMAGE_STRUCTURE') or str(gdal.GetDataTypeSize(band.DataType))
+
     dataset = None  # Close the dataset
     return {
         "driver": driver,
@@ -88,12 +454,29 @@ def extract_tiff_properties(input_tiff_path):
         "photometric": photometric,
         "interleave": interleave,
         "tiled": tiled,
+        "block_size": [block_x, block_y],
         "bits_per_sample": bits_per_sample
     }
 
-def convert_tiff_with_default_compression(input_tiff_path, output_tiff_path, properties):
-    creation_options = []
-    
+def probe_tiff_properties(bucket, key):
+    # Opens the object through /vsis3/, so GDAL only fetches the header with range requests
+    with gdal_thread_config(GDAL_DISABLE_READDIR_ON_OPEN='EMPTY_DIR', AWS_REGION=AWS_REGION):
+        return extract_tiff_properties(f'/vsis3/{bucket}/{key}')
+
+def encoding_unchanged(properties, block_size=GDAL_BLOCK_SIZE):
+    # True when convert_tiff_with_default_compression would write the same encoding again
+    if properties['driver'] != 'GTiff' or properties['interleave'] != 'PIXEL':
+        return False
+    if properties['compression'] == 'JPEG':
+        if properties['photometric'] != 'YCBCR':
+            return False
+    elif properties['compression'] != 'LZW':
+        return False
+    return properties['tiled'] == 'NO' or properties['block_size'] == [block_size, block_size]
+
+def convert_tiff_with_default_compression(input_tiff_path, output_tiff_path, properties, block_size=GDAL_BLOCK_SIZE):
+    creation_options = [f'NUM_THREADS={GDAL_NUM_THREADS}']
+
     if properties['compression'] == 'JPEG':
         creation_options.append('COMPRESS=JPEG')
         creation_options.append('PHOTOMETRIC=YCBCR')
@@ -103,52 +486,174 @@ def convert_tiff_with_default_compression(input_tiff_path, output_tiff_path, pro
 
     if properties['tiled'] == 'YES':
         creation_options.append('TILED=YES')
+        creation_options.append(f'BLOCKXSIZE={block_size}')
+        creation_options.append(f'BLOCKYSIZE={block_size}')
     else:
         creation_options.append('TILED=NO')
 
-    gdal.Translate(
-        output_tiff_path,
-        input_tiff_path,
-        format='GTiff',
-        creationOptions=creation_options
-    )
-
-@app.route('/gdal_Test', methods=['POST'])
-def gdal_test():
-    data = request.json
-    s3_key = data.get('s3_key')  # The S3 key of the TIFF image
-    if not s3_key:
-        return jsonify({'error': 'Missing s3_key in request'}), 400
+    with gdal_thread_config(GDAL_NUM_THREADS=GDAL_NUM_THREADS):
+        gdal.Translate(
+            output_tiff_path,
+            input_tiff_path,
+            format='GTiff',
+            creationOptions=creation_options
+        )
+
+def run_gdal_test(s3_key, timings, probe_only=False, block_size=GDAL_BLOCK_SIZE):
+    file_name = os.path.basename(s3_key)
+    output_file_name = f'{os.path.splitext(file_name)[0]}_output.tif'
+    output_s3_key = f'gdal-output/{output_file_name}'
+    # URL that doesn't require signing
+    output_url = f"https://{S3_BUCKET}.s3.{AWS_REGION}.amazonaws.com/{output_s3_key}"
+
+    # Extract TIFF properties from the header alone
+    with timed(timings, 'probe'):
+        tiff_properties = probe_tiff_properties(S3_BUCKET, s3_key)
+    print("Extracted Properties:", tiff_properties)
+    if probe_only:
+        return {'properties': tiff_properties}
+
+    # Translate would only write the same encoding again, so copy the object within S3 instead
+    if encoding_unchanged(tiff_properties, block_size):
+        with timed(timings, 'copy'):
+            copy_object(s3_client, S3_BUCKET, s3_key, output_s3_key)
+        return {'output_url': output_url, 'properties': tiff_properties, 're_encoded': False}
+
+    # Request-unique paths in GDAL's in-memory filesystem
+    request_dir = f'/vsimem/{uuid.uuid4()}'
+    input_tiff_path = f'{request_dir}/{file_name}'
+    output_tiff_path = f'{request_dir}/{output_file_name}'
+
+    # Download the TIFF file from S3
+    with timed(timings, 'download'):
+        gdal.FileFromMemBuffer(input_tiff_path, read_s3_object(s3_client, S3_BUCKET, s3_key))
 
     try:
-        file_name = os.path.basename(s3_key)
-        local_tiff_path = f'/tmp/{file_name}'
+        # Process the TIFF file with default or determined compression
+        with timed(timings, 'convert'):
+            convert_tiff_with_default_compression(input_tiff_path, output_tiff_path, tiff_properties, block_size)
+            output_content = read_gdal_memfile(output_tiff_path)
+    finally:
+        gdal.Unlink(input_tiff_path)
 
-        # Download the TIFF file from S3
-        download_file(s3_client, S3_BUCKET, s3_key, local_tiff_path)
+    # Upload the processed file back to S3
+    with timed(timings, 'upload'):
+        upload_fileobj(s3_client, io.BytesIO(output_content), S3_BUCKET, output_s3_key, 'image/tiff')
 
-        # Extract TIFF properties
-        tiff_properties = extract_tiff_properties(local_tiff_path)
-        print("Extracted Properties:", tiff_properties)
+    return {'output_url': output_url, 'properties': tiff_properties, 're_encoded': True}
 
-        # Process the TIFF file with default or determined compression
-        output_tiff_path = f'/tmp/{os.path.splitext(file_name)[0]}_output.tif'
-        convert_tiff_with_default_compression(local_tiff_path, output_tiff_path, tiff_properties)
-
-        # Upload the processed file back to S3
-        output_s3_key = f'gdal-output/{os.path.basename(output_tiff_path)}'
-        upload_file(s3_client, output_tiff_path, S3_BUCKET, output_s3_key, 'image/tiff')
+def run_process_image_and_notify(s3_key, output_mode, timings, dedup=PRODUCT_DEDUP):
+    # Reports the outcome to clients waiting on the PNG key instead of polling for it
+    png_s3_key = f"png-export/{os.path.basename(s3_key).rsplit('.', 1)[0]}.png"
+    try:
+        result = run_process_image(s3_key, output_mode, timings, dedup)
+    except Exception as e:
+        notify_completion(completion_event('processing', png_s3_key, 'failed', error=str(e)))
+        raise
+    notify_completion(completion_event('processing', png_s3_key, deduplicated=result.get('deduplicated', False)))
+    return result
+
+def run_process_image(s3_key, output_mode, timings, dedup=PRODUCT_DEDUP):
+    file_name = os.path.basename(s3_key)
+
+    # No need to extract the UUID again; use the existing base name
+    base_file_name = file_name.rsplit('.', 1)[0]  # This includes the UUID
+    png_filename = f"{base_file_name}.png"  # No need to append the UUID again
+    png_s3_key = f'png-export/{png_filename}'
+    bounds_key = f'png-export/{base_file_name}_bounds.json'
+    png_url = f"https://{S3_BUCKET}.s3.{AWS_REGION}.amazonaws.com/{png_s3_key}"
+
+    # A re-upload of an already processed file only needs its products copied
+    if dedup and output_mode != 'tiles':
+        with timed(timings, 'dedup'):
+            digest = get_source_digest(s3_client, S3_BUCKET, s3_key)
+            targets = {'png': png_s3_key, 'bounds': bounds_key}
+            if restore_products(s3_client, S3_BUCKET, digest, targets):
+                bounds_obj = s3_client.get_object(Bucket=S3_BUCKET, Key=bounds_key)
+                bounds_dict = json.loads(bounds_obj['Body'].read().decode('utf-8'))
+                print(f"Reused products of {digest} for {s3_key}")
+                return {'png_url': png_url, 'bounds': bounds_dict, 'deduplicated': True}
+
+    # Download the TIFF file from S3 into memory
+    with timed(timings, 'download'):
+        tiff_memfile = open_s3_memfile(s3_client, S3_BUCKET, s3_key)
+
+    with tiff_memfile, MemoryFile(ext='.png') as png_memfile:
+        if output_mode == 'tiles':
+            return process_image_tiles(tiff_memfile.name, base_file_name, timings)
 
-        # Clean up
-        clean_up([local_tiff_path, output_tiff_path])
+        # Convert TIFF to PNG
+        reprojection_cache = {}
+        with timed(timings, 'convert'):
+            bounds_dict = convert_tiff_to_png(tiff_memfile.name, png_memfile.name, cache_info=reprojection_cache)
 
-        # Generate a URL that doesn't require signing
-        output_url = f"https://{S3_BUCKET}.s3.{AWS_REGION}.amazonaws.com/{output_s3_key}"
+        # Verify PNG integrity
+        verify_png(png_memfile)
+
+        # Upload the PNG and its bounds (same UUID) to S3 at the same time. upload_fileobj
+        # raises if the upload fails, so no follow-up head_object is needed.
+        with timed(timings, 'upload'):
+            run_concurrently(
+                (upload_fileobj, s3_client, png_memfile, S3_BUCKET, png_s3_key, 'image/png'),
+                (upload_fileobj, s3_client, io.BytesIO(json.dumps(bounds_dict).encode('utf-8')), S3_BUCKET, bounds_key)
+            )
+            print(f"File {png_s3_key} uploaded successfully to S3")
+
+    if dedup:
+        record_products(s3_client, S3_BUCKET, digest, targets)
+    print(bounds_dict)
+
+    return {'png_url': png_url, 'bounds': bounds_dict, 'reprojection_cache': reprojection_cache, 'deduplicated': False}
+
+def process_image_tiles(tiff_path, base_file_name, timings):
+    # Tiled output: a COG plus a pre-rendered XYZ pyramid under a per-image prefix
+    tile_prefix = f'tiles/{base_file_name}'
+    cog_s3_key = f'cog-export/{base_file_name}.tif'
+    tile_url = f"https://{S3_BUCKET}.s3.{AWS_REGION}.amazonaws.com/{tile_prefix}/{{z}}/{{x}}/{{y}}.{TILE_FORMAT}"
+    cog_url = f"https://{S3_BUCKET}.s3.{AWS_REGION}.amazonaws.com/{cog_s3_key}"
+
+    with MemoryFile(ext='.tif') as cog_memfile:
+        with timed(timings, 'convert'):
+            bounds_dict = convert_tiff_to_cog(tiff_path, cog_memfile.name)
+
+        with timed(timings, 'tiles'):
+            tile_count, minzoom, maxzoom = upload_xyz_tiles(s3_client, cog_memfile.name, S3_BUCKET, tile_prefix)
+        print(f"Uploaded {tile_count} tiles for zooms {minzoom}-{maxzoom} to {tile_prefix}")
+
+        # The tile template goes next to the bounds, which other stages (segmentation) copy as is.
+        # The bounds are written last, as clients take them as the sign that the output is ready.
+        bounds_key = f'png-export/{base_file_name}_bounds.json'
+        tiles_key = f'png-export/{base_file_name}_tiles.json'
+        tiles_info = {'tile_url': tile_url, 'minzoom': minzoom, 'maxzoom': maxzoom}
+        with timed(timings, 'upload'):
+            run_concurrently(
+                (upload_fileobj, s3_client, cog_memfile, S3_BUCKET, cog_s3_key, 'image/tiff'),
+                (upload_fileobj, s3_client, io.BytesIO(json.dumps(tiles_info).encode('utf-8')), S3_BUCKET, tiles_key)
+            )
+            upload_fileobj(s3_client, io.BytesIO(json.dumps(bounds_dict).encode('utf-8')), S3_BUCKET, bounds_key)
+
+    return {'tile_url': tile_url, 'cog_url': cog_url, 'bounds': bounds_dict,
+            'minzoom': minzoom, 'maxzoom': maxzoom}
+
+def submit_or_run(data, job_type, fn, **kwargs):
+    # Runs the job inline, or queues it and returns a job id at once when 'async' is set
+    if data.get('async'):
+        try:
+            job = job_queue.submit(job_type, fn, **kwargs)
+        except QueueFullError as e:
+            return jsonify({'error': str(e)}), 429, {'Retry-After': str(JOB_RETRY_AFTER_SECONDS)}
+        except BrokenProcessPool:
+            # The queue has already replaced its dead worker pool, so a retry can succeed
+            return jsonify({'error': 'Job workers are restarting'}), 503, {'Retry-After': str(JOB_RETRY_AFTER_SECONDS)}
+        return jsonify({'job_id': job['job_id'], 'status': job['status'],
+                        'status_url': f"/jobs/{job['job_id']}"}), 202
 
-        return jsonify({'output_url': output_url})
+    try:
+        timings = {}
+        result = fn(timings=timings, **kwargs)
+        return jsonify(dict(result, timings=timings))
 
     except Exception as e:
-        # Handle errors
         error_message = str(e)
         stack_trace = traceback.format_exc()
         print(f"Error: {error_message}")
@@ -156,55 +661,68 @@ def gdal_test():
         return jsonify({'error': error_message, 'stack_trace': stack_trace}), 500
 
 
+@app.route('/gdal_Test', methods=['POST'])
+def gdal_test():
+    data = request.json
+    s3_key = data.get('s3_key')  # The S3 key of the TIFF image
+    if not s3_key:
+        return jsonify({'error': 'Missing s3_key in request'}), 400
+    block_size = data.get('block_size', GDAL_BLOCK_SIZE)
+    if isinstance(block_size, str) and block_size.strip().isdigit():
+        block_size = int(block_size)
+    if not isinstance(block_size, int) or isinstance(block_size, bool) or block_size <= 0 or block_size % 16:
+        return jsonify({'error': 'block_size must be a positive multiple of 16'}), 400
+    return submit_or_run(data, 'gdal-test', run_gdal_test, s3_key=s3_key, probe_only=data.get('probe_only', False),
+                         block_size=block_size)
+
+
 @app.route('/process-image', methods=['POST'])
 def process_image():
     data = request.json
     s3_key = data.get('s3_key')  # The S3 key includes the UUID
     if not s3_key:
         return jsonify({'error': 'Missing s3_key in request'}), 400
+    return submit_or_run(data, 'process-image', run_process_image_and_notify, s3_key=s3_key,
+                         output_mode=data.get('output', OUTPUT_MODE), dedup=data.get('dedup', PRODUCT_DEDUP))
 
-    try:
-        file_name = os.path.basename(s3_key)
-
-        # No need to extract the UUID again; use the existing base name
-        base_file_name = file_name.rsplit('.', 1)[0]  # This includes the UUID
-
-        local_tiff_path = f'/tmp/{file_name}'
-        png_filename = f"{base_file_name}.png"  # No need to append the UUID again
-        local_png_path = f'/tmp/{png_filename}'
-
-        # Ensure the /tmp directory is used correctly without subdirectories
-        if not os.path.exists('/tmp'):
-            os.makedirs('/tmp')
-
-        # Download the TIFF file from S3
-        download_file(s3_client, S3_BUCKET, s3_key, local_tiff_path)
 
-        # Convert TIFF to PNG
-        bounds_dict = convert_tiff_to_png(local_tiff_path, local_png_path)
-
-        # Verify PNG integrity
-        verify_png(local_png_path)
-
-        # Upload PNG to S3
-        png_s3_key = f'png-export/{png_filename}'
-        upload_file(s3_client, local_png_path, S3_BUCKET, png_s3_key, 'image/png')
-
-        # Verify S3 upload
-        s3_client.head_object(Bucket=S3_BUCKET, Key=png_s3_key)
-        print(f"File {png_s3_key} uploaded successfully to S3")
+@app.route('/metrics/s3', methods=['GET'])
+def get_s3_metrics():
+    # Latency histograms for S3 calls made by this server process
+    return jsonify(s3_latency.snapshot())
 
-        # Generate a URL that doesn't require signing
-        png_url = f"https://{S3_BUCKET}.s3.{AWS_REGION}.amazonaws.com/{png_s3_key}"
 
-        # Save bounds to S3 as JSON, with the same UUID
-        bounds_key = f'png-export/{base_file_name}_bounds.json'
-        s3_client.put_object(Bucket=S3_BUCKET, Key=bounds_key, Body=json.dumps(bounds_dict))
-
-        clean_up([local_tiff_path, local_png_path])
-        print(bounds_dict)
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': f'Job {job_id} not found'}), 404
+    return jsonify(job)
 
-        return jsonify({'png_url': png_url, 'bounds': bounds_dict})
+@app.route('/tiles/<image_id>/<int:z>/<int:x>/<int:y>.png', methods=['GET'])
+def get_tile(image_id, z, x, y):
+    try:
+        source = get_tile_source(image_id)
+        if source is None:
+            return jsonify({'error': f'No source raster found for {image_id}'}), 404
+        prefix, source_path = source
+        # Tiles rendered from the raw upload must not be served once the COG exists
+        key = (image_id, prefix.rstrip('/'), z, x, y)
+        content = tile_cache.get(key)
+        if content is None:
+            # Range requests against S3 only fetch the header and the blocks the tile touches
+            with rasterio.Env(AWSSession(boto3.Session(region_name=AWS_REGION)),
+                              GDAL_DISABLE_READDIR_ON_OPEN='EMPTY_DIR', VSI_CACHE=True):
+                content = render_tile(source_path, z, x, y) or b''
+            tile_cache.put(key, content)
+
+        etag = hashlib.md5(content).hexdigest()
+        headers = {'ETag': f'"{etag}"', 'Cache-Control': TILE_CACHE_CONTROL}
+        if request.if_none_match.contains(etag):
+            return Response(status=304, headers=headers)
+        if not content:
+            return Response(status=204, headers=headers)
+        return Response(content, mimetype='image/png', headers=headers)
 
     except Exception as e:
         error_message = str(e)
@@ -214,63 +732,65 @@ def process_image():
         return jsonify({'error': error_message, 'stack_trace': stack_trace}), 500
 
 
+def run_convert_png_to_tif(png_s3_key, timings, dedup=PRODUCT_DEDUP, codec=EXPORT_CODEC, predictor=EXPORT_PREDICTOR):
+    png_file_name = os.path.basename(png_s3_key)
+    tiff_file_name = export_file_name(png_file_name, codec, predictor)
+    product = export_product(codec, predictor)
 
-@app.route('/convert-png-to-tif', methods=['POST'])
-def convert_png_to_tif():
-    data = request.json
-    png_s3_key = data.get('s3_key')
-    if not png_s3_key:
-        return jsonify({'error': 'Missing s3_key in request'}), 400
-
-    try:
-        png_file_name = os.path.basename(png_s3_key)
-        tiff_file_name = png_file_name.rsplit('.', 1)[0] + '.tif'
-        local_png_path = f'/tmp/{png_file_name}'
-        local_tiff_path = f'/tmp/{tiff_file_name}'
+    # The same classified PNG with the same bounds (same ETags) always converts to the same
+    # TIFF, so reuse it as is
+    bounds_key = png_s3_key.replace('classified.png', 'bounds.json')
+    if dedup:
+        with timed(timings, 'dedup'):
+            digest = get_combined_digest(s3_client, S3_BUCKET, [png_s3_key, bounds_key])
+            existing = lookup_products(s3_client, S3_BUCKET, digest, [product])
+        if existing:
+            tiff_url = f"https://{S3_BUCKET}.s3.{AWS_REGION}.amazonaws.com/{existing[product]}"
+            return {'tiff_url': tiff_url, 'deduplicated': True}
 
-        # Download the PNG file from S3
-        download_file(s3_client, S3_BUCKET, png_s3_key, local_png_path)
+    # Download the PNG file from S3
+    with timed(timings, 'download'):
+        png_content = read_s3_object(s3_client, S3_BUCKET, png_s3_key)
 
         # Fetch bounds from corresponding JSON file
-        bounds_key = png_s3_key.replace('classified.png', 'bounds.json')
         bounds_obj = s3_client.get_object(Bucket=S3_BUCKET, Key=bounds_key)
         bounds = json.loads(bounds_obj['Body'].read().decode('utf-8'))
 
-        # Convert PNG to TIFF with geospatial metadata
-        with Image.open(local_png_path) as img:
-            img = img.convert('RGBA')
-            transform = from_bounds(bounds['left'], bounds['bottom'], bounds['right'], bounds['top'], img.width, img.height)
-            meta = {
-                'driver': 'GTiff',
-                'dtype': 'uint8',
-                'count': 4,
-                'height': img.height,
-                'width': img.width,
-                'crs': 'EPSG:4326',
-                'transform': transform,
-                'compress': 'LZW'
-            }
-            with rasterio.open(local_tiff_path, 'w', **meta) as dst:
-                for i, band in enumerate(img.split(), start=1):
-                    dst.write(np.array(band), i)
+    # Convert the PNG to a paletted single-band Cloud Optimized GeoTIFF with geospatial metadata
+    with MemoryFile(ext='.tif') as tiff_memfile:
+        with timed(timings, 'convert'):
+            labels, palette = read_png_labels(png_content)
+            height, width = labels.shape
+            transform = from_bounds(bounds['left'], bounds['bottom'], bounds['right'], bounds['top'], width, height)
+            write_label_cog(tiff_memfile.name, labels, palette, transform, codec=codec, predictor=predictor)
 
         # Upload TIFF to S3
         tiff_s3_key = f'tif-export/{tiff_file_name}'
-        upload_file(s3_client, local_tiff_path, S3_BUCKET, tiff_s3_key, 'image/tiff')
-
-        # Generate a URL for the TIFF file
-        tiff_url = f"https://{S3_BUCKET}.s3.{AWS_REGION}.amazonaws.com/{tiff_s3_key}"
+        with timed(timings, 'upload'):
+            upload_fileobj(s3_client, tiff_memfile, S3_BUCKET, tiff_s3_key, 'image/tiff')
+    if dedup:
+        record_products(s3_client, S3_BUCKET, digest, {product: tiff_s3_key})
 
-        clean_up([local_png_path, local_tiff_path])
+    # Generate a URL for the TIFF file
+    tiff_url = f"https://{S3_BUCKET}.s3.{AWS_REGION}.amazonaws.com/{tiff_s3_key}"
 
-        return jsonify({'tiff_url': tiff_url})
+    return {'tiff_url': tiff_url, 'deduplicated': False}
 
-    except Exception as e:
-        error_message = str(e)
-        stack_trace = traceback.format_exc()
-        print(f"Error: {error_message}")
-        print(f"Stack trace: {stack_trace}")
-        return jsonify({'error': error_message, 'stack_trace': stack_trace}), 500
+@app.route('/convert-png-to-tif', methods=['POST'])
+def convert_png_to_tif():
+    data = request.json
+    png_s3_key = data.get('s3_key')
+    if not png_s3_key:
+        return jsonify({'error': 'Missing s3_key in request'}), 400
+    codec = data.get('codec', EXPORT_CODEC).upper()
+    if codec not in EXPORT_CODECS:
+        return jsonify({'error': f'Unknown codec {codec}, expected one of {list(EXPORT_CODECS)}'}), 400
+    try:
+        predictor = parse_predictor(data.get('predictor', EXPORT_PREDICTOR))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return submit_or_run(data, 'convert-png-to-tif', run_convert_png_to_tif, png_s3_key=png_s3_key,
+                         dedup=data.get('dedup', PRODUCT_DEDUP), codec=codec, predictor=predictor)
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000)
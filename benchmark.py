@@ -0,0 +1,714 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import subprocess
+import threading
+import time
+import tracemalloc
+import numpy as np
+
+def benchmark_inference(model_path, image_size=2048, batch_sizes=(1, 4, 8, 16), thread_counts=(1, 2, 4), num_interpreters=1):
+    from segmentFunction import InferenceEngine, create_patches
+
+    with open(model_path, 'rb') as f:
+        model_content = f.read()
+
+    rng = np.random.default_rng(0)
+    image = rng.random((image_size, image_size, 3), dtype=np.float32)
+    patches, _, _ = create_patches(image)
+
+    results = []
+    for batch_size in batch_sizes:
+        for num_threads in thread_counts:
+            engine = InferenceEngine(model_content, batch_size=batch_size, num_threads=num_threads,
+                                     num_interpreters=num_interpreters)
+            engine.predict_patches(patches[:engine.batch_size])  # Warm up
+            start = time.perf_counter()
+            engine.predict_patches(patches)
+            elapsed = time.perf_counter() - start
+            results.append({
+                'batch_size': engine.batch_size,
+                'num_threads': num_threads,
+                'num_interpreters': num_interpreters,
+                'patches': len(patches),
+                'seconds': round(elapsed, 3),
+                'patches_per_sec': round(len(patches) / elapsed, 2)
+            })
+            print(results[-1])
+    return results
+
+def seam_ratio(segmentation, patch_size=(256, 256)):
+    # Label change rate across the non-overlapping tile grid relative to the change rate
+    # everywhere else; values well above 1 mean visible seams
+    ph, pw = patch_size
+    row_changes = segmentation[1:, :] != segmentation[:-1, :]
+    col_changes = segmentation[:, 1:] != segmentation[:, :-1]
+    seam_rows = np.arange(ph - 1, row_changes.shape[0], ph)
+    seam_cols = np.arange(pw - 1, col_changes.shape[1], pw)
+    seam = row_changes[seam_rows].sum() + col_changes[:, seam_cols].sum()
+    seam_pixels = row_changes[seam_rows].size + col_changes[:, seam_cols].size
+    overall = (row_changes.sum() + col_changes.sum()) / (row_changes.size + col_changes.size)
+    if seam_pixels == 0 or overall == 0:
+        return 0.0
+    return float(seam / seam_pixels / overall)
+
+def benchmark_sliding_window(model_path, image_path=None, image_size=2048, strides=(256, 192, 128), batch_size=8):
+    from PIL import Image
+    from segmentFunction import InferenceEngine, preprocess_image, sliding_window_segmentation
+
+    with open(model_path, 'rb') as f:
+        model_content = f.read()
+    if image_path:
+        image = preprocess_image(Image.open(image_path).convert('RGB'))
+    else:
+        image = np.random.default_rng(0).random((image_size, image_size, 3), dtype=np.float32)
+    engine = InferenceEngine(model_content, batch_size=batch_size)
+
+    results = []
+    reference = None
+    for stride in sorted(strides):
+        start = time.perf_counter()
+        segmentation = sliding_window_segmentation(image, engine, stride=(stride, stride))
+        elapsed = time.perf_counter() - start
+        # The densest stride is the quality reference for the others
+        if reference is None:
+            reference = segmentation
+        results.append({
+            'stride': stride,
+            'seconds': round(elapsed, 3),
+            'mpix_per_sec': round(image.shape[0] * image.shape[1] / elapsed / 1e6, 3),
+            f'agreement_with_stride_{min(strides)}': round(float(np.mean(segmentation == reference)), 4),
+            'seam_ratio': round(seam_ratio(segmentation, engine.patch_size), 3)
+        })
+        print(results[-1])
+    return results
+
+def load_fixed_tiles(image_path=None, num_tiles=64, patch_size=(256, 256), seed=0):
+    # The same uint8 tiles on every run: the first num_tiles of an image's tile grid, or
+    # smooth random blobs when no image is given
+    from PIL import Image
+    from segmentFunction import create_patches, pad_image
+
+    ph, pw = patch_size
+    if image_path:
+        image = np.asarray(Image.open(image_path).convert('RGB'))
+        patches, _, _ = create_patches(pad_image(image, patch_size), patch_size)
+        return [np.ascontiguousarray(patch) for patch in patches[:num_tiles]]
+    rng = np.random.default_rng(seed)
+    cells = rng.integers(0, 256, (num_tiles, ph // 32 + 1, pw // 32 + 1, 3), dtype=np.uint8)
+    tiles = np.kron(cells, np.ones((1, 32, 32, 1), dtype=np.uint8))[:, :ph, :pw]
+    noise = rng.integers(-8, 9, tiles.shape)
+    return list(np.clip(tiles + noise, 0, 255).astype(np.uint8))
+
+def benchmark_quantization(float_model_path, variant_paths, image_path=None, num_tiles=64, batch_size=8, repeats=3):
+    # Accuracy and throughput of reduced-precision model variants against the float model
+    from segmentFunction import InferenceEngine
+
+    def run(model_path):
+        with open(model_path, 'rb') as f:
+            engine = InferenceEngine(f.read(), batch_size=batch_size)
+        engine.predict_patches(tiles[:engine.batch_size])  # Warm up
+        start = time.perf_counter()
+        for _ in range(repeats):
+            labels = engine.predict_patches(tiles)
+        elapsed = (time.perf_counter() - start) / repeats
+        return engine, labels, engine.predict_logits(tiles), elapsed
+
+    tiles = None
+    results = []
+    for name, model_path in [('float32', float_model_path)] + list(variant_paths.items()):
+        if tiles is None:
+            with open(model_path, 'rb') as f:
+                patch_size = InferenceEngine(f.read(), batch_size=1).patch_size
+            tiles = load_fixed_tiles(image_path, num_tiles, patch_size)
+        engine, labels, logits, elapsed = run(model_path)
+        if name == 'float32':
+            reference_labels, reference_logits = labels, logits
+        ious = {}
+        for cls in range(engine.num_classes):
+            union = np.sum((labels == cls) | (reference_labels == cls))
+            if union:
+                ious[str(cls)] = round(float(np.sum((labels == cls) & (reference_labels == cls)) / union), 4)
+        results.append({
+            'variant': name,
+            'tiles': len(tiles),
+            'seconds': round(elapsed, 3),
+            'tiles_per_sec': round(len(tiles) / elapsed, 2),
+            'speedup': round(results[0]['seconds'] / elapsed, 2) if results else 1.0,
+            'pixel_agreement': round(float(np.mean(labels == reference_labels)), 4),
+            'class_iou': ious,
+            'mean_abs_logit_error': round(float(np.mean(np.abs(logits.astype(np.float32) - reference_logits))), 5)
+        })
+        print(results[-1])
+    return results
+
+def make_label_mask(size, num_classes=6, block=8, seed=0, class_weights=None):
+    # Blocky random labels so that components span a range of sizes around min_area.
+    # class_weights sets the share of each class instead of a uniform mix.
+    rng = np.random.default_rng(seed)
+    if class_weights is None:
+        cells = rng.integers(0, num_classes, (size // block + 1, size // block + 1), dtype=np.uint8)
+    else:
+        weights = np.asarray(class_weights, dtype=np.float64)
+        cells = rng.choice(len(weights), (size // block + 1, size // block + 1), p=weights / weights.sum()).astype(np.uint8)
+    mask = np.kron(cells, np.ones((block, block), dtype=np.uint8))[:size, :size]
+    noise = rng.random((size, size)) < 0.02
+    mask[noise] = rng.integers(0, num_classes, noise.sum(), dtype=np.uint8)
+    return mask
+
+def benchmark_cleanup(sizes=(256, 512, 1024, 4096), min_area=100, reference_limit=1024):
+    from segmentFunction import clean_segmentation, clean_segmentation_reference
+
+    results = []
+    for size in sizes:
+        mask = make_label_mask(size).astype(np.int32)
+        start = time.perf_counter()
+        cleaned = clean_segmentation(mask, min_area)
+        elapsed = time.perf_counter() - start
+        result = {'size': size, 'seconds': round(elapsed, 3), 'mpix_per_sec': round(size * size / elapsed / 1e6, 2)}
+
+        # The DFS reference is too slow for large masks, so only compare on the small ones
+        if size <= reference_limit:
+            start = time.perf_counter()
+            expected = clean_segmentation_reference(mask, min_area)
+            result['reference_seconds'] = round(time.perf_counter() - start, 3)
+            result['matches_reference'] = bool(np.array_equal(cleaned, expected))
+        results.append(result)
+        print(result)
+    return results
+
+def cleanup_check_masks(seeds):
+    # Edge cases first, then random blocky masks of varied shapes, block sizes and noise
+    yield 'empty', np.zeros((0, 0), dtype=np.uint8)
+    yield 'no_columns', np.zeros((5, 0), dtype=np.uint8)
+    yield 'no_rows', np.zeros((0, 5), dtype=np.uint8)
+    yield 'single_pixel', np.array([[3]], dtype=np.uint8)
+    for class_id in range(6):
+        yield f'all_class_{class_id}', np.full((17, 23), class_id, dtype=np.uint8)
+    checkerboard = (np.indices((16, 16)).sum(axis=0) % 2).astype(np.uint8)
+    yield 'diagonal_contacts', checkerboard
+    yield 'diagonal_contacts_unlabeled', checkerboard * 5
+    staircase = np.zeros((12, 12), dtype=np.uint8)
+    staircase[np.arange(12), np.arange(12)] = 2
+    yield 'diagonal_line', staircase
+    for seed in seeds:
+        rng = np.random.default_rng(seed)
+        h, w = (int(n) for n in rng.integers(1, 80, 2))
+        block = int(rng.integers(1, 12))
+        mask = make_label_mask(max(h, w), block=block, seed=seed)[:h, :w].copy()
+        noise = rng.random((h, w)) < rng.choice([0.0, 0.05, 0.3])
+        mask[noise] = rng.integers(0, 6, int(noise.sum()), dtype=np.uint8)
+        yield f'random_{seed}_{h}x{w}_block{block}', mask
+        yield f'row_{seed}', mask[:1]
+        yield f'column_{seed}', mask[:, :1]
+
+def check_cleanup(seeds=range(200), min_areas=(0, 1, 2, 5, 20, 100), band_heights=(1, 2, 3, 7, 64)):
+    # clean_segmentation against the DFS reference, and clean_segmentation_bands against
+    # clean_segmentation for band heights that do and don't divide the mask height. Returns the
+    # number of comparisons and every mismatch.
+    from segmentFunction import clean_segmentation, clean_segmentation_bands, clean_segmentation_reference
+
+    comparisons, mismatches = 0, []
+    for name, mask in cleanup_check_masks(seeds):
+        for min_area in min_areas:
+            cleaned = clean_segmentation(mask, min_area)
+            comparisons += 1
+            if not np.array_equal(cleaned, clean_segmentation_reference(mask, min_area)):
+                mismatches.append({'mask': name, 'min_area': min_area, 'labeller': 'clean_segmentation'})
+            for rows_per_band in band_heights + (max(1, mask.shape[0]),):
+                bands = list(clean_segmentation_bands(mask, min_area, rows_per_band))
+                banded = np.concatenate(bands) if bands else np.zeros_like(mask)
+                comparisons += 1
+                if banded.shape != cleaned.shape or not np.array_equal(banded, cleaned):
+                    mismatches.append({'mask': name, 'min_area': min_area, 'labeller': 'clean_segmentation_bands',
+                                       'rows_per_band': rows_per_band})
+    result = {'comparisons': comparisons, 'mismatches': mismatches}
+    print({'comparisons': comparisons, 'mismatches': len(mismatches)})
+    return result
+
+# Synthetic rasters centred on an area each projection covers (origin x, origin y)
+REPROJECT_TEST_CRS = {
+    'EPSG:32630': (400000, 5800000),
+    'EPSG:27700': (400000, 300000),
+    'EPSG:3857': (-150000, 6700000),
+}
+
+def make_synthetic_tiff(memfile, crs, origin, size, bands=3, pixel_size=1.0, seed=0):
+    import rasterio
+    from rasterio.transform import from_origin
+
+    rng = np.random.default_rng(seed)
+    data = rng.integers(0, 256, (bands, size, size), dtype=np.uint8)
+    with rasterio.open(memfile.name, 'w', driver='GTiff', width=size, height=size, count=bands, dtype='uint8',
+                       crs=crs, transform=from_origin(origin[0], origin[1], pixel_size, pixel_size)) as dst:
+        dst.write(data)
+
+def convert_tiff_to_png_per_band(tiff_path, png_path):
+    # The original conversion: one single-threaded warp per band
+    import rasterio
+    from rasterio.warp import calculate_default_transform, reproject, Resampling
+
+    with rasterio.open(tiff_path) as src:
+        transform, width, height = calculate_default_transform(src.crs, 'EPSG:4326', src.width, src.height, *src.bounds)
+        kwargs = src.meta.copy()
+        kwargs.update({'crs': 'EPSG:4326', 'transform': transform, 'width': width, 'height': height,
+                       'driver': 'PNG', 'compress': 'DEFLATE', 'zlevel': 9})
+        with rasterio.open(png_path, 'w', **kwargs) as dst:
+            for i in range(1, src.count + 1):
+                reproject(source=rasterio.band(src, i), destination=rasterio.band(dst, i),
+                          src_transform=src.transform, src_crs=src.crs, dst_transform=transform,
+                          dst_crs='EPSG:4326', resampling=Resampling.nearest)
+
+def benchmark_reproject(sizes=(2048, 4096), crs_list=tuple(REPROJECT_TEST_CRS), chunk_workers=(2, 4)):
+    import rasterio
+    from rasterio.io import MemoryFile
+    from ec2 import convert_tiff_to_png
+
+    modes = [('per_band', lambda src, dst: convert_tiff_to_png_per_band(src, dst)),
+             ('single_call', lambda src, dst: convert_tiff_to_png(src, dst, chunk_workers=0, use_grid_cache=False))]
+    modes += [(f'chunked_{workers}', lambda src, dst, workers=workers: convert_tiff_to_png(src, dst, chunk_workers=workers))
+              for workers in chunk_workers]
+    # The first grid-cache call builds the mapping, the second reuses it
+    modes += [(f'grid_cache_{phase}', lambda src, dst: convert_tiff_to_png(src, dst, chunk_workers=0, use_grid_cache=True))
+              for phase in ('miss', 'hit')]
+
+    results = []
+    for size in sizes:
+        for crs in crs_list:
+            with MemoryFile(ext='.tif') as tiff_memfile:
+                make_synthetic_tiff(tiff_memfile, crs, REPROJECT_TEST_CRS[crs], size)
+                reference = None
+                for mode, convert in modes:
+                    with MemoryFile(ext='.png') as png_memfile:
+                        start = time.perf_counter()
+                        convert(tiff_memfile.name, png_memfile.name)
+                        elapsed = time.perf_counter() - start
+                        with rasterio.open(png_memfile.name) as dst:
+                            output = dst.read()
+                    if reference is None:
+                        reference = output
+                    results.append({
+                        'size': size,
+                        'crs': crs,
+                        'mode': mode,
+                        'seconds': round(elapsed, 3),
+                        'megapixels_per_sec': round(size * size / elapsed / 1e6, 2),
+                        # Nearest-neighbour warps should agree with the per-band path pixel for pixel
+                        'matching_pixels': round(float(np.mean(output == reference)), 6)
+                    })
+    return results
+
+def benchmark_vectorize(sizes=(1024, 4096), tolerances=(0.0, 1.0, 2.0), formats=('fgb', 'geojsonl'), min_area=100):
+    import io
+    from rasterio.transform import from_bounds
+    from segmentFunction import CLASS_INFO, UNLABELED_CLASS, clean_segmentation, encode_paletted_png
+    from vectorize import polygonize_labels, write_vectors
+
+    class_names = {class_id: name for class_id, (name, _) in CLASS_INFO.items()}
+    results = []
+    for size in sizes:
+        # Cleaned masks, as the Lambda vectorizes them, over a ~1 km box
+        labels = clean_segmentation(make_label_mask(size, block=32), min_area)
+        transform = from_bounds(-0.13, 51.50, -0.12, 51.51, size, size)
+        png_bytes = len(encode_paletted_png(labels))
+        for tolerance in tolerances:
+            for vector_format in formats:
+                buffer = io.BytesIO()
+                start = time.perf_counter()
+                count = write_vectors(polygonize_labels(labels, transform, tolerance, (UNLABELED_CLASS,)), buffer,
+                                      vector_format, class_names)
+                elapsed = time.perf_counter() - start
+                results.append({
+                    'size': size,
+                    'tolerance': tolerance,
+                    'format': vector_format,
+                    'polygons': count,
+                    'seconds': round(elapsed, 3),
+                    'polygons_per_sec': round(count / elapsed, 1),
+                    'bytes': len(buffer.getvalue()),
+                    'png_bytes': png_bytes
+                })
+                print(results[-1])
+    return results
+
+def convert_png_to_tif_rgba(png_content, path, transform):
+    # The former export: RGBA conversion and four striped LZW bands
+    import io
+    import rasterio
+    from PIL import Image
+
+    with Image.open(io.BytesIO(png_content)) as img:
+        img = img.convert('RGBA')
+        meta = {'driver': 'GTiff', 'dtype': 'uint8', 'count': 4, 'height': img.height, 'width': img.width,
+                'crs': 'EPSG:4326', 'transform': transform, 'compress': 'LZW'}
+        with rasterio.open(path, 'w', **meta) as dst:
+            for i, band in enumerate(img.split(), start=1):
+                dst.write(np.array(band), i)
+
+def benchmark_export(sizes=(2048, 8192), codecs=('LZW', 'DEFLATE', 'ZSTD'), min_area=100):
+    from rasterio.io import MemoryFile
+    from rasterio.transform import from_bounds
+    from segmentFunction import clean_segmentation, encode_paletted_png
+    from tiff_export import read_png_labels, write_label_cog
+
+    results = []
+    for size in sizes:
+        png_content = encode_paletted_png(clean_segmentation(make_label_mask(size, block=32), min_area))
+        transform = from_bounds(-0.13, 51.50, -0.12, 51.51, size, size)
+        runs = [('rgba_striped_lzw', lambda path: convert_png_to_tif_rgba(png_content, path, transform))]
+        for codec in codecs:
+            for predictor in (False, True):
+                runs.append((f"cog_{codec.lower()}{'_predictor' if predictor else ''}",
+                             lambda path, codec=codec, predictor=predictor: write_label_cog(
+                                 path, *read_png_labels(png_content), transform, codec=codec, predictor=predictor)))
+        for mode, run in runs:
+            with MemoryFile(ext='.tif') as memfile:
+                start = time.perf_counter()
+                run(memfile.name)
+                elapsed = time.perf_counter() - start
+                size_bytes = len(memfile.read())
+            results.append({'size': size, 'mode': mode, 'seconds': round(elapsed, 3), 'bytes': size_bytes})
+            print(results[-1])
+    return results
+
+class StubInterpreter:
+    # Stands in for tflite.Interpreter in the pipeline benchmark: a fixed random per-pixel
+    # projection from RGB to class logits, so segmentation runs without the model and the
+    # measured time is the pipeline's own
+    weights = np.random.default_rng(0).standard_normal((3, 6)).astype(np.float32)
+
+    def __init__(self, model_content=None, model_path=None, num_threads=None):
+        self.shape = [1, 256, 256, 3]
+
+    def get_input_details(self):
+        return [{'index': 0, 'shape': np.array(self.shape), 'dtype': np.float32, 'quantization': (0.0, 0)}]
+
+    def get_output_details(self):
+        return [{'index': 1, 'shape': np.array(self.shape[:3] + [self.weights.shape[1]]), 'dtype': np.float32,
+                 'quantization': (0.0, 0)}]
+
+    def resize_tensor_input(self, index, shape):
+        self.shape = list(shape)
+
+    def allocate_tensors(self):
+        self.input = np.zeros(self.shape, dtype=np.float32)
+
+    def tensor(self, index):
+        return lambda: self.input
+
+    def set_tensor(self, index, value):
+        self.input[...] = value
+
+    def invoke(self):
+        self.output = self.input @ self.weights
+
+    def get_tensor(self, index):
+        return self.output.copy()
+
+def use_stub_interpreter():
+    # segmentFunction imports tflite_runtime at module level, so a stand-in module is registered
+    # when it is not installed; either way its Interpreter is swapped for the stub
+    import sys
+    import types
+    try:
+        import tflite_runtime.interpreter  # noqa: F401
+    except ImportError:
+        package = types.ModuleType('tflite_runtime')
+        package.interpreter = types.ModuleType('tflite_runtime.interpreter')
+        sys.modules.update({'tflite_runtime': package, 'tflite_runtime.interpreter': package.interpreter})
+    import segmentFunction
+    segmentFunction.tflite.Interpreter = StubInterpreter
+    return segmentFunction
+
+def read_rss():
+    # Current resident set size in bytes; /proc is Linux-only, elsewhere the peak so far
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+class PeakRSS:
+    # Samples the RSS while a stage runs; getrusage only reports the peak of the whole process
+    def __init__(self, interval=0.005):
+        self.interval = interval
+
+    def __enter__(self):
+        self.baseline = self.peak = read_rss()
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def _sample(self):
+        while not self.stop.wait(self.interval):
+            self.peak = max(self.peak, read_rss())
+
+    def __exit__(self, *exc_info):
+        self.stop.set()
+        self.thread.join()
+        self.peak = max(self.peak, read_rss())
+
+def measure_stage(run, repeats, megapixels):
+    # Median wall time over the repeats, peak RSS over all of them and the stage timings of the
+    # last repeat, then one more run under tracemalloc for the stage's own peak allocation.
+    # The process RSS is mostly earlier stages, moto and imports, and sampling it misses
+    # short-lived arrays; the traced peak covers every Python and numpy allocation of the stage
+    # alone (GDAL's internal buffers are not traced). Output of the pipeline code goes to
+    # /dev/null to keep the JSON readable.
+    seconds = []
+    stage_timings = {}
+    with PeakRSS() as rss, open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for _ in range(repeats):
+            stage_timings = {}
+            start = time.perf_counter()
+            run(stage_timings)
+            seconds.append(time.perf_counter() - start)
+        tracemalloc.start()
+        try:
+            run({})
+            peak_alloc = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    median = float(np.median(seconds))
+    return {
+        'seconds': round(median, 4),
+        'min_seconds': round(min(seconds), 4),
+        'megapixels_per_sec': round(megapixels / median, 2),
+        'peak_alloc_mb': round(peak_alloc / 2 ** 20, 1),
+        'peak_rss_mb': round(rss.peak / 2 ** 20, 1),
+        'rss_growth_mb': round((rss.peak - rss.baseline) / 2 ** 20, 1),
+        'stage_timings': stage_timings
+    }
+
+def get_commit():
+    # Commit of the benchmarked tree, marked -dirty when tracked files have local changes
+    repo = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=repo, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=repo, capture_output=True,
+                               text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ('-dirty' if dirty else '')
+
+def benchmark_pipeline(sizes=(1024, 2048), bands=3, crs='EPSG:32630', class_weights=None, repeats=3, min_area=100):
+    # End-to-end stages against a moto S3 bucket and the stub interpreter: processing (TIFF to
+    # PNG), segmentation, export (PNG to GeoTIFF) and the in-memory steps of the segmentation on
+    # synthetic masks. convert_tiff_with_default_compression runs on a local file, as GDAL's
+    # /vsis3/ cannot reach an in-process S3 stand-in, and needs osgeo (app.py).
+    import tempfile
+    import boto3
+    from moto import mock_aws
+    from rasterio.io import MemoryFile
+
+    with mock_aws(), tempfile.TemporaryDirectory() as tmp_dir:
+        s3 = boto3.client('s3', region_name='eu-west-2')
+        segmentFunction = use_stub_interpreter()
+        import ec2
+        try:
+            import app
+        except ImportError as e:
+            app, app_error = None, str(e)
+        s3.create_bucket(Bucket=ec2.S3_BUCKET, CreateBucketConfiguration={'LocationConstraint': 'eu-west-2'})
+        s3.put_object(Bucket=segmentFunction.MODEL_BUCKET, Key=segmentFunction.get_model_key(), Body=b'stub model')
+        ph, pw = StubInterpreter().shape[1:3]
+
+        results = []
+        for size in sizes:
+            case = {'size': size, 'bands': bands, 'crs': crs}
+            megapixels = size * size / 1e6
+            name = f'bench_{size}_{bands}'
+            tiff_key = f'tiff-uploads/{name}.tif'
+            with MemoryFile(ext='.tif') as tiff_memfile:
+                make_synthetic_tiff(tiff_memfile, crs, REPROJECT_TEST_CRS[crs], size, bands)
+                tiff_content = tiff_memfile.read()
+            s3.put_object(Bucket=ec2.S3_BUCKET, Key=tiff_key, Body=tiff_content)
+
+            def segment(timings):
+                # Products are always recomputed: no dedup copies and no stored tiles
+                event = {'bucket': ec2.S3_BUCKET, 'key': tiff_key, 'output_bucket': ec2.S3_BUCKET,
+                         'output_key': 'segment-upload/', 'dedup': False, 'tile_store': False, 'min_area': min_area}
+                response = segmentFunction.lambda_handler(event, None)
+                if response['statusCode'] != 200:
+                    raise RuntimeError(response['body'])
+
+            stages = [
+                ('convert_tiff_to_png', lambda timings: ec2.run_process_image(tiff_key, timings, dedup=False)),
+                ('segmentation', segment),
+                ('convert_png_to_tif', lambda timings: ec2.run_convert_png_to_tif(
+                    f'segment-upload/{name}_classified.png', timings, dedup=False))
+            ]
+
+            if app is not None:
+                input_path = os.path.join(tmp_dir, f'{name}.tif')
+                with open(input_path, 'wb') as f:
+                    f.write(tiff_content)
+                stages.insert(1, ('convert_tiff_with_default_compression',
+                                  lambda timings: app.convert_tiff_with_default_compression(
+                                      input_path, os.path.join(tmp_dir, 'output.tif'), app.extract_tiff_properties(input_path))))
+
+            # In-memory steps on a synthetic mask with the requested class mix
+            mask = make_label_mask(size, block=32, class_weights=class_weights)
+            padded = np.pad(mask, ((0, -size % ph), (0, -size % pw)))
+            patches = [padded[i:i + ph, j:j + pw] for i in range(0, padded.shape[0], ph) for j in range(0, padded.shape[1], pw)]
+            stages += [
+                ('stitch_patches', lambda timings: segmentFunction.stitch_patches(
+                    patches, padded.shape + (3,), mask.shape, (ph, pw))),
+                ('clean_segmentation', lambda timings: segmentFunction.clean_segmentation(mask, min_area)),
+                ('colorize_segmentation', lambda timings: segmentFunction.colorize_segmentation(mask))
+            ]
+
+            # The model takes RGB, and the export converts the segmentation's PNG
+            skipped = {'segmentation': 'segmentation needs an RGB image',
+                       'convert_png_to_tif': 'no segmentation output to export'} if bands < 3 else {}
+            for stage, run in stages:
+                if stage in skipped:
+                    results.append(dict(case, stage=stage, skipped=skipped[stage]))
+                else:
+                    results.append(dict(case, stage=stage, **measure_stage(run, repeats, megapixels)))
+                print(results[-1])
+            if app is None:
+                results.append(dict(case, stage='convert_tiff_with_default_compression', skipped=app_error))
+
+    return {
+        'commit': get_commit(),
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'cpu_count': os.cpu_count(),
+        'params': {'sizes': list(sizes), 'bands': bands, 'crs': crs, 'class_weights': class_weights,
+                   'repeats': repeats, 'min_area': min_area},
+        'results': results
+    }
+
+PIPELINE_CASE_FIELDS = ('stage', 'size', 'bands', 'crs')
+PIPELINE_REGRESSION_METRICS = ('seconds', 'peak_alloc_mb')
+
+def compare_pipeline(baseline, current, threshold=0.1, min_seconds=0.01, min_alloc_mb=1.0):
+    # Cases present in both runs whose time or own peak allocation grew by more than threshold
+    # (a fraction). Stages below min_seconds or min_alloc_mb in both runs are left out of that
+    # comparison as noise, as are metrics a run lacks (results from before peak_alloc_mb).
+    noise_floor = {'seconds': min_seconds, 'peak_alloc_mb': min_alloc_mb}
+    def cases(run):
+        return {tuple(result.get(field) for field in PIPELINE_CASE_FIELDS): result
+                for result in run['results'] if 'skipped' not in result}
+
+    baseline_cases = cases(baseline)
+    regressions = []
+    for key, result in cases(current).items():
+        before = baseline_cases.get(key)
+        if before is None:
+            continue
+        for metric in PIPELINE_REGRESSION_METRICS:
+            if metric not in before or metric not in result:
+                continue
+            if max(before[metric], result[metric]) < noise_floor[metric]:
+                continue
+            if before[metric] and result[metric] > before[metric] * (1 + threshold):
+                regressions.append(dict(zip(PIPELINE_CASE_FIELDS, key), metric=metric, baseline=before[metric],
+                                        current=result[metric], change=round(result[metric] / before[metric] - 1, 3)))
+    return {'baseline_commit': baseline.get('commit'), 'current_commit': current.get('commit'),
+            'threshold': threshold, 'regressions': regressions}
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for the GIS Playground processing pipelines')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    inference_parser = subparsers.add_parser('inference', help='Patches/sec for batch and thread settings')
+    inference_parser.add_argument('model_path')
+    inference_parser.add_argument('--image-size', type=int, default=2048)
+    inference_parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 4, 8, 16])
+    inference_parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4])
+    inference_parser.add_argument('--interpreters', type=int, default=1)
+
+    cleanup_parser = subparsers.add_parser('cleanup', help='clean_segmentation speed and equivalence with the DFS reference')
+    cleanup_parser.add_argument('--sizes', type=int, nargs='+', default=[256, 512, 1024, 4096])
+    cleanup_parser.add_argument('--min-area', type=int, default=100)
+    cleanup_parser.add_argument('--check', action='store_true',
+                                help='Compare the labellers with the DFS reference over many masks instead; exits 1 on any mismatch')
+    cleanup_parser.add_argument('--seeds', type=int, default=200, help='Random masks for --check')
+
+    sliding_parser = subparsers.add_parser('sliding', help='Throughput/quality trade-off of sliding-window strides')
+    sliding_parser.add_argument('model_path')
+    sliding_parser.add_argument('--image', default=None, help='Optional RGB image instead of random input')
+    sliding_parser.add_argument('--image-size', type=int, default=2048)
+    sliding_parser.add_argument('--strides', type=int, nargs='+', default=[256, 192, 128])
+    sliding_parser.add_argument('--batch-size', type=int, default=8)
+
+    quantization_parser = subparsers.add_parser('quantization', help='Accuracy/throughput of quantized variants vs the float model')
+    quantization_parser.add_argument('model_path', help='Float32 reference model')
+    quantization_parser.add_argument('--variant', action='append', default=[], metavar='NAME=PATH',
+                                     help='Reduced-precision model, e.g. int8=model_int8.tflite')
+    quantization_parser.add_argument('--image', default=None, help='Optional RGB image to draw the fixed tiles from')
+    quantization_parser.add_argument('--tiles', type=int, default=64)
+    quantization_parser.add_argument('--batch-size', type=int, default=8)
+
+    reproject_parser = subparsers.add_parser('reproject', help='convert_tiff_to_png per-band vs single-call vs chunked warps vs cached grids')
+    reproject_parser.add_argument('--sizes', type=int, nargs='+', default=[2048, 4096])
+    reproject_parser.add_argument('--crs', nargs='+', default=list(REPROJECT_TEST_CRS), choices=list(REPROJECT_TEST_CRS))
+    reproject_parser.add_argument('--chunk-workers', type=int, nargs='+', default=[2, 4])
+
+    vectorize_parser = subparsers.add_parser('vectorize', help='Polygons/sec and output size of FlatGeobuf vs GeoJSONSeq')
+    vectorize_parser.add_argument('--sizes', type=int, nargs='+', default=[1024, 4096])
+    vectorize_parser.add_argument('--tolerances', type=float, nargs='+', default=[0.0, 1.0, 2.0])
+    vectorize_parser.add_argument('--formats', nargs='+', default=['fgb', 'geojsonl'], choices=['fgb', 'geojsonl'])
+
+    export_parser = subparsers.add_parser('export', help='GeoTIFF export size and encode time per codec vs the RGBA export')
+    export_parser.add_argument('--sizes', type=int, nargs='+', default=[2048, 8192])
+    export_parser.add_argument('--codecs', nargs='+', default=['LZW', 'DEFLATE', 'ZSTD'], choices=['LZW', 'DEFLATE', 'ZSTD'])
+
+    pipeline_parser = subparsers.add_parser('pipeline', help='Wall time, peak memory and throughput of each pipeline stage on synthetic inputs')
+    pipeline_parser.add_argument('--sizes', type=int, nargs='+', default=[1024, 2048])
+    pipeline_parser.add_argument('--bands', type=int, default=3, choices=[1, 2, 3, 4])
+    pipeline_parser.add_argument('--crs', default='EPSG:32630', choices=list(REPROJECT_TEST_CRS))
+    pipeline_parser.add_argument('--class-weights', type=float, nargs='+', default=None,
+                                 help='Share of each class in the synthetic masks, e.g. 5 1 1 1 1 1')
+    pipeline_parser.add_argument('--repeats', type=int, default=3)
+    pipeline_parser.add_argument('--output', default=None, help='Also write the results to this JSON file')
+    pipeline_parser.add_argument('--baseline', default=None, help='Results of an earlier commit to flag regressions against')
+    pipeline_parser.add_argument('--threshold', type=float, default=0.1, help='Allowed growth before a regression is flagged')
+
+    compare_parser = subparsers.add_parser('compare', help='Flag regressions between two pipeline result files')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--threshold', type=float, default=0.1)
+
+    args = parser.parse_args()
+    if args.command == 'inference':
+        results = benchmark_inference(args.model_path, args.image_size, args.batch_sizes, args.threads, args.interpreters)
+    elif args.command == 'cleanup':
+        results = check_cleanup(range(args.seeds)) if args.check else benchmark_cleanup(args.sizes, args.min_area)
+    elif args.command == 'sliding':
+        results = benchmark_sliding_window(args.model_path, args.image, args.image_size, args.strides, args.batch_size)
+    elif args.command == 'quantization':
+        variants = dict(variant.split('=', 1) for variant in args.variant)
+        results = benchmark_quantization(args.model_path, variants, args.image, args.tiles, args.batch_size)
+    elif args.command == 'reproject':
+        results = benchmark_reproject(args.sizes, args.crs, args.chunk_workers)
+    elif args.command == 'vectorize':
+        results = benchmark_vectorize(args.sizes, args.tolerances, args.formats)
+    elif args.command == 'export':
+        results = benchmark_export(args.sizes, args.codecs)
+    elif args.command == 'pipeline':
+        results = benchmark_pipeline(args.sizes, args.bands, args.crs, args.class_weights, args.repeats)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2)
+        if args.baseline:
+            with open(args.baseline) as f:
+                results['comparison'] = compare_pipeline(json.load(f), results, args.threshold)
+    elif args.command == 'compare':
+        with open(args.baseline) as f, open(args.current) as g:
+            results = compare_pipeline(json.load(f), json.load(g), args.threshold)
+    print(json.dumps(results, indent=2))
+    # A non-zero exit lets CI fail on regressions and on cleanup mismatches
+    comparison = results.get('comparison', results) if isinstance(results, dict) else {}
+    if comparison.get('regressions') or comparison.get('mismatches'):
+        raise SystemExit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+import json
+import os
+import threading
+import time
+import urllib.request
+from collections import deque
+
+# Completion notifications. The segmentation Lambda and the processing server report each
+# finished output to the web app, which hands it to waiting clients instead of letting them poll
+# S3. CompletionBus is an in-process stand-in for the notification bus (SNS/Redis pub/sub in
+# production): events live in memory on the web server, so publisher and subscribers must reach
+# the same process.
+
+COMPLETION_NOTIFY_URL = os.environ.get('COMPLETION_NOTIFY_URL', '')
+COMPLETION_NOTIFY_TOKEN = os.environ.get('COMPLETION_NOTIFY_TOKEN', '')
+COMPLETION_NOTIFY_TIMEOUT = 5
+COMPLETION_HISTORY = int(os.environ.get('COMPLETION_HISTORY', '1000'))
+COMPLETION_RETENTION_SECONDS = int(os.environ.get('COMPLETION_RETENTION_SECONDS', '3600'))
+
+class CompletionBus:
+    def __init__(self, history=COMPLETION_HISTORY, retention_seconds=COMPLETION_RETENTION_SECONDS):
+        self.retention_seconds = retention_seconds
+        self.events = deque(maxlen=history)
+        self.last_id = 0
+        self.condition = threading.Condition()
+
+    def publish(self, event):
+        with self.condition:
+            self.last_id += 1
+            event = dict(event, id=self.last_id, published_at=time.time())
+            self.events.append(event)
+            self._prune()
+            self.condition.notify_all()
+        return event
+
+    def _prune(self):
+        cutoff = time.time() - self.retention_seconds
+        while self.events and self.events[0]['published_at'] < cutoff:
+            self.events.popleft()
+
+    def _matching(self, object_names, after_id):
+        return [event for event in self.events if event['id'] > after_id
+                and (not object_names or event['object_name'] in object_names)]
+
+    def wait(self, object_names=None, after_id=0, timeout=25):
+        # Events newer than after_id for the given objects (all objects when None). Events that
+        # arrived before the client subscribed are returned at once; otherwise blocks until one
+        # arrives or the timeout passes, then returns an empty list.
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while True:
+                events = self._matching(object_names, after_id)
+                remaining = deadline - time.monotonic()
+                if events or remaining <= 0:
+                    return events
+                self.condition.wait(remaining)
+
+def completion_event(stage, object_name, status='succeeded', **details):
+    # stage is 'segmentation' or 'processing'; object_name is the output key clients wait for
+    return dict(details, stage=stage, object_name=object_name, status=status)
+
+def notify_completion(*events, url=COMPLETION_NOTIFY_URL, token=COMPLETION_NOTIFY_TOKEN):
+    # Best effort: a lost notification only means the client falls back to polling, so
+    # failures are logged and never fail the job that reports them
+    if not url or not events:
+        return False
+    request = urllib.request.Request(url, data=json.dumps({'events': list(events)}).encode('utf-8'),
+                                     headers={'Content-Type': 'application/json', 'X-Completion-Token': token},
+                                     method='POST')
+    try:
+        with urllib.request.urlopen(request, timeout=COMPLETION_NOTIFY_TIMEOUT) as response:
+            return response.status == 200
+    except Exception as e:
+        print(f"Completion notification to {url} failed: {e}")
+        return False
@@ -1,30 +1,93 @@
 from flask import Flask, request, jsonify
-import boto3
 import os
 import rasterio
 from rasterio.warp import calculate_default_transform, reproject, Resampling, transform_bounds
 from rasterio.transform import from_bounds
+from rasterio.windows import Window
 import traceback
 import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import math
+import io
 from PIL import Image
 import uuid
 import numpy as np
+from rasterio.io import MemoryFile
+from jobs import JobQueue, QueueFullError, timed
+from raster_io import read_s3_object, open_s3_memfile, upload_fileobj
+from s3_transfer import make_s3_client, run_concurrently, s3_latency
+from product_index import PRODUCT_DEDUP, get_combined_digest, get_source_digest, lookup_products, record_products, restore_products
+from completion import completion_event, notify_completion
+from reprojection import REPROJECT_GRID_CACHE, reproject_with_cached_grid
+from tiff_export import (EXPORT_CODEC, EXPORT_CODECS, EXPORT_PREDICTOR, export_file_name, export_product, parse_predictor,
+                         read_png_labels, write_label_cog)
 
 app = Flask(__name__)
 
 S3_BUCKET = "dutta007bucket"
 AWS_REGION = "eu-west-2"
-s3_client = boto3.client('s3', region_name=AWS_REGION)
+s3_client = make_s3_client(AWS_REGION)
+
+# Background job settings; GDAL work runs in worker processes
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', str(os.cpu_count() or 1)))
+JOB_QUEUE_LIMIT = int(os.environ.get('JOB_QUEUE_LIMIT', '32'))
+JOB_RETRY_AFTER_SECONDS = 5
+
+# Reprojection settings; REPROJECT_CHUNK_WORKERS > 1 splits a GDAL warp across processes.
+# The cached reprojection grids (REPROJECT_GRID_CACHE=1) are opt-in and bypass the GDAL warp.
+REPROJECT_NUM_THREADS = int(os.environ.get('REPROJECT_NUM_THREADS', str(os.cpu_count() or 1)))
+REPROJECT_WARP_MEM_MB = int(os.environ.get('REPROJECT_WARP_MEM_MB', '512'))
+REPROJECT_CHUNK_WORKERS = int(os.environ.get('REPROJECT_CHUNK_WORKERS', '0'))
+
+def init_job_worker():
+    # Forked workers must not share the parent's S3 connection pool
+    global s3_client
+    s3_client = make_s3_client(AWS_REGION)
+
+job_queue = JobQueue(JOB_WORKERS, JOB_QUEUE_LIMIT, initializer=init_job_worker)
+
+def reproject_chunk(tiff_path, dst_transform, window):
+    # Runs in a worker process: warps one block of destination rows
+    with rasterio.open(tiff_path) as src:
+        destination = np.zeros((src.count, window.height, window.width), dtype=src.dtypes[0])
+        reproject(
+            source=rasterio.band(src, list(range(1, src.count + 1))),
+            destination=destination,
+            src_transform=src.transform,
+            src_crs=src.crs,
+            src_nodata=src.nodata,
+            dst_transform=rasterio.windows.transform(window, dst_transform),
+            dst_crs='EPSG:4326',
+            dst_nodata=src.nodata,
+            resampling=Resampling.nearest,
+            warp_mem_limit=REPROJECT_WARP_MEM_MB
+        )
+    return window, destination
+
+def reproject_chunked(tiff_path, dst, dst_transform, workers):
+    # Splits the output into row blocks (a few per worker) that a process pool warps in
+    # parallel. Workers are forked so they can read /vsimem inputs from the parent.
+    rows_per_chunk = max(1, math.ceil(dst.height / (workers * 4)))
+    windows = [Window(0, row_off, dst.width, min(rows_per_chunk, dst.height - row_off))
+               for row_off in range(0, dst.height, rows_per_chunk)]
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork')) as executor:
+        for window, data in executor.map(reproject_chunk, [tiff_path] * len(windows),
+                                         [dst_transform] * len(windows), windows):
+            dst.write(data, window=window)
+
+def convert_tiff_to_png(tiff_path, png_path, chunk_workers=REPROJECT_CHUNK_WORKERS,
+                        use_grid_cache=REPROJECT_GRID_CACHE, cache_info=None):
+    with rasterio.open(tiff_path) as src:
+        if use_grid_cache and chunk_workers <= 1:
+            # Repeated CRS/grid pairs reuse a cached coordinate mapping and go straight to resampling
+            bounds_dict, info = reproject_with_cached_grid(src, png_path, 'EPSG:4326', dict(
+                src.meta, driver='PNG', compress='DEFLATE', zlevel=9))
+            if cache_info is not None:
+                cache_info.update(info)
+            return bounds_dict
 
-def download_file(s3_client, bucket, s3_key, local_path):
-    s3_client.download_file(bucket, s3_key, local_path)
-
-def upload_file(s3_client, local_path, bucket, s3_key, content_type=None):
-    extra_args = {'ContentType': content_type} if content_type else {}
-    s3_client.upload_file(local_path, bucket, s3_key, ExtraArgs=extra_args)
-
-def convert_tiff_to_png(local_tiff_path, local_png_path):
-    with rasterio.open(local_tiff_path) as src:
         bounds = transform_bounds(src.crs, 'EPSG:4326', *src.bounds)
         bounds_dict = {'left': bounds[0], 'bottom': bounds[1], 'right': bounds[2], 'top': bounds[3]}
         transform, width, height = calculate_default_transform(src.crs, 'EPSG:4326', src.width, src.height, *src.bounds)
@@ -38,88 +101,111 @@ def convert_tiff_to_png(local_tiff_path, local_png_path):
             'compress': 'DEFLATE',  # Use DEFLATE compression
             'zlevel': 9  # Maximum compression level
         })
-        with rasterio.open(local_png_path, 'w', **kwargs) as dst:
-            for i in range(1, src.count + 1):
+        with rasterio.open(png_path, 'w', **kwargs) as dst:
+            if chunk_workers > 1:
+                reproject_chunked(tiff_path, dst, transform, chunk_workers)
+            else:
+                # All bands in one multithreaded warp
+                bands = list(range(1, src.count + 1))
                 reproject(
-                    source=rasterio.band(src, i),
-                    destination=rasterio.band(dst, i),
+                    source=rasterio.band(src, bands),
+                    destination=rasterio.band(dst, bands),
                     src_transform=src.transform,
                     src_crs=src.crs,
                     dst_transform=transform,
                     dst_crs='EPSG:4326',
-                    resampling=Resampling.nearest
+                    resampling=Resampling.nearest,
+                    num_threads=REPROJECT_NUM_THREADS,
+                    warp_mem_limit=REPROJECT_WARP_MEM_MB
                 )
     return bounds_dict
 
-
-
-
-def verify_png(local_png_path):
+def verify_png(png_file):
     try:
-        with Image.open(local_png_path) as img:
+        with Image.open(png_file) as img:
             img.verify()
         print("PNG file is valid")
     except Exception as e:
         print(f"PNG file is invalid: {str(e)}")
         raise
 
-def clean_up(files):
-    for file in files:
-        try:
-            os.remove(file)
-        except Exception as e:
-            print(f"Error removing file {file}: {str(e)}")
-
-
-@app.route('/process-image', methods=['POST'])
-def process_image():
-    data = request.json
-    s3_key = data.get('s3_key')  # The S3 key includes the UUID
-    if not s3_key:
-        return jsonify({'error': 'Missing s3_key in request'}), 400
-
+def run_process_image_and_notify(s3_key, timings, dedup=PRODUCT_DEDUP):
+    # Reports the outcome to clients waiting on the PNG key instead of polling for it
+    png_s3_key = f"png-export/{os.path.basename(s3_key).rsplit('.', 1)[0]}.png"
     try:
-        file_name = os.path.basename(s3_key)
-
-        # No need to extract the UUID again; use the existing base name
-        base_file_name = file_name.rsplit('.', 1)[0]  # This includes the UUID
-
-        local_tiff_path = f'/tmp/{file_name}'
-        png_filename = f"{base_file_name}.png"  # No need to append the UUID again
-        local_png_path = f'/tmp/{png_filename}'
-
-        # Ensure the /tmp directory is used correctly without subdirectories
-        if not os.path.exists('/tmp'):
-            os.makedirs('/tmp')
-
-        # Download the TIFF file from S3
-        download_file(s3_client, S3_BUCKET, s3_key, local_tiff_path)
-
+        result = run_process_image(s3_key, timings, dedup)
+    except Exception as e:
+        notify_completion(completion_event('processing', png_s3_key, 'failed', error=str(e)))
+        raise
+    notify_completion(completion_event('processing', png_s3_key, deduplicated=result.get('deduplicated', False)))
+    return result
+
+def run_process_image(s3_key, timings, dedup=PRODUCT_DEDUP):
+    file_name = os.path.basename(s3_key)
+
+    # No need to extract the UUID again; use the existing base name
+    base_file_name = file_name.rsplit('.', 1)[0]  # This includes the UUID
+    png_filename = f"{base_file_name}.png"  # No need to append the UUID again
+    png_s3_key = f'png-export/{png_filename}'
+    bounds_key = f'png-export/{base_file_name}_bounds.json'
+    png_url = f"https://{S3_BUCKET}.s3.{AWS_REGION}.amazonaws.com/{png_s3_key}"
+
+    # A re-upload of an already processed file only needs its products copied
+    if dedup:
+        with timed(timings, 'dedup'):
+            digest = get_source_digest(s3_client, S3_BUCKET, s3_key)
+            targets = {'png': png_s3_key, 'bounds': bounds_key}
+            if restore_products(s3_client, S3_BUCKET, digest, targets):
+                bounds_obj = s3_client.get_object(Bucket=S3_BUCKET, Key=bounds_key)
+                bounds_dict = json.loads(bounds_obj['Body'].read().decode('utf-8'))
+                print(f"Reused products of {digest} for {s3_key}")
+                return {'png_url': png_url, 'bounds': bounds_dict, 'deduplicated': True}
+
+    # Download the TIFF file from S3 into memory
+    with timed(timings, 'download'):
+        tiff_memfile = open_s3_memfile(s3_client, S3_BUCKET, s3_key)
+
+    with tiff_memfile, MemoryFile(ext='.png') as png_memfile:
         # Convert TIFF to PNG
-        bounds_dict = convert_tiff_to_png(local_tiff_path, local_png_path)
+        reprojection_cache = {}
+        with timed(timings, 'convert'):
+            bounds_dict = convert_tiff_to_png(tiff_memfile.name, png_memfile.name, cache_info=reprojection_cache)
 
         # Verify PNG integrity
-        verify_png(local_png_path)
-
-        # Upload PNG to S3
-        png_s3_key = f'png-export/{png_filename}'
-        upload_file(s3_client, local_png_path, S3_BUCKET, png_s3_key, 'image/png')
-
-        # Verify S3 upload
-        s3_client.head_object(Bucket=S3_BUCKET, Key=png_s3_key)
-        print(f"File {png_s3_key} uploaded successfully to S3")
-
-        # Generate a URL that doesn't require signing
-        png_url = f"https://{S3_BUCKET}.s3.{AWS_REGION}.amazonaws.com/{png_s3_key}"
-
-        # Save bounds to S3 as JSON, with the same UUID
-        bounds_key = f'png-export/{base_file_name}_bounds.json'
-        s3_client.put_object(Bucket=S3_BUCKET, Key=bounds_key, Body=json.dumps(bounds_dict))
-
-        clean_up([local_tiff_path, local_png_path])
-        print(bounds_dict)
+        verify_png(png_memfile)
+
+        # Upload the PNG and its bounds (same UUID) to S3 at the same time. upload_fileobj
+        # raises if the upload fails, so no follow-up head_object is needed.
+        with timed(timings, 'upload'):
+            run_concurrently(
+                (upload_fileobj, s3_client, png_memfile, S3_BUCKET, png_s3_key, 'image/png'),
+                (upload_fileobj, s3_client, io.BytesIO(json.dumps(bounds_dict).encode('utf-8')), S3_BUCKET, bounds_key)
+            )
+            print(f"File {png_s3_key} uploaded successfully to S3")
+
+    if dedup:
+        record_products(s3_client, S3_BUCKET, digest, targets)
+    print(bounds_dict)
+
+    return {'png_url': png_url, 'bounds': bounds_dict, 'reprojection_cache': reprojection_cache, 'deduplicated': False}
+
+def submit_or_run(data, job_type, fn, **kwargs):
+    # Runs the job inline, or queues it and returns a job id at once when 'async' is set
+    if data.get('async'):
+        try:
+            job = job_queue.submit(job_type, fn, **kwargs)
+        except QueueFullError as e:
+            return jsonify({'error': str(e)}), 429, {'Retry-After': str(JOB_RETRY_AFTER_SECONDS)}
+        except BrokenProcessPool:
+            # The queue has already replaced its dead worker pool, so a retry can succeed
+            return jsonify({'error': 'Job workers are restarting'}), 503, {'Retry-After': str(JOB_RETRY_AFTER_SECONDS)}
+        return jsonify({'job_id': job['job_id'], 'status': job['status'],
+                        'status_url': f"/jobs/{job['job_id']}"}), 202
 
-        return jsonify({'png_url': png_url, 'bounds': bounds_dict})
+    try:
+        timings = {}
+        result = fn(timings=timings, **kwargs)
+        return jsonify(dict(result, timings=timings))
 
     except Exception as e:
         error_message = str(e)
@@ -129,63 +215,88 @@ def process_image():
         return jsonify({'error': error_message, 'stack_trace': stack_trace}), 500
 
 
-
-@app.route('/convert-png-to-tif', methods=['POST'])
-def convert_png_to_tif():
+@app.route('/process-image', methods=['POST'])
+def process_image():
     data = request.json
-    png_s3_key = data.get('s3_key')
-    if not png_s3_key:
+    s3_key = data.get('s3_key')  # The S3 key includes the UUID
+    if not s3_key:
         return jsonify({'error': 'Missing s3_key in request'}), 400
-
-    try:
-        png_file_name = os.path.basename(png_s3_key)
-        tiff_file_name = png_file_name.rsplit('.', 1)[0] + '.tif'
-        local_png_path = f'/tmp/{png_file_name}'
-        local_tiff_path = f'/tmp/{tiff_file_name}'
-
-        # Download the PNG file from S3
-        download_file(s3_client, S3_BUCKET, png_s3_key, local_png_path)
+    return submit_or_run(data, 'process-image', run_process_image_and_notify, s3_key=s3_key,
+                         dedup=data.get('dedup', PRODUCT_DEDUP))
+
+
+@app.route('/metrics/s3', methods=['GET'])
+def get_s3_metrics():
+    # Latency histograms for S3 calls made by this server process
+    return jsonify(s3_latency.snapshot())
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': f'Job {job_id} not found'}), 404
+    return jsonify(job)
+
+def run_convert_png_to_tif(png_s3_key, timings, dedup=PRODUCT_DEDUP, codec=EXPORT_CODEC, predictor=EXPORT_PREDICTOR):
+    png_file_name = os.path.basename(png_s3_key)
+    tiff_file_name = export_file_name(png_file_name, codec, predictor)
+    product = export_product(codec, predictor)
+
+    # The same classified PNG with the same bounds (same ETags) always converts to the same
+    # TIFF, so reuse it as is
+    bounds_key = png_s3_key.replace('classified.png', 'bounds.json')
+    if dedup:
+        with timed(timings, 'dedup'):
+            digest = get_combined_digest(s3_client, S3_BUCKET, [png_s3_key, bounds_key])
+            existing = lookup_products(s3_client, S3_BUCKET, digest, [product])
+        if existing:
+            tiff_url = f"https://{S3_BUCKET}.s3.{AWS_REGION}.amazonaws.com/{existing[product]}"
+            return {'tiff_url': tiff_url, 'deduplicated': True}
+
+    # Download the PNG file from S3
+    with timed(timings, 'download'):
+        png_content = read_s3_object(s3_client, S3_BUCKET, png_s3_key)
 
         # Fetch bounds from corresponding JSON file
-        bounds_key = png_s3_key.replace('classified.png', 'bounds.json')
         bounds_obj = s3_client.get_object(Bucket=S3_BUCKET, Key=bounds_key)
         bounds = json.loads(bounds_obj['Body'].read().decode('utf-8'))
 
-        # Convert PNG to TIFF with geospatial metadata
-        with Image.open(local_png_path) as img:
-            img = img.convert('RGBA')
-            transform = from_bounds(bounds['left'], bounds['bottom'], bounds['right'], bounds['top'], img.width, img.height)
-            meta = {
-                'driver': 'GTiff',
-                'dtype': 'uint8',
-                'count': 4,
-                'height': img.height,
-                'width': img.width,
-                'crs': 'EPSG:4326',
-                'transform': transform,
-                'compress': 'LZW'
-            }
-            with rasterio.open(local_tiff_path, 'w', **meta) as dst:
-                for i, band in enumerate(img.split(), start=1):
-                    dst.write(np.array(band), i)
+    # Convert the PNG to a paletted single-band Cloud Optimized GeoTIFF with geospatial metadata
+    with MemoryFile(ext='.tif') as tiff_memfile:
+        with timed(timings, 'convert'):
+            labels, palette = read_png_labels(png_content)
+            height, width = labels.shape
+            transform = from_bounds(bounds['left'], bounds['bottom'], bounds['right'], bounds['top'], width, height)
+            write_label_cog(tiff_memfile.name, labels, palette, transform, codec=codec, predictor=predictor)
 
         # Upload TIFF to S3
         tiff_s3_key = f'tif-export/{tiff_file_name}'
-        upload_file(s3_client, local_tiff_path, S3_BUCKET, tiff_s3_key, 'image/tiff')
-
-        # Generate a URL for the TIFF file
-        tiff_url = f"https://{S3_BUCKET}.s3.{AWS_REGION}.amazonaws.com/{tiff_s3_key}"
+        with timed(timings, 'upload'):
+            upload_fileobj(s3_client, tiff_memfile, S3_BUCKET, tiff_s3_key, 'image/tiff')
+    if dedup:
+        record_products(s3_client, S3_BUCKET, digest, {product: tiff_s3_key})
 
-        clean_up([local_png_path, local_tiff_path])
+    # Generate a URL for the TIFF file
+    tiff_url = f"https://{S3_BUCKET}.s3.{AWS_REGION}.amazonaws.com/{tiff_s3_key}"
 
-        return jsonify({'tiff_url': tiff_url})
+    return {'tiff_url': tiff_url, 'deduplicated': False}
 
-    except Exception as e:
-        error_message = str(e)
-        stack_trace = traceback.format_exc()
-        print(f"Error: {error_message}")
-        print(f"Stack trace: {stack_trace}")
-        return jsonify({'error': error_message, 'stack_trace': stack_trace}), 500
+@app.route('/convert-png-to-tif', methods=['POST'])
+def convert_png_to_tif():
+    data = request.json
+    png_s3_key = data.get('s3_key')
+    if not png_s3_key:
+        return jsonify({'error': 'Missing s3_key in request'}), 400
+    codec = data.get('codec', EXPORT_CODEC).upper()
+    if codec not in EXPORT_CODECS:
+        return jsonify({'error': f'Unknown codec {codec}, expected one of {list(EXPORT_CODECS)}'}), 400
+    try:
+        predictor = parse_predictor(data.get('predictor', EXPORT_PREDICTOR))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return submit_or_run(data, 'convert-png-to-tif', run_convert_png_to_tif, png_s3_key=png_s3_key,
+                         dedup=data.get('dedup', PRODUCT_DEDUP), codec=codec, predictor=predictor)
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000)
@@ -13,7 +13,7 @@ def lambda_handler(event, context):
         # Trigger the processing on the EC2 instance
         response = requests.post(
             processing_url,
-            json={'s3_key': object_key},
+            json={'s3_key': object_key, 'async': True},  # Queue the job instead of waiting for it
             headers={'Content-Type': 'application/json'},
             verify=False  # Disable SSL verification
         )
@@ -0,0 +1,126 @@
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+
+# In-process stand-in for a job queue (SQS/Redis in production): jobs run on a bounded
+# process pool and their records live in memory on the web server.
+
+class QueueFullError(Exception):
+    pass
+
+@contextmanager
+def timed(timings, stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = round(time.perf_counter() - start, 3)
+
+def run_job(fn, kwargs):
+    # Runs in the worker process; timings are returned even when the job fails
+    started_at = time.time()
+    timings = {}
+    try:
+        return {'result': fn(timings=timings, **kwargs), 'timings': timings, 'started_at': started_at}
+    except Exception as e:
+        return {'error': str(e), 'stack_trace': traceback.format_exc(), 'timings': timings, 'started_at': started_at}
+
+class JobQueue:
+    def __init__(self, max_workers, max_pending, initializer=None, history=1000):
+        self.max_workers = max_workers
+        self.initializer = initializer
+        self.executor = ProcessPoolExecutor(max_workers=max_workers, initializer=initializer)
+        self.max_pending = max_pending
+        self.history = history
+        self.jobs = {}
+        self.futures = {}
+        self.active = 0
+        self.lock = threading.Lock()
+
+    def submit(self, job_type, fn, **kwargs):
+        with self.lock:
+            if self.active >= self.max_pending:
+                raise QueueFullError(f"Job queue is full ({self.active} jobs pending)")
+            self.active += 1
+            job_id = str(uuid.uuid4())
+            self.jobs[job_id] = {
+                'job_id': job_id,
+                'type': job_type,
+                'status': 'queued',
+                'submitted_at': time.time(),
+                'started_at': None,
+                'finished_at': None,
+                'timings': {},
+                'result': None,
+                'error': None
+            }
+            self._prune()
+            executor = self.executor
+        try:
+            future = executor.submit(run_job, fn, kwargs)
+        except Exception as e:
+            # Give the slot back; a broken pool is replaced so the next submit can succeed
+            with self.lock:
+                self.active -= 1
+                del self.jobs[job_id]
+                if isinstance(e, BrokenProcessPool):
+                    self._replace_executor(executor)
+            raise
+        self.futures[job_id] = future
+        future.add_done_callback(lambda f: self._finish(job_id, f))
+        return self.get(job_id)
+
+    def _finish(self, job_id, future):
+        with self.lock:
+            self.active -= 1
+            self.futures.pop(job_id, None)
+            job = self.jobs.get(job_id)
+            if job is None:
+                return
+            job['finished_at'] = time.time()
+            try:
+                outcome = future.result()
+            except Exception as e:
+                # The worker process itself died, which breaks the whole pool
+                job.update(status='failed', error=str(e))
+                if isinstance(e, BrokenProcessPool):
+                    self._replace_executor(self.executor)
+                return
+            job['started_at'] = outcome['started_at']
+            job['timings'] = dict(outcome['timings'], queued=round(outcome['started_at'] - job['submitted_at'], 3))
+            if 'error' in outcome:
+                job.update(status='failed', error=outcome['error'])
+                print(f"Job {job_id} failed: {outcome['stack_trace']}")
+            else:
+                job.update(status='succeeded', result=outcome['result'])
+
+    def _replace_executor(self, broken):
+        # Called with the lock held. A worker killed by the OS (e.g. the OOM killer) leaves the
+        # pool refusing every submit, so it is swapped for a fresh one, once per broken pool.
+        # Jobs still pending on the old pool fail through _finish.
+        if self.executor is not broken:
+            return
+        print("Job worker pool is broken, starting a new one")
+        self.executor = ProcessPoolExecutor(max_workers=self.max_workers, initializer=self.initializer)
+        broken.shutdown(wait=False, cancel_futures=True)
+
+    def _prune(self):
+        # Forget the oldest finished jobs once the history limit is reached
+        finished = [job_id for job_id, job in self.jobs.items() if job['finished_at'] is not None]
+        for job_id in finished[:max(0, len(self.jobs) - self.history)]:
+            del self.jobs[job_id]
+
+    def get(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            job = dict(job)
+        future = self.futures.get(job_id)
+        if job['status'] == 'queued' and future is not None and future.running():
+            job['status'] = 'running'
+        return job
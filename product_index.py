@@ -0,0 +1,81 @@
+import hashlib
+import json
+import os
+import time
+from botocore.exceptions import ClientError
+from s3_transfer import TRANSFER_CONFIG, run_concurrently
+
+# Content-addressed index of derived products. Sources are identified by their S3 ETag
+# (the MD5 of the content for single-part uploads), and every product made from a source
+# is recorded under product-index/<digest>/<product>.json pointing at its S3 key. A
+# re-upload of the same file then costs a HEAD, a few small GETs and server-side copies
+# instead of a GDAL or TFLite run. One record per product keeps writers from different
+# services (EC2, Lambda, the web app) from overwriting each other.
+
+PRODUCT_INDEX_PREFIX = 'product-index'
+PRODUCT_DEDUP = os.environ.get('PRODUCT_DEDUP', '1') == '1'
+
+def source_digest(etag):
+    etag = etag.strip('"')
+    # Multipart ETags (md5-of-parts plus "-N") only match for the same part size
+    return f"etag-{etag.replace('-', '_')}" if '-' in etag else f"md5-{etag}"
+
+def get_source_digest(s3_client, bucket, key):
+    return source_digest(s3_client.head_object(Bucket=bucket, Key=key)['ETag'])
+
+def get_combined_digest(s3_client, bucket, keys):
+    # For products made from several sources, e.g. a mask and the bounds that georeference it:
+    # identical masks at different places must not share a product
+    digests = run_concurrently(*[(get_source_digest, s3_client, bucket, key) for key in keys])
+    return 'sha1-' + hashlib.sha1('|'.join(digests).encode('utf-8')).hexdigest()
+
+def product_record_key(digest, product):
+    return f'{PRODUCT_INDEX_PREFIX}/{digest}/{product}.json'
+
+def get_product_record(s3_client, bucket, digest, product):
+    try:
+        response = s3_client.get_object(Bucket=bucket, Key=product_record_key(digest, product))
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return None
+        raise
+    return json.loads(response['Body'].read())
+
+def lookup_products(s3_client, bucket, digest, products):
+    # Returns {product: key} when every requested product is indexed, otherwise None
+    records = run_concurrently(*[(get_product_record, s3_client, bucket, digest, product) for product in products])
+    if any(record is None for record in records):
+        return None
+    return {product: record['key'] for product, record in zip(products, records)}
+
+def put_product_record(s3_client, bucket, digest, product, key):
+    record = {'digest': digest, 'product': product, 'key': key, 'created_at': time.time()}
+    s3_client.put_object(Bucket=bucket, Key=product_record_key(digest, product),
+                         Body=json.dumps(record).encode('utf-8'), ContentType='application/json')
+
+def record_products(s3_client, bucket, digest, products):
+    # products maps product name to the S3 key it was written to
+    run_concurrently(*[
+        (put_product_record, s3_client, bucket, digest, product, key)
+        for product, key in products.items()
+    ])
+
+def copy_object(s3_client, bucket, source_key, target_key):
+    if source_key != target_key:
+        s3_client.copy({'Bucket': bucket, 'Key': source_key}, bucket, target_key, Config=TRANSFER_CONFIG)
+
+def restore_products(s3_client, bucket, digest, targets):
+    # Copies indexed products to the keys a new upload expects ({product: target key}).
+    # Returns False, leaving the caller to recompute, when the index or a product is missing.
+    sources = lookup_products(s3_client, bucket, digest, list(targets))
+    if sources is None:
+        return False
+    try:
+        run_concurrently(*[(copy_object, s3_client, bucket, sources[product], target)
+                           for product, target in targets.items()])
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            print(f"Indexed product for {digest} is gone, recomputing")
+            return False
+        raise
+    return True
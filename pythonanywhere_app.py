@@ -1,4 +1,4 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, request, jsonify, send_from_directory, Response
 from flask_cors import CORS
 import boto3
 import os
@@ -6,6 +6,14 @@ import requests
 import urllib3
 import json
 import uuid
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from product_index import PRODUCT_DEDUP, get_combined_digest, lookup_products, record_products
+from s3_transfer import run_concurrently
+from completion import COMPLETION_NOTIFY_TOKEN, CompletionBus
+from tiff_export import EXPORT_CODEC, EXPORT_PREDICTOR, export_product
 
 # Disable warnings about insecure requests
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
@@ -21,6 +29,76 @@ LAMBDA_EXPORT_FUNCTION = 'convertPNGtoTIFF'
 s3_client = boto3.client('s3', region_name=AWS_REGION)
 lambda_client = boto3.client('lambda', region_name=AWS_REGION)
 
+# Image info metadata cache: the front end polls the info endpoints, so bounds JSON and
+# presigned GET URLs are kept in process. A URL is handed out again until it is within
+# PRESIGNED_URL_REUSE_MARGIN seconds of expiring; bounds are re-read after METADATA_CACHE_TTL.
+PRESIGNED_URL_EXPIRES = 3600
+PRESIGNED_URL_REUSE_MARGIN = int(os.environ.get('PRESIGNED_URL_REUSE_MARGIN', '600'))
+METADATA_CACHE_TTL = int(os.environ.get('METADATA_CACHE_TTL', '300'))
+METADATA_CACHE_ENTRIES = int(os.environ.get('METADATA_CACHE_ENTRIES', '4096'))
+IMAGE_INFO_BATCH_MAX = int(os.environ.get('IMAGE_INFO_BATCH_MAX', '100'))
+INFO_CACHE_CONTROL = 'private, no-cache'
+
+class MetadataCache:
+    # LRU of (value, expiry) pairs; expired entries count as misses and are dropped on lookup
+    def __init__(self, max_entries=METADATA_CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.entries.pop(key, None)
+            self.misses += 1
+            return None
+
+    def put(self, key, value, ttl):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, object_key):
+        # Drops the URL and bounds cached for an S3 key, e.g. once it has been rewritten
+        with self.lock:
+            for key in [key for key in self.entries if key[1] == object_key]:
+                del self.entries[key]
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0
+            }
+
+metadata_cache = MetadataCache()
+
+# Completion channel: stages POST to /notify-completion and clients wait on /completion-events
+# (server-sent events) or /wait-for-completion (long poll). Streams are closed after
+# COMPLETION_STREAM_SECONDS so a web worker is not held forever; EventSource reconnects on its own
+# and resumes from Last-Event-ID. Each open stream holds a web worker, so the channel is off unless
+# COMPLETION_EVENTS=1 (with the stages' COMPLETION_NOTIFY_URL pointing here); clients check
+# /completion-status before subscribing and otherwise keep polling at full rate. Events carry
+# presigned URLs, so publishing also needs COMPLETION_NOTIFY_TOKEN, shared with the stages, and
+# clients can only wait on object names they already know.
+COMPLETION_EVENTS = os.environ.get('COMPLETION_EVENTS', '0') == '1' and bool(COMPLETION_NOTIFY_TOKEN)
+COMPLETION_STREAM_SECONDS = int(os.environ.get('COMPLETION_STREAM_SECONDS', '60'))
+COMPLETION_HEARTBEAT_SECONDS = 15
+COMPLETION_LONG_POLL_SECONDS = 25
+COMPLETION_STAGE_SOURCES = {'segmentation': 'segmented', 'processing': 'processed'}
+completion_bus = CompletionBus()
+
 # Serve static files (e.g., index.html, script.js, styles.css)
 @app.route('/')
 def serve_index():
@@ -49,6 +127,70 @@ def generate_presigned_url():
         return jsonify({'error': str(e)}), 500
 
 
+def get_presigned_get_url(object_key):
+    presigned_url = metadata_cache.get(('url', object_key))
+    if presigned_url is None:
+        presigned_url = s3_client.generate_presigned_url(
+            'get_object',
+            Params={'Bucket': S3_BUCKET, 'Key': object_key},
+            ExpiresIn=PRESIGNED_URL_EXPIRES
+        )
+        metadata_cache.put(('url', object_key), presigned_url, PRESIGNED_URL_EXPIRES - PRESIGNED_URL_REUSE_MARGIN)
+    return presigned_url
+
+
+def get_bounds(bounds_key):
+    # Missing bounds (output not written yet) raise NoSuchKey and are not cached
+    bounds = metadata_cache.get(('bounds', bounds_key))
+    if bounds is None:
+        bounds_object = s3_client.get_object(Bucket=S3_BUCKET, Key=bounds_key)
+        bounds = json.loads(bounds_object['Body'].read().decode('utf-8'))
+        metadata_cache.put(('bounds', bounds_key), bounds, METADATA_CACHE_TTL)
+    return bounds
+
+
+def get_bounds_key(object_name, source):
+    if source == 'segmented':
+        # Extract base name before the suffix
+        return f"{object_name.rsplit('_', 1)[0]}_bounds.json"
+    return object_name.replace('.png', '_bounds.json')
+
+
+def get_tiles(tiles_key):
+    # Tile template of a tiled processing output; {} (also cached) for the single-PNG output
+    tiles = metadata_cache.get(('tiles', tiles_key))
+    if tiles is None:
+        try:
+            tiles_object = s3_client.get_object(Bucket=S3_BUCKET, Key=tiles_key)
+            tiles = json.loads(tiles_object['Body'].read().decode('utf-8'))
+        except s3_client.exceptions.NoSuchKey:
+            tiles = {}
+        metadata_cache.put(('tiles', tiles_key), tiles, METADATA_CACHE_TTL)
+    return tiles
+
+
+def get_image_info(object_name, source):
+    bounds = get_bounds(get_bounds_key(object_name, source))
+    info = {'png_url': get_presigned_get_url(object_name), 'bounds': bounds}
+    if source == 'processed':
+        # Written before the bounds, so it is in place once the bounds are
+        tiles = get_tiles(object_name.replace('.png', '_tiles.json'))
+        if tiles:
+            info['tiles'] = tiles
+    return info
+
+
+def conditional_json_response(payload):
+    # The body only changes when the bounds change or a new URL is presigned, so pollers
+    # revalidating with If-None-Match get an empty 304 in between
+    body = json.dumps(payload, sort_keys=True)
+    etag = hashlib.md5(body.encode('utf-8')).hexdigest()
+    headers = {'ETag': f'"{etag}"', 'Cache-Control': INFO_CACHE_CONTROL}
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers=headers)
+    return Response(body, mimetype='application/json', headers=headers)
+
+
 # Endpoint to get processed image info from png-export folder
 @app.route('/get-processed-image-info', methods=['GET'])
 def get_processed_image_info():
@@ -56,18 +198,7 @@ def get_processed_image_info():
     if not object_name:
         return jsonify({'error': 'Missing object_name in request'}), 400
     try:
-        # Generate a pre-signed URL for the processed PNG image
-        presigned_url = s3_client.generate_presigned_url(
-            'get_object',
-            Params={'Bucket': S3_BUCKET, 'Key': object_name},
-            ExpiresIn=3600  # URL expires in 1 hour
-        )
-
-        # Retrieve the bounds information from the JSON file
-        bounds_key = object_name.replace('.png', '_bounds.json')
-        bounds_object = s3_client.get_object(Bucket=S3_BUCKET, Key=bounds_key)
-        bounds = json.loads(bounds_object['Body'].read().decode('utf-8'))
-        return jsonify({'png_url': presigned_url, 'bounds': bounds})
+        return conditional_json_response(get_image_info(object_name, 'processed'))
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -79,17 +210,83 @@ def invoke_segmentation():
     image_key = data.get('image_key')
     if not image_key:
         return jsonify({'error': 'Missing image_key in request'}), 400
+    payload = {'bucket': S3_BUCKET, 'key': image_key, 'output_bucket': S3_BUCKET, 'output_key': 'segment-upload/',
+               'dedup': data.get('dedup', PRODUCT_DEDUP), 'precision': data.get('precision')}
+    # Optional region of interest as [west, south, east, north] in EPSG:4326, the CRS of _bounds.json
+    bbox = data.get('bbox')
+    if bbox is not None:
+        if not is_valid_bbox(bbox):
+            return jsonify({'error': 'bbox must be [west, south, east, north] with west < east and south < north'}), 400
+        payload['bbox'] = [float(v) for v in bbox]
+    # Optional FlatGeobuf / line-delimited GeoJSON polygons of the classes; the Lambda's defaults apply otherwise
+    for option in ('vectorize', 'vector_format', 'simplify_tolerance'):
+        if option in data:
+            payload[option] = data[option]
     try:
         response = lambda_client.invoke(
             FunctionName=LAMBDA_FUNCTION_NAME,
             InvocationType='Event',
-            Payload=json.dumps({'bucket': S3_BUCKET, 'key': image_key, 'output_bucket': S3_BUCKET, 'output_key': 'segment-upload/'})
+            Payload=json.dumps(payload)
         )
         return jsonify({'message': 'Segmentation invoked', 'statusCode': response['StatusCode']})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
+def is_valid_bbox(bbox):
+    if not isinstance(bbox, (list, tuple)) or len(bbox) != 4:
+        return False
+    try:
+        west, south, east, north = (float(v) for v in bbox)
+    except (TypeError, ValueError):
+        return False
+    return west < east and south < north
+
+
+# Endpoint to segment many images with one Lambda invocation
+@app.route('/invoke-batch-segmentation', methods=['POST'])
+def invoke_batch_segmentation():
+    data = request.get_json()
+    image_keys = data.get('image_keys')
+    prefix = data.get('prefix')
+    if not image_keys and not prefix:
+        return jsonify({'error': 'Missing image_keys or prefix in request'}), 400
+    batch_id = str(uuid.uuid4())
+    payload = {'bucket': S3_BUCKET, 'output_bucket': S3_BUCKET, 'output_key': 'segment-upload/',
+               'batch_id': batch_id, 'dedup': data.get('dedup', PRODUCT_DEDUP), 'precision': data.get('precision')}
+    if image_keys:
+        payload['keys'] = image_keys
+    else:
+        payload['prefix'] = prefix
+    try:
+        response = lambda_client.invoke(
+            FunctionName=LAMBDA_FUNCTION_NAME,
+            InvocationType='Event',
+            Payload=json.dumps(payload)
+        )
+        return jsonify({'message': 'Batch segmentation invoked', 'statusCode': response['StatusCode'],
+                        'batch_id': batch_id, 'manifest_key': f'segment-upload/batches/{batch_id}_manifest.json'})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+# Endpoint to read the per-image status of a batch
+@app.route('/get-batch-segmentation-status', methods=['GET'])
+def get_batch_segmentation_status():
+    batch_id = request.args.get('batch_id')
+    if not batch_id:
+        return jsonify({'error': 'Missing batch_id in request'}), 400
+    manifest_key = f'segment-upload/batches/{batch_id}_manifest.json'
+    try:
+        manifest_object = s3_client.get_object(Bucket=S3_BUCKET, Key=manifest_key)
+        return jsonify(json.loads(manifest_object['Body'].read().decode('utf-8')))
+    except s3_client.exceptions.NoSuchKey:
+        # The Lambda has not started the batch yet
+        return jsonify({'batch_id': batch_id, 'status': 'pending'}), 202
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
 # Endpoint to get processed image info from segment-upload folder
 @app.route('/get-segmented-image-info', methods=['GET'])
 def get_segmented_image_info():
@@ -97,27 +294,142 @@ def get_segmented_image_info():
     if not object_name:
         return jsonify({'error': 'Missing object_name in request'}), 400
     try:
-        # Generate a pre-signed URL for the processed PNG image
-        presigned_url = s3_client.generate_presigned_url(
-            'get_object',
-            Params={'Bucket': S3_BUCKET, 'Key': object_name},
-            ExpiresIn=3600  # URL expires in 1 hour
-        )
-
-        # Modify the logic to fetch the correct bounds JSON file
-        base_name = object_name.rsplit('_', 1)[0]  # Extract base name before the suffix
-        bounds_key = f"{base_name}_bounds.json"
-
-        bounds_object = s3_client.get_object(Bucket=S3_BUCKET, Key=bounds_key)
-        bounds = json.loads(bounds_object['Body'].read().decode('utf-8'))
-        return jsonify({'png_url': presigned_url, 'bounds': bounds})
+        return conditional_json_response(get_image_info(object_name, 'segmented'))
     except s3_client.exceptions.NoSuchKey:
+        bounds_key = get_bounds_key(object_name, 'segmented')
         error_message = f"Object {object_name} or {bounds_key} not found in bucket {S3_BUCKET}."
         return jsonify({'error': error_message}), 404
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
+def resolve_image_info(object_name, source):
+    try:
+        return get_image_info(object_name, source), None
+    except s3_client.exceptions.NoSuchKey:
+        return None, f"{get_bounds_key(object_name, source)} not found in bucket {S3_BUCKET}."
+    except Exception as e:
+        return None, str(e)
+
+
+# Endpoint to resolve the info of many processed or segmented images in one request
+@app.route('/get-image-info-batch', methods=['POST'])
+def get_image_info_batch():
+    data = request.get_json()
+    object_names = data.get('object_names')
+    source = data.get('source', 'processed')
+    if not object_names or not isinstance(object_names, list) or not all(isinstance(name, str) for name in object_names):
+        return jsonify({'error': 'Missing object_names in request'}), 400
+    if len(object_names) > IMAGE_INFO_BATCH_MAX:
+        return jsonify({'error': f'At most {IMAGE_INFO_BATCH_MAX} object_names per request'}), 400
+    if source not in ('processed', 'segmented'):
+        return jsonify({'error': "source must be 'processed' or 'segmented'"}), 400
+    try:
+        # Cache misses fetch their bounds at the same time
+        object_names = list(dict.fromkeys(object_names))
+        results = run_concurrently(*[(resolve_image_info, name, source) for name in object_names])
+        images = {name: info for name, (info, error) in zip(object_names, results) if info is not None}
+        errors = {name: error for name, (info, error) in zip(object_names, results) if error is not None}
+        return conditional_json_response({'images': images, 'errors': errors})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+# Endpoint the segmentation and processing stages report finished outputs to
+@app.route('/notify-completion', methods=['POST'])
+def notify_completion():
+    if not COMPLETION_EVENTS:
+        return completion_events_disabled()
+    if request.headers.get('X-Completion-Token') != COMPLETION_NOTIFY_TOKEN:
+        return jsonify({'error': 'Invalid completion token'}), 403
+    data = request.get_json()
+    events = data.get('events') if data else None
+    if not events or not isinstance(events, list):
+        return jsonify({'error': 'Missing events in request'}), 400
+    for event in events:
+        if (not isinstance(event, dict) or event.get('stage') not in COMPLETION_STAGE_SOURCES
+                or not isinstance(event.get('object_name'), str)):
+            return jsonify({'error': 'Each event needs a stage (segmentation or processing) and an object_name'}), 400
+    published = []
+    for event in events:
+        # The output was (re)written, so cached bounds and URLs of it are stale. Clients get
+        # its info with the event, resolved once here rather than by every poller.
+        source = COMPLETION_STAGE_SOURCES[event['stage']]
+        metadata_cache.invalidate(event['object_name'])
+        metadata_cache.invalidate(get_bounds_key(event['object_name'], source))
+        metadata_cache.invalidate(event['object_name'].replace('.png', '_tiles.json'))
+        if event.get('status', 'succeeded') == 'succeeded':
+            event['info'], _ = resolve_image_info(event['object_name'], source)
+        published.append(completion_bus.publish(event)['id'])
+    return jsonify({'published': published})
+
+
+# Endpoint clients ask whether completion events will be published before subscribing
+@app.route('/completion-status', methods=['GET'])
+def completion_status():
+    return jsonify({'enabled': COMPLETION_EVENTS})
+
+
+def completion_events_disabled():
+    return jsonify({'error': 'Completion events are disabled on this server'}), 404
+
+
+def get_waited_object_names():
+    # None when the request names no object: there is no listing of everyone's outputs
+    object_names = [name for name in request.args.getlist('object_name') if name]
+    return object_names or None
+
+
+def get_last_event_id():
+    try:
+        return int(request.headers.get('Last-Event-ID') or request.args.get('last_event_id', 0))
+    except ValueError:
+        return 0
+
+
+# Server-sent events for the completion of the given object_names (repeatable, at least one)
+@app.route('/completion-events', methods=['GET'])
+def completion_events():
+    if not COMPLETION_EVENTS:
+        return completion_events_disabled()
+    object_names = get_waited_object_names()
+    if object_names is None:
+        return jsonify({'error': 'Missing object_name in request'}), 400
+    after_id = get_last_event_id()
+
+    def stream(after_id):
+        deadline = time.monotonic() + COMPLETION_STREAM_SECONDS
+        yield f"retry: {COMPLETION_HEARTBEAT_SECONDS * 1000}\n\n"
+        while time.monotonic() < deadline:
+            timeout = min(COMPLETION_HEARTBEAT_SECONDS, deadline - time.monotonic())
+            events = completion_bus.wait(object_names, after_id, timeout)
+            if not events:
+                yield ": keep-alive\n\n"
+            for event in events:
+                after_id = event['id']
+                yield f"id: {event['id']}\nevent: completion\ndata: {json.dumps(event)}\n\n"
+
+    return Response(stream(after_id), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+# Long-poll variant for clients without EventSource: returns as soon as an event is available
+@app.route('/wait-for-completion', methods=['GET'])
+def wait_for_completion():
+    if not COMPLETION_EVENTS:
+        return completion_events_disabled()
+    object_names = get_waited_object_names()
+    if object_names is None:
+        return jsonify({'error': 'Missing object_name in request'}), 400
+    after_id = get_last_event_id()
+    try:
+        timeout = min(float(request.args.get('timeout', COMPLETION_LONG_POLL_SECONDS)), COMPLETION_LONG_POLL_SECONDS)
+    except ValueError:
+        return jsonify({'error': 'timeout must be a number of seconds'}), 400
+    events = completion_bus.wait(object_names, after_id, timeout)
+    return jsonify({'events': events, 'last_event_id': events[-1]['id'] if events else after_id})
+
+
 @app.route('/export-tiff', methods=['POST'])
 def export_tiff():
     data = request.json
@@ -137,11 +449,28 @@ def export_tiff():
             )
             return jsonify({'tiff_url': presigned_url})
         else:
+            # A classified PNG with the same content and bounds (ETags) was exported before: reuse
+            # that TIFF. The bounds are part of the key, as the TIFF embeds the georeferencing. The
+            # product name is the one app.py and ec2.py use for the same export settings.
+            dedup = data.get('dedup', PRODUCT_DEDUP)
+            product = export_product()
+            if dedup:
+                digest = get_combined_digest(s3_client, S3_BUCKET,
+                                             [png_s3_key, png_s3_key.replace('classified.png', 'bounds.json')])
+                existing = lookup_products(s3_client, S3_BUCKET, digest, [product])
+                if existing:
+                    presigned_url = s3_client.generate_presigned_url(
+                        'get_object',
+                        Params={'Bucket': S3_BUCKET, 'Key': existing[product]},
+                        ExpiresIn=3600  # URL expires in 1 hour
+                    )
+                    return jsonify({'tiff_url': presigned_url, 'deduplicated': True})
+
             # Invoke the Lambda function to convert the PNG to TIFF
             response = lambda_client.invoke(
                 FunctionName=LAMBDA_EXPORT_FUNCTION,
                 InvocationType='RequestResponse',  # Synchronous call
-                Payload=json.dumps({'s3_key': png_s3_key})
+                Payload=json.dumps({'s3_key': png_s3_key, 'codec': EXPORT_CODEC, 'predictor': EXPORT_PREDICTOR})
             )
 
             # Read the response payload
@@ -159,6 +488,8 @@ def export_tiff():
             tiff_s3_key = response_body.get('tiff_url').split(f"https://{S3_BUCKET}.s3.{AWS_REGION}.amazonaws.com/")[-1]
             if not tiff_s3_key:
                 raise ValueError("TIFF S3 key not found in response")
+            if dedup:
+                record_products(s3_client, S3_BUCKET, digest, {product: tiff_s3_key})
 
             # Generate a presigned URL for the TIFF file
             tiff_presigned_url = s3_client.generate_presigned_url(
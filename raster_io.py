@@ -0,0 +1,24 @@
+import io
+import os
+from rasterio.io import MemoryFile
+from s3_transfer import TRANSFER_CONFIG
+
+# Rasters move between S3 and GDAL through in-memory files instead of /tmp. Each
+# MemoryFile lives in its own /vsimem/<uuid>/ directory, so concurrent requests for
+# the same file name cannot collide, and sidecar files are dropped on close.
+
+def read_s3_object(s3_client, bucket, key):
+    # Large objects are fetched with parallel ranged GETs
+    buffer = io.BytesIO()
+    s3_client.download_fileobj(bucket, key, buffer, Config=TRANSFER_CONFIG)
+    return buffer.getvalue()
+
+def open_s3_memfile(s3_client, bucket, key):
+    # Returns a MemoryFile whose .name can be passed to rasterio.open like a path
+    return MemoryFile(read_s3_object(s3_client, bucket, key), ext=os.path.splitext(key)[1])
+
+def upload_fileobj(s3_client, fileobj, bucket, key, content_type=None):
+    # Streams to S3, switching to multipart upload above the threshold
+    extra_args = {'ContentType': content_type} if content_type else {}
+    fileobj.seek(0)
+    s3_client.upload_fileobj(fileobj, bucket, key, ExtraArgs=extra_args, Config=TRANSFER_CONFIG)
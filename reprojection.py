@@ -0,0 +1,127 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+import rasterio
+from rasterio.warp import calculate_default_transform, transform, transform_bounds
+from rasterio.windows import Window
+
+# Nearest-neighbour reprojection through cached coordinate-mapping grids. Uploads from the
+# same survey share a CRS and pixel grid, so the destination transform and the source
+# pixel position of every destination pixel only need to be worked out once. The mapping
+# is sampled every REPROJECT_GRID_STEP pixels and interpolated linearly between samples,
+# the same approximation GDAL's warper makes. The source is read whole and a small share of
+# pixels land differently from GDAL's warp, so convert_tiff_to_png only takes this path when
+# REPROJECT_GRID_CACHE=1; GDAL's multithreaded, memory-bounded warp is the default.
+
+REPROJECT_GRID_STEP = int(os.environ.get('REPROJECT_GRID_STEP', '16'))
+REPROJECT_GRID_CACHE = os.environ.get('REPROJECT_GRID_CACHE', '0') == '1'
+REPROJECT_GRID_CACHE_ENTRIES = int(os.environ.get('REPROJECT_GRID_CACHE_ENTRIES', '32'))
+REPROJECT_ROWS_PER_BLOCK = 256
+
+def grid_key(src, dst_crs):
+    return (src.crs.to_string(), tuple(src.transform)[:6], src.width, src.height, str(dst_crs))
+
+def sample_positions(length, step):
+    return np.unique(np.r_[np.arange(0, length, step), length - 1])
+
+def build_reprojection_grid(src, dst_crs, step=REPROJECT_GRID_STEP):
+    bounds = transform_bounds(src.crs, dst_crs, *src.bounds)
+    dst_transform, width, height = calculate_default_transform(src.crs, dst_crs, src.width, src.height, *src.bounds)
+
+    # Destination pixel centres at the sample positions, mapped back to fractional source pixels
+    rows = sample_positions(height, step)
+    cols = sample_positions(width, step)
+    col_grid, row_grid = np.meshgrid(cols + 0.5, rows + 0.5)
+    xs, ys = dst_transform * (col_grid.ravel(), row_grid.ravel())
+    src_xs, src_ys = transform(dst_crs, src.crs, xs, ys)
+    src_cols, src_rows = ~src.transform * (np.asarray(src_xs), np.asarray(src_ys))
+
+    return {
+        'bounds': {'left': bounds[0], 'bottom': bounds[1], 'right': bounds[2], 'top': bounds[3]},
+        'transform': dst_transform,
+        'width': width,
+        'height': height,
+        'sample_rows': rows,
+        'sample_cols': cols,
+        'src_cols': np.asarray(src_cols, dtype=np.float64).reshape(len(rows), len(cols)),
+        'src_rows': np.asarray(src_rows, dtype=np.float64).reshape(len(rows), len(cols))
+    }
+
+def expand_grid(values, sample_rows, sample_cols, row_start, row_stop, width):
+    # Linear interpolation of a sampled grid for destination rows [row_start, row_stop)
+    cols = np.arange(width)
+    by_column = np.stack([np.interp(cols, sample_cols, row) for row in values])
+    if len(sample_rows) == 1:
+        return np.repeat(by_column, row_stop - row_start, axis=0)
+    rows = np.arange(row_start, row_stop)
+    index = np.clip(np.searchsorted(sample_rows, rows, side='right') - 1, 0, len(sample_rows) - 2)
+    weight = ((rows - sample_rows[index]) / (sample_rows[index + 1] - sample_rows[index]))[:, None]
+    return by_column[index] * (1 - weight) + by_column[index + 1] * weight
+
+def resample_with_grid(data, grid, dst, nodata=None, rows_per_block=REPROJECT_ROWS_PER_BLOCK):
+    # Nearest-neighbour gather from the source array, written to dst one block of rows at a time
+    _, src_height, src_width = data.shape
+    fill = 0 if nodata is None else nodata
+    for row_start in range(0, grid['height'], rows_per_block):
+        row_stop = min(row_start + rows_per_block, grid['height'])
+        src_cols = np.floor(expand_grid(grid['src_cols'], grid['sample_rows'], grid['sample_cols'],
+                                        row_start, row_stop, grid['width'])).astype(np.int64)
+        src_rows = np.floor(expand_grid(grid['src_rows'], grid['sample_rows'], grid['sample_cols'],
+                                        row_start, row_stop, grid['width'])).astype(np.int64)
+        inside = (src_cols >= 0) & (src_cols < src_width) & (src_rows >= 0) & (src_rows < src_height)
+        block = data[:, np.clip(src_rows, 0, src_height - 1), np.clip(src_cols, 0, src_width - 1)]
+        block[:, ~inside] = fill
+        dst.write(block, window=Window(0, row_start, grid['width'], row_stop - row_start))
+
+class ReprojectionGridCache:
+    # LRU of reprojection grids keyed on (src CRS, src transform, shape, dst CRS). Hits skip
+    # the transform computation entirely; saved time is the build time of the reused grids.
+    def __init__(self, max_entries=REPROJECT_GRID_CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self.grids = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+        self.lock = threading.Lock()
+
+    def get_or_build(self, src, dst_crs):
+        key = grid_key(src, dst_crs)
+        with self.lock:
+            entry = self.grids.get(key)
+            if entry is not None:
+                self.grids.move_to_end(key)
+                self.hits += 1
+                self.saved_seconds += entry['build_seconds']
+                return entry['grid'], True
+        start = time.perf_counter()
+        grid = build_reprojection_grid(src, dst_crs)
+        build_seconds = time.perf_counter() - start
+        with self.lock:
+            self.misses += 1
+            self.grids[key] = {'grid': grid, 'build_seconds': build_seconds}
+            while len(self.grids) > self.max_entries:
+                self.grids.popitem(last=False)
+        return grid, False
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.grids),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+                'saved_seconds': round(self.saved_seconds, 3)
+            }
+
+reprojection_grid_cache = ReprojectionGridCache()
+
+def reproject_with_cached_grid(src, dst_path, dst_crs, dst_kwargs, cache=reprojection_grid_cache):
+    # Returns (bounds, cache info); dst_kwargs are the output profile without the georeferencing
+    grid, hit = cache.get_or_build(src, dst_crs)
+    profile = dict(dst_kwargs, crs=dst_crs, transform=grid['transform'], width=grid['width'], height=grid['height'])
+    with rasterio.open(dst_path, 'w', **profile) as dst:
+        resample_with_grid(src.read(), grid, dst, src.nodata)
+    return grid['bounds'], dict(cache.stats(), hit=hit)
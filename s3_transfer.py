@@ -0,0 +1,84 @@
+import os
+import threading
+import time
+import boto3
+from botocore.config import Config
+from boto3.s3.transfer import TransferConfig
+from concurrent.futures import ThreadPoolExecutor
+
+# Shared S3 transfer settings: one pooled client per process, tuned multipart chunking,
+# a thread pool for fanning out independent transfers and per-operation latency histograms.
+
+S3_TRANSFER_WORKERS = 8
+LATENCY_BUCKETS_MS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=S3_TRANSFER_WORKERS
+)
+
+class LatencyHistogram:
+    def __init__(self, buckets_ms=LATENCY_BUCKETS_MS):
+        self.buckets_ms = buckets_ms
+        self.operations = {}
+        self.lock = threading.Lock()
+
+    def record(self, operation, seconds):
+        ms = seconds * 1000
+        with self.lock:
+            stats = self.operations.setdefault(operation, {
+                'count': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'buckets': [0] * (len(self.buckets_ms) + 1)
+            })
+            stats['count'] += 1
+            stats['total_ms'] += ms
+            stats['max_ms'] = max(stats['max_ms'], ms)
+            index = next((i for i, bound in enumerate(self.buckets_ms) if ms <= bound), len(self.buckets_ms))
+            stats['buckets'][index] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                operation: {
+                    'count': stats['count'],
+                    'mean_ms': round(stats['total_ms'] / stats['count'], 2),
+                    'max_ms': round(stats['max_ms'], 2),
+                    'buckets': dict(zip([f'le_{bound}ms' for bound in self.buckets_ms] + ['le_inf'], stats['buckets']))
+                }
+                for operation, stats in self.operations.items()
+            }
+
+s3_latency = LatencyHistogram()
+
+def _start_timer(context, **kwargs):
+    context['s3_call_started'] = time.perf_counter()
+
+def _record_latency(context, model, **kwargs):
+    started = context.get('s3_call_started')
+    if started is not None:
+        s3_latency.record(model.name, time.perf_counter() - started)
+
+def make_s3_client(region_name=None, max_workers=S3_TRANSFER_WORKERS):
+    # The connection pool is sized so concurrent transfers never wait for a socket
+    config = Config(max_pool_connections=max(10, max_workers * 2), retries={'mode': 'adaptive', 'max_attempts': 5})
+    client = boto3.client('s3', region_name=region_name, config=config)
+    client.meta.events.register('before-call.s3', _start_timer)
+    client.meta.events.register('after-call.s3', _record_latency)
+    return client
+
+_executors = {}
+
+def get_transfer_executor():
+    # One pool per process: a pool inherited through fork has no live threads
+    pid = os.getpid()
+    if pid not in _executors:
+        _executors[pid] = ThreadPoolExecutor(max_workers=S3_TRANSFER_WORKERS)
+    return _executors[pid]
+
+def submit_transfer(fn, *args, **kwargs):
+    return get_transfer_executor().submit(fn, *args, **kwargs)
+
+def run_concurrently(*calls):
+    # Runs independent (fn, args...) transfers at the same time and returns their results in order
+    futures = [submit_transfer(fn, *args) for fn, *args in calls]
+    return [future.result() for future in futures]
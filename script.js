@@ -298,7 +298,7 @@ function initializeMap() {
 
     map.on('styledata', function() {
         uploadedImages.forEach(image => {
-            addImageLayer(image.imagePath, image.bounds, image.layerId);
+            addImageLayer(image.imagePath, image.bounds, image.layerId, image.tiles);
         });
     });
 
@@ -439,29 +439,101 @@ function generateUUID() {
 }
 
 
+// Whether the server publishes completion events, asked once per page load
+let completionEventsEnabled = null;
+
+function getCompletionEventsEnabled() {
+    if (!completionEventsEnabled) {
+        completionEventsEnabled = fetch('https://dutta007.pythonanywhere.com/completion-status')
+            .then(response => response.json())
+            .then(data => Boolean(data.enabled))
+            .catch(() => false);
+    }
+    return completionEventsEnabled;
+}
+
+// Completion events for an output key. onEvent gets the stage's report, which carries the
+// image info when it succeeded. onSubscribed gets the EventSource; it is never called when the
+// server has the events turned off or the browser has no EventSource.
+function subscribeToCompletion(objectName, onEvent, onSubscribed) {
+    if (typeof EventSource === 'undefined') {
+        return;
+    }
+    getCompletionEventsEnabled().then(enabled => {
+        if (!enabled) {
+            return;
+        }
+        const source = new EventSource(`https://dutta007.pythonanywhere.com/completion-events?object_name=${encodeURIComponent(objectName)}`);
+        source.addEventListener('completion', event => onEvent(JSON.parse(event.data)));
+        onSubscribed(source);
+    });
+}
+
 function checkProcessedImage(pngExportKey, originalFileName, userLng, userLat) {
     const checkInterval = 2000; // Check every 2 seconds
+    const eventCheckInterval = 10000; // Slower fallback polling while completion events are streamed
     const maxAttempts = 30; // Maximum number of attempts (1 minute total)
     let attempts = 0;
+    let finished = false;
+
+    const showImage = (data) => {
+        finished = true;
+        if (completion) {
+            completion.close();
+        }
+        console.log("Response from /get-processed-image-info:", data);
+        const imagePath = data.png_url;
+        const imageBounds = data.bounds;
+        console.log("Displaying image on map:", imagePath);
+        // Display the image on the map using the original file name (without UUID)
+        displayImageOnMap(imagePath, imageBounds, originalFileName, userLng, userLat, data.tiles);
+    };
+
+    let completion = null;
+    subscribeToCompletion(pngExportKey, event => {
+        if (finished) {
+            return;
+        }
+        if (event.status === 'failed') {
+            finished = true;
+            completion.close();
+            document.getElementById('results').innerText = 'Processing failed: ' + event.error;
+        } else if (event.info) {
+            showImage(event.info);
+        } else {
+            checkImage();
+        }
+    }, source => {
+        if (finished) {
+            source.close();
+        } else {
+            completion = source;
+        }
+    });
 
     const checkImage = () => {
+        if (finished) {
+            return;
+        }
         fetch(`https://dutta007.pythonanywhere.com/get-processed-image-info?object_name=${encodeURIComponent(pngExportKey)}`)
             .then(response => response.json())
             .then(data => {
+                if (finished) {
+                    return;
+                }
                 if (data.error) {
                     attempts++;
                     if (attempts < maxAttempts) {
-                        setTimeout(checkImage, checkInterval);
+                        setTimeout(checkImage, completion ? eventCheckInterval : checkInterval);
                     } else {
+                        finished = true;
+                        if (completion) {
+                            completion.close();
+                        }
                         document.getElementById('results').innerText = 'Processing timed out. Please try again.';
                     }
                 } else {
-                    console.log("Response from /get-processed-image-info:", data);
-                    const imagePath = data.png_url;
-                    const imageBounds = data.bounds;
-                    console.log("Displaying image on map:", imagePath);
-                    // Display the image on the map using the original file name (without UUID)
-                    displayImageOnMap(imagePath, imageBounds, originalFileName, userLng, userLat);
+                    showImage(data);
                 }
             })
             .catch(error => {
@@ -525,32 +597,74 @@ function classifyImage() {
 
 function checkSegmentedImage(pngExportKey, originalFileName, userLng, userLat) {
     const checkInterval = 2000; // Check every 2 seconds
+    const eventCheckInterval = 10000; // Slower fallback polling while completion events are streamed
     const maxAttempts = 120; // Maximum number of attempts (4 minutes total)
     let attempts = 0;
+    let finished = false;
+
+    const showImage = (data) => {
+        finished = true;
+        if (completion) {
+            completion.close();
+        }
+        console.log("Response from /get-segmented-image-info:", data);
+        const imagePath = data.png_url;
+        const imageBounds = data.bounds;
+        console.log("Displaying segmented image on map:", imagePath);
+
+        // Extract the base name without UUID and extension
+        const baseName = originalFileName.replace(/^[^_]+_/, '').replace(/\.[^.]+$/, '');
+        const cleanImageName = `${baseName}_classified.tif`;
+
+        // Display the segmented image on the map
+        displayImageOnMap(imagePath, imageBounds, cleanImageName, userLng, userLat);
+    };
+
+    let completion = null;
+    subscribeToCompletion(pngExportKey, event => {
+        if (finished) {
+            return;
+        }
+        if (event.status === 'failed') {
+            finished = true;
+            completion.close();
+            document.getElementById('results').innerText = 'Segmentation failed: ' + event.error;
+        } else if (event.info) {
+            showImage(event.info);
+        } else {
+            checkImage();
+        }
+    }, source => {
+        if (finished) {
+            source.close();
+        } else {
+            completion = source;
+        }
+    });
 
     const checkImage = () => {
+        if (finished) {
+            return;
+        }
         fetch(`https://dutta007.pythonanywhere.com/get-segmented-image-info?object_name=${encodeURIComponent(pngExportKey)}`)
             .then(response => response.json())
             .then(data => {
+                if (finished) {
+                    return;
+                }
                 if (data.error) {
                     attempts++;
                     if (attempts < maxAttempts) {
-                        setTimeout(checkImage, checkInterval);
+                        setTimeout(checkImage, completion ? eventCheckInterval : checkInterval);
                     } else {
+                        finished = true;
+                        if (completion) {
+                            completion.close();
+                        }
                         document.getElementById('results').innerText = 'Processing timed out. Please try again.';
                     }
                 } else {
-                    console.log("Response from /get-segmented-image-info:", data);
-                    const imagePath = data.png_url;
-                    const imageBounds = data.bounds;
-                    console.log("Displaying segmented image on map:", imagePath);
-
-                    // Extract the base name without UUID and extension
-                    const baseName = originalFileName.replace(/^[^_]+_/, '').replace(/\.[^.]+$/, '');
-                    const cleanImageName = `${baseName}_classified.tif`;
-
-                    // Display the segmented image on the map
-                    displayImageOnMap(imagePath, imageBounds, cleanImageName, userLng, userLat);
+                    showImage(data);
                 }
             })
             .catch(error => {
@@ -564,7 +678,7 @@ function checkSegmentedImage(pngExportKey, originalFileName, userLng, userLat) {
 
 
 
-function displayImageOnMap(imagePath, bounds, imageName, userLng, userLat) {
+function displayImageOnMap(imagePath, bounds, imageName, userLng, userLat, tiles) {
     console.log("Displaying image on map with path:", imagePath);
     console.log("Bounds:", bounds);
 
@@ -599,7 +713,7 @@ function displayImageOnMap(imagePath, bounds, imageName, userLng, userLat) {
     });
 
     // Add the image layer to the map
-    addImageLayer(imagePath, bounds, layerId);
+    addImageLayer(imagePath, bounds, layerId, tiles);
 
     // Extract the clean image name (without UUID) for display in the layer control
     const cleanImageName = imageName.replace(/^[0-9a-fA-F-]+_/, '');
@@ -615,6 +729,7 @@ function displayImageOnMap(imagePath, bounds, imageName, userLng, userLat) {
         layerId, // New Layer ID
         imageName: cleanImageName,
         bounds,
+        tiles, // Only set for tiled processing output, never inherited by the classified layer
         imagePath,
         tiffKey : tiffKey
     });
@@ -664,7 +779,8 @@ function updateLayerControl(imageName, layerId, bounds, imagePath) {
             map.setLayoutProperty(layerId, 'visibility', visibility);
         } else if (checkbox.checked) {
             // If the layer doesn't exist and checkbox is checked, add the layer
-            addImageLayer(imagePath, bounds, layerId);
+            const image = uploadedImages.find(img => img.layerId === layerId);
+            addImageLayer(imagePath, bounds, layerId, image && image.tiles);
         }
     }
 
@@ -751,9 +867,19 @@ function exportTiff(s3Key) {
 
 
 
-function addImageLayer(imagePath, bounds, layerId) {
+function addImageLayer(imagePath, bounds, layerId, tiles) {
     // Check if the source exists, if not, add it
-    if (!map.getSource(layerId)) {
+    if (!map.getSource(layerId) && tiles && tiles.tile_url) {
+        // Tiled output: only the tiles in view are requested
+        map.addSource(layerId, {
+            'type': 'raster',
+            'tiles': [tiles.tile_url],
+            'tileSize': 256,
+            'bounds': [bounds.left, bounds.bottom, bounds.right, bounds.top],
+            'minzoom': tiles.minzoom,
+            'maxzoom': tiles.maxzoom
+        });
+    } else if (!map.getSource(layerId)) {
         map.addSource(layerId, {
             'type': 'image',
             'url': imagePath,
@@ -1,11 +1,37 @@
+import hashlib
 import json
-import boto3
+import math
 import numpy as np
 from PIL import Image
 import tflite_runtime.interpreter as tflite
 import io
 import pandas as pd
 import os
+import queue
+import struct
+import tempfile
+import time
+import zlib
+from collections import deque
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+import rasterio
+from contextlib import contextmanager
+from rasterio.enums import MaskFlags
+from rasterio.errors import WindowError
+from rasterio.io import MemoryFile
+from rasterio.session import AWSSession
+from rasterio.transform import from_bounds
+from rasterio.warp import transform_bounds
+from rasterio.windows import Window, bounds as window_bounds, from_bounds as window_from_bounds
+from s3_transfer import TRANSFER_CONFIG, make_s3_client, run_concurrently, submit_transfer, s3_latency
+from product_index import PRODUCT_DEDUP, copy_object, get_source_digest, record_products, restore_products
+from completion import completion_event, notify_completion
+from tile_store import (TILE_STORE, TILE_STORE_TOP_K, load_tile_entry, missing_tiles, new_tile_entry, save_tile_entry,
+                        tile_labels, tile_store_key, top_k_scores)
+from vectorize import (VECTORIZE, VECTOR_CONTENT_TYPES, VECTOR_FORMAT, VECTOR_SIMPLIFY_TOLERANCE, polygonize_labels,
+                       write_vectors)
 
 # Define class names and colors
 CLASS_INFO = {
@@ -17,25 +43,71 @@ CLASS_INFO = {
     5: ('Unlabeled', (255, 255, 255))# White
 }
 
+# Inference settings, overridable through the Lambda environment
+INFERENCE_BATCH_SIZE = int(os.environ.get('INFERENCE_BATCH_SIZE', '8'))
+INFERENCE_NUM_THREADS = int(os.environ.get('INFERENCE_NUM_THREADS', str(os.cpu_count() or 1)))
+INFERENCE_NUM_INTERPRETERS = int(os.environ.get('INFERENCE_NUM_INTERPRETERS', '1'))
+
+# Tiles without valid pixels, or with (nearly) constant values, skip inference and get the Unlabeled class
+UNLABELED_CLASS = 5
+SKIP_EMPTY_TILES = os.environ.get('SKIP_EMPTY_TILES', '1') == '1'
+SKIP_TILE_VARIANCE = float(os.environ.get('SKIP_TILE_VARIANCE', '1e-5'))
+
+# Model location and warm-start cache settings
+MODEL_BUCKET = os.environ.get('MODEL_BUCKET', 'dutta007bucket')
+MODEL_KEY = os.environ.get('MODEL_KEY', 'model.tflite')
+# Reduced-precision variants of the same model, chosen by MODEL_PRECISION or a request's 'precision'
+MODEL_PRECISION = os.environ.get('MODEL_PRECISION', 'float32')
+MODEL_KEYS = {
+    'float32': MODEL_KEY,
+    'float16': os.environ.get('MODEL_KEY_FLOAT16', 'model_float16.tflite'),
+    'int8': os.environ.get('MODEL_KEY_INT8', 'model_int8.tflite')
+}
+MODEL_CACHE_DIR = os.environ.get('MODEL_CACHE_DIR', '/tmp/model-cache')
+MODEL_REVALIDATE_SECONDS = float(os.environ.get('MODEL_REVALIDATE_SECONDS', '300'))
+
+# Batch mode: images downloading ahead of inference, and where batch manifests are written
+BATCH_PREFETCH_IMAGES = int(os.environ.get('BATCH_PREFETCH_IMAGES', '2'))
+BATCH_MANIFEST_PREFIX = 'batches/'
+
+# Region-of-interest mode: per-image label rasters live under the output prefix, 255 = not computed yet
+ROI_STORE_PREFIX = 'roi/'
+ROI_NO_LABEL = 255
+
+# Shared across invocations of a warm container
+s3_client = make_s3_client()
+_model_cache = {}   # (bucket, key) -> {'etag', 'content', 'checked_at'}
+_engine_cache = {}  # (bucket, key, etag, batch_size, num_threads, num_interpreters) -> InferenceEngine
+
 def download_from_s3(bucket, key):
-    s3 = boto3.client('s3')
-    response = s3.get_object(Bucket=bucket, Key=key)
-    return response['Body'].read()
+    # Large objects are fetched with parallel ranged GETs
+    buffer = io.BytesIO()
+    s3_client.download_fileobj(bucket, key, buffer, Config=TRANSFER_CONFIG)
+    return buffer.getvalue()
 
-def load_tflite_model(model_content):
-    interpreter = tflite.Interpreter(model_content=model_content)
+def load_tflite_model(model_content, num_threads=None, batch_size=1):
+    interpreter = tflite.Interpreter(model_content=model_content, num_threads=num_threads)
+    if batch_size > 1:
+        input_details = interpreter.get_input_details()[0]
+        input_shape = list(input_details['shape'])
+        input_shape[0] = batch_size
+        interpreter.resize_tensor_input(input_details['index'], input_shape)
     interpreter.allocate_tensors()
     return interpreter
 
 def preprocess_image(image):
     return np.array(image).astype(np.float32) / 255.0
 
+def normalize_patch(patch, out):
+    # uint8 pixels are scaled straight into the interpreter's float input buffer
+    np.divide(patch, np.float32(255.0), out=out)
+
 def pad_image(image, patch_size=(256, 256)):
     h, w, _ = image.shape
     ph, pw = patch_size
     new_h = ((h // ph) + 1) * ph if h % ph != 0 else h
     new_w = ((w // pw) + 1) * pw if w % pw != 0 else w
-    padded_image = np.zeros((new_h, new_w, 3), dtype=np.float32)
+    padded_image = np.zeros((new_h, new_w, 3), dtype=image.dtype)
     padded_image[:h, :w, :] = image
     return padded_image
 
@@ -49,10 +121,52 @@ def create_patches(image, patch_size=(256, 256)):
             patches.append(patch)
     return patches, h, w
 
+def has_invalid_pixels(dataset):
+    # True when the raster has a nodata value, an alpha band or an internal mask
+    return not all(MaskFlags.all_valid in flags for flags in dataset.mask_flag_enums)
+
+def get_valid_mask(dataset):
+    return dataset.dataset_mask() > 0 if has_invalid_pixels(dataset) else None
+
+def read_valid_mask(image_content):
+    with MemoryFile(image_content) as memfile, memfile.open() as src:
+        return get_valid_mask(src)
+
+def is_empty_tile(tile, tile_mask=None, variance_threshold=SKIP_TILE_VARIANCE):
+    # A tile needs no inference when none of its pixels are valid or every band is (nearly) constant.
+    # The threshold is on the 0-1 scale, so it is rescaled for uint8 tiles.
+    if tile_mask is not None and not tile_mask.any():
+        return True
+    if tile.dtype == np.uint8:
+        variance_threshold *= 255.0 ** 2
+    return bool(tile.reshape(-1, tile.shape[-1]).var(axis=0).max() <= variance_threshold)
+
+def screen_patches(patches, padded_shape, mask=None, patch_size=(256, 256)):
+    # Flags the patches of a padded image that need no inference; the mask is padded the same way
+    mask_patches = [None] * len(patches)
+    if mask is not None:
+        padded_mask = np.zeros(tuple(padded_shape[:2]) + (1,), dtype=bool)
+        padded_mask[:mask.shape[0], :mask.shape[1], 0] = mask
+        mask_patches, _, _ = create_patches(padded_mask, patch_size)
+    return np.array([is_empty_tile(patch, tile_mask) for patch, tile_mask in zip(patches, mask_patches)], dtype=bool)
+
+def expand_predictions(predictions, empty, patch_size, num_classes=None):
+    # Puts the predictions of the non-empty patches back in place. Empty patches get the Unlabeled
+    # class, or a one-hot Unlabeled vote when num_classes is given for logits.
+    ph, pw = patch_size
+    if num_classes is None:
+        full = np.full((len(empty), ph, pw), UNLABELED_CLASS, dtype=np.uint8)
+    else:
+        full = np.zeros((len(empty), ph, pw, num_classes), dtype=np.float32)
+        full[..., UNLABELED_CLASS] = 1
+    if predictions is not None:
+        full[~empty] = predictions
+    return full
+
 def stitch_patches(patches, padded_shape, original_shape, patch_size=(256, 256)):
     ph, pw = patch_size
     padded_h, padded_w, _ = padded_shape
-    full_segmentation = np.zeros((padded_h, padded_w), dtype=np.int32)
+    full_segmentation = np.zeros((padded_h, padded_w), dtype=np.uint8)
     idx = 0
     for i in range(0, padded_h, ph):
         for j in range(0, padded_w, pw):
@@ -73,10 +187,377 @@ def predict(image, interpreter):
     
     return np.argmax(output_data, axis=-1)
 
+def get_input_lut(input_details):
+    # For integer-input models: quantized input value for every uint8 pixel, given that the float
+    # model sees pixel / 255. None for float-input models (float32, or float16-weight variants).
+    if not np.issubdtype(input_details['dtype'], np.integer):
+        return None
+    scale, zero_point = input_details['quantization']
+    limits = np.iinfo(input_details['dtype'])
+    levels = np.arange(256, dtype=np.float64) / 255.0
+    return np.clip(np.round(levels / scale + zero_point), limits.min, limits.max).astype(input_details['dtype'])
+
+def dequantize(output_data, quantization):
+    scale, zero_point = quantization
+    if not np.issubdtype(output_data.dtype, np.integer) or scale == 0:
+        return output_data
+    return (output_data.astype(np.float32) - zero_point) * np.float32(scale)
+
+class InferenceEngine:
+    # Runs patches through one or more interpreters whose input is resized to a fixed batch.
+    # Input/output details are looked up once, and patches are copied straight into the
+    # interpreter's input buffer instead of being stacked into an intermediate array.
+    # Patches may be uint8 pixels or 0-1 floats. For integer-input (quantized) models, uint8
+    # pixels go through a 256-entry table holding the input scale/zero-point, so no float copy
+    # is made; quantized outputs are only dequantized when logits are asked for.
+    def __init__(self, model_content, batch_size=INFERENCE_BATCH_SIZE,
+                 num_threads=INFERENCE_NUM_THREADS, num_interpreters=INFERENCE_NUM_INTERPRETERS):
+        self.num_interpreters = max(1, num_interpreters)
+        threads_per_interpreter = max(1, num_threads // self.num_interpreters)
+        try:
+            interpreters = [load_tflite_model(model_content, threads_per_interpreter, batch_size)
+                            for _ in range(self.num_interpreters)]
+        except (ValueError, RuntimeError) as e:
+            print(f"Model does not support batch size {batch_size}, falling back to 1: {str(e)}")
+            batch_size = 1
+            interpreters = [load_tflite_model(model_content, threads_per_interpreter)
+                            for _ in range(self.num_interpreters)]
+        self.batch_size = batch_size
+        input_details = interpreters[0].get_input_details()[0]
+        self.input_index = input_details['index']
+        self.patch_size = tuple(int(d) for d in input_details['shape'][1:3])
+        self.input_lut = get_input_lut(input_details)
+        output_details = interpreters[0].get_output_details()[0]
+        self.output_index = output_details['index']
+        self.output_quantization = output_details['quantization']
+        self.num_classes = int(output_details['shape'][-1])
+        self.interpreters = queue.Queue()
+        for interpreter in interpreters:
+            self.interpreters.put(interpreter)
+
+    def _predict_batch(self, patches, start, return_logits=False):
+        batch = patches[start:start + self.batch_size]
+        interpreter = self.interpreters.get()
+        try:
+            # Rows past len(batch) keep stale data on the last batch; their output is dropped
+            input_tensor = interpreter.tensor(self.input_index)
+            for k, patch in enumerate(batch):
+                self._fill_input(input_tensor()[k], patch)
+            interpreter.invoke()
+            output_data = interpreter.get_tensor(self.output_index)[:len(batch)]
+            if return_logits:
+                return dequantize(output_data, self.output_quantization)
+            # A positive output scale keeps the order of the classes, so argmax skips dequantizing
+            return np.argmax(output_data, axis=-1).astype(np.uint8)
+        finally:
+            self.interpreters.put(interpreter)
+
+    def _fill_input(self, slot, patch):
+        if self.input_lut is not None:
+            if patch.dtype != np.uint8:
+                patch = np.round(patch * 255.0).astype(np.uint8)
+            np.take(self.input_lut, patch, out=slot)
+        elif patch.dtype == np.uint8:
+            normalize_patch(patch, slot)
+        else:
+            slot[...] = patch
+
+    def _run(self, patches, return_logits):
+        starts = range(0, len(patches), self.batch_size)
+        if self.num_interpreters > 1:
+            with ThreadPoolExecutor(max_workers=self.num_interpreters) as executor:
+                predictions = list(executor.map(lambda start: self._predict_batch(patches, start, return_logits), starts))
+        else:
+            predictions = [self._predict_batch(patches, start, return_logits) for start in starts]
+        return np.concatenate(predictions)
+
+    def _run_nonempty(self, patches, empty, return_logits):
+        # Patches flagged in `empty` never reach an interpreter
+        if empty is None or not empty.any():
+            return self._run(patches, return_logits)
+        keep = np.flatnonzero(~empty)
+        predictions = self._run([patches[i] for i in keep], return_logits) if len(keep) else None
+        return expand_predictions(predictions, empty, self.patch_size, self.num_classes if return_logits else None)
+
+    def predict_patches(self, patches, empty=None):
+        return self._run_nonempty(patches, empty, return_logits=False)
+
+    def predict_logits(self, patches, empty=None):
+        return self._run_nonempty(patches, empty, return_logits=True)
+
+def get_window_positions(length, window, stride):
+    # Window offsets along one axis; the last window is pinned to the far edge
+    if length <= window:
+        return [0]
+    positions = list(range(0, length - window, stride))
+    positions.append(length - window)
+    return positions
+
+def get_blend_window(patch_size):
+    # Separable Hann weights that never reach zero, so every covered pixel gets a vote
+    ph, pw = patch_size
+    wy = np.hanning(ph + 2)[1:-1]
+    wx = np.hanning(pw + 2)[1:-1]
+    return np.outer(wy, wx).astype(np.float32)
+
+def sliding_window_segmentation(image, engine, stride=None, out=None, mask=None, skip_empty=True, tile_stats=None):
+    # Overlapping-window inference with seam blending. Weighted logits are accumulated in a
+    # float16 buffer one tile row high; rows are argmaxed as soon as no later tile covers them,
+    # so memory is bounded by the tile band rather than the scene. Empty tiles (see is_empty_tile,
+    # with `mask` marking valid pixels) vote for the Unlabeled class without inference.
+    h, w, c = image.shape
+    ph, pw = engine.patch_size
+    stride = stride or (ph, pw)
+    sh, sw = stride
+    if sh > ph or sw > pw:
+        raise ValueError(f"Stride {stride} must not exceed the patch size {engine.patch_size}")
+
+    weight = get_blend_window(engine.patch_size)[np.newaxis, :, :, np.newaxis]
+    ys = get_window_positions(h, ph, sh)
+    xs = get_window_positions(w, pw, sw)
+    segmentation = np.zeros((h, w), dtype=np.uint8) if out is None else out
+    band = None
+    band_top = 0
+    skipped = 0
+
+    for y in ys:
+        if band is not None:
+            # Rows above this tile row are final; emit them and roll the band up
+            done = y - band_top
+            segmentation[band_top:y] = np.argmax(band[:done, :w], axis=-1)
+            band[:ph - done] = band[done:]
+            band[ph - done:] = 0
+            band_top = y
+
+        tiles = []
+        empty = []
+        for x in xs:
+            tile = image[y:y+ph, x:x+pw, :]
+            if tile.shape[:2] != (ph, pw):
+                padded_tile = np.zeros((ph, pw, c), dtype=image.dtype)
+                padded_tile[:tile.shape[0], :tile.shape[1]] = tile
+                tile = padded_tile
+            tiles.append(tile)
+            empty.append(skip_empty and is_empty_tile(tile, None if mask is None else mask[y:y+ph, x:x+pw]))
+        empty = np.array(empty, dtype=bool)
+        skipped += int(empty.sum())
+        weighted_logits = engine.predict_logits(tiles, empty) * weight
+
+        if band is None:
+            band = np.zeros((ph, max(w, pw), weighted_logits.shape[-1]), dtype=np.float16)
+        for x, tile_logits in zip(xs, weighted_logits):
+            band[:, x:x+pw] += tile_logits.astype(np.float16)
+
+    band_bottom = min(band_top + ph, h)
+    segmentation[band_top:band_bottom] = np.argmax(band[:band_bottom - band_top, :w], axis=-1)
+    print(f"Sliding window: {len(ys) * len(xs)} tiles with stride {stride}, {skipped} skipped as empty")
+    if tile_stats is not None:
+        tile_stats.update(tiles=len(ys) * len(xs), skipped_tiles=skipped)
+    return segmentation
+
+class RasterTileReader:
+    # Presents an open rasterio dataset as an (h, w, 3) image for sliding_window_segmentation.
+    # Each tile row triggers one windowed read of a row band; the engine normalizes the tiles.
+    def __init__(self, dataset, band_height):
+        self.dataset = dataset
+        self.shape = (dataset.height, dataset.width, 3)
+        self.dtype = np.uint8 if dataset.dtypes[0] == 'uint8' else np.float32
+        self.band_height = band_height
+        self._band = None
+        self._band_top = None
+
+    def __getitem__(self, key):
+        rows, cols, channels = key
+        if self._band_top != rows.start:
+            band_rows = min(self.band_height, self.dataset.height - rows.start)
+            window = Window(0, rows.start, self.dataset.width, band_rows)
+            self._band = np.moveaxis(self.dataset.read(indexes=[1, 2, 3], window=window), 0, -1)
+            self._band_top = rows.start
+        tile = self._band[:rows.stop - rows.start, cols, channels]
+        return tile if self.dtype == np.uint8 else tile.astype(np.float32) / 255.0
+
+class RasterMaskReader:
+    # The dataset's valid-pixel mask, read in the same row bands as RasterTileReader
+    def __init__(self, dataset, band_height):
+        self.dataset = dataset
+        self.band_height = band_height
+        self._band = None
+        self._band_top = None
+
+    def __getitem__(self, key):
+        rows, cols = key
+        if self._band_top != rows.start:
+            band_rows = min(self.band_height, self.dataset.height - rows.start)
+            window = Window(0, rows.start, self.dataset.width, band_rows)
+            self._band = self.dataset.dataset_mask(window=window) > 0
+            self._band_top = rows.start
+        return self._band[:rows.stop - rows.start, cols]
+
+def get_palette():
+    return np.array([color for _, color in CLASS_INFO.values()], dtype=np.uint8)
+
+def write_paletted_png(fileobj, height, width, palette, label_bands):
+    # Streams row blocks of class labels into an 8-bit paletted PNG without holding the image
+    def write_chunk(tag, data):
+        fileobj.write(struct.pack('>I', len(data)) + tag + data)
+        fileobj.write(struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff))
+
+    fileobj.write(b'\x89PNG\r\n\x1a\n')
+    write_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 3, 0, 0, 0))
+    write_chunk(b'PLTE', palette.tobytes())
+    compressor = zlib.compressobj(6)
+    for labels in label_bands:
+        # Every scanline is prefixed with filter type 0 (None)
+        scanlines = np.zeros((labels.shape[0], width + 1), dtype=np.uint8)
+        scanlines[:, 1:] = labels
+        data = compressor.compress(scanlines.tobytes())
+        if data:
+            write_chunk(b'IDAT', data)
+    write_chunk(b'IDAT', compressor.flush())
+    write_chunk(b'IEND', b'')
+
+def segment_streaming(image_content, engine, stride=None, min_area=100, rows_per_band=1024, skip_empty=True):
+    # Segments a raster without decoding it in full. Labels go to a uint8 memmap in /tmp and the
+    # classified PNG is encoded band by band, so peak memory follows the tile band, not the scene.
+    # Cleaning runs band by band as well (clean_segmentation_bands).
+    ph, pw = engine.patch_size
+    with MemoryFile(image_content) as memfile, memfile.open() as src, tempfile.TemporaryFile(dir='/tmp') as label_file:
+        h, w = src.height, src.width
+        print(f"Streaming segmentation of {w}x{h} raster")
+        labels = np.memmap(label_file, dtype=np.uint8, mode='w+', shape=(h, w))
+        mask = RasterMaskReader(src, ph) if skip_empty and has_invalid_pixels(src) else None
+        tile_stats = {}
+        sliding_window_segmentation(RasterTileReader(src, ph), engine, stride or (ph, pw), out=labels,
+                                    mask=mask, skip_empty=skip_empty, tile_stats=tile_stats)
+        class_counts = np.zeros(len(CLASS_INFO), dtype=np.int64)
+
+        def label_bands():
+            if min_area > 1:
+                bands = clean_segmentation_bands(labels, min_area, rows_per_band)
+            else:
+                bands = (np.asarray(labels[top:top + rows_per_band]) for top in range(0, h, rows_per_band))
+            for band in bands:
+                class_counts[:] += count_classes(band)
+                yield band
+
+        png_buffer = io.BytesIO()
+        write_paletted_png(png_buffer, h, w, get_palette(), label_bands())
+        del labels
+    return png_buffer.getvalue(), class_counts, tile_stats
+
+def get_runs(segmentation):
+    # Run-length encode each row: a run starts at column 0 or wherever the class changes
+    h, w = segmentation.shape
+    run_starts = np.ones((h, w), dtype=bool)
+    run_starts[:, 1:] = segmentation[:, 1:] != segmentation[:, :-1]
+    start_idx = np.flatnonzero(run_starts)
+    run_lengths = np.diff(np.append(start_idx, h * w))
+    run_classes = segmentation.ravel()[start_idx]
+    return start_idx, run_lengths, run_classes, run_starts
+
+def label_runs(segmentation, start_idx, run_starts):
+    # Two runs in neighbouring rows are 4-connected when they share a class and overlap.
+    # Each overlap begins at a column where either row starts a run, so only those columns
+    # are checked, giving at most one edge per overlapping pair.
+    w = segmentation.shape[1]
+    same_class = segmentation[1:, :] == segmentation[:-1, :]
+    overlap_starts = same_class & (run_starts[1:, :] | run_starts[:-1, :])
+    top = np.flatnonzero(overlap_starts)
+    bottom = top + w
+    u = np.searchsorted(start_idx, top, side='right') - 1
+    v = np.searchsorted(start_idx, bottom, side='right') - 1
+    return union_find(len(start_idx), u, v)
+
+def union_find(count, u, v):
+    # Vectorized union-find over count nodes and the edges u[i]-v[i]: hook roots onto the
+    # smaller root, then pointer-jump to flatten. Returns the root of every node.
+    labels = np.arange(count)
+    while True:
+        lu, lv = labels[u], labels[v]
+        if np.array_equal(lu, lv):
+            return labels
+        merged = np.minimum(lu, lv)
+        np.minimum.at(labels, lu, merged)
+        np.minimum.at(labels, lv, merged)
+        while True:
+            jumped = labels[labels]
+            if np.array_equal(jumped, labels):
+                break
+            labels = jumped
+
 def clean_segmentation(segmentation, min_area=100):
+    # Labels the components of every class in one pass and drops those smaller than min_area.
+    # Dropped regions and the Unlabeled class become 0, matching clean_segmentation_reference.
+    h, w = segmentation.shape
+    if h == 0 or w == 0:
+        return np.zeros_like(segmentation)
+    start_idx, run_lengths, run_classes, run_starts = get_runs(segmentation)
+    labels = label_runs(segmentation, start_idx, run_starts)
+    component_sizes = np.bincount(labels, weights=run_lengths, minlength=len(start_idx))
+
+    # Lookup table from component root to output class
+    lut = np.where((component_sizes >= min_area) & (run_classes != 5), run_classes, 0).astype(segmentation.dtype)
+    return np.repeat(lut[labels], run_lengths).reshape(h, w)
+
+def band_components(band):
+    # Components of one band: runs, the band-local component of every run, and per component
+    # its size and class
+    start_idx, run_lengths, run_classes, run_starts = get_runs(band)
+    roots, run_components = np.unique(label_runs(band, start_idx, run_starts), return_inverse=True)
+    sizes = np.bincount(run_components, weights=run_lengths, minlength=len(roots))
+    return start_idx, run_lengths, run_components, sizes, run_classes[roots]
+
+def clean_segmentation_bands(segmentation, min_area=100, rows_per_band=1024):
+    # clean_segmentation for a label raster read in bands of rows, e.g. a memmap, yielding the
+    # cleaned bands. The first pass labels each band and joins components across the band seams
+    # with the seam rows alone; the second relabels each band and looks up its components' fate.
+    # Memory follows the band plus a size and class per component, not the scene.
+    h, w = segmentation.shape
+    if h == 0 or w == 0:
+        for top in range(0, h, rows_per_band):
+            yield np.zeros_like(np.asarray(segmentation[top:top + rows_per_band]))
+        return
+
+    offsets, sizes, classes, seam_u, seam_v = [], [], [], [], []
+    count = 0
+    previous_row = previous_ids = None
+    for top in range(0, h, rows_per_band):
+        band = np.asarray(segmentation[top:top + rows_per_band])
+        start_idx, run_lengths, run_components, band_sizes, band_classes = band_components(band)
+        # Runs never span rows, so the first and last rows are the first and last runs
+        first_runs = np.searchsorted(start_idx, w)
+        last_runs = np.searchsorted(start_idx, (band.shape[0] - 1) * w)
+        first_ids = count + np.repeat(run_components[:first_runs], run_lengths[:first_runs])
+        if previous_row is not None:
+            # As in label_runs, one edge per overlap: the columns where either row starts a run
+            starts = np.ones(w, dtype=bool)
+            starts[1:] = (previous_row[1:] != previous_row[:-1]) | (band[0, 1:] != band[0, :-1])
+            joined = np.flatnonzero((previous_row == band[0]) & starts)
+            seam_u.append(previous_ids[joined])
+            seam_v.append(first_ids[joined])
+        previous_row = band[-1].copy()
+        previous_ids = count + np.repeat(run_components[last_runs:], run_lengths[last_runs:])
+        offsets.append(count)
+        sizes.append(band_sizes)
+        classes.append(band_classes)
+        count += len(band_sizes)
+
+    sizes, classes = np.concatenate(sizes), np.concatenate(classes)
+    roots = union_find(count, np.concatenate(seam_u or [[]]).astype(np.int64),
+                       np.concatenate(seam_v or [[]]).astype(np.int64))
+    component_sizes = np.bincount(roots, weights=sizes, minlength=count)
+    lut = np.where((component_sizes[roots] >= min_area) & (classes != 5), classes, 0).astype(segmentation.dtype)
+    del sizes, classes, roots, component_sizes
+
+    for offset, top in zip(offsets, range(0, h, rows_per_band)):
+        band = np.asarray(segmentation[top:top + rows_per_band])
+        _, run_lengths, run_components, _, _ = band_components(band)
+        yield np.repeat(lut[offset + run_components], run_lengths).reshape(band.shape)
+
+def clean_segmentation_reference(segmentation, min_area=100):
+    # Original per-class DFS implementation, kept for equivalence checks in benchmark.py
     h, w = segmentation.shape
     cleaned = np.zeros_like(segmentation)
-    label_id = 1
     for class_id in np.unique(segmentation):
         if class_id == 5:  # Skip the Unlabeled class
             continue
@@ -120,88 +601,744 @@ class ConnectedComponent:
         self.size = len(coords)
 
 def colorize_segmentation(segmentation):
-    colored_seg = np.zeros((segmentation.shape[0], segmentation.shape[1], 3), dtype=np.uint8)
-    for class_id, (_, color) in CLASS_INFO.items():
-        colored_seg[segmentation == class_id] = color
-    return colored_seg
+    # One palette lookup for all classes
+    return get_palette()[segmentation]
+
+def encode_paletted_png(segmentation):
+    # Labels are written as a paletted PNG, so no RGB copy of the mask is ever made
+    image = Image.fromarray(segmentation.astype(np.uint8, copy=False))
+    image.putpalette(get_palette().tobytes())
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+def count_classes(segmentation):
+    return np.bincount(segmentation.ravel(), minlength=len(CLASS_INFO))
 
 def save_to_s3(content, bucket, key, content_type):
-    s3 = boto3.client('s3')
-    s3.put_object(Bucket=bucket, Key=key, Body=content, ContentType=content_type)
+    s3_client.put_object(Bucket=bucket, Key=key, Body=content, ContentType=content_type)
 
-def lambda_handler(event, context):
-    try:
-        # Configuration
-        model_bucket = 'dutta007bucket'
-        model_key = 'model.tflite'
-        input_bucket = event['bucket']
-        input_key = event['key']
-        output_bucket = event['output_bucket']
-        output_key_prefix = event['output_key']
+def get_model_cache_path(etag):
+    return os.path.join(MODEL_CACHE_DIR, etag.strip('"') + '.tflite')
+
+def read_model_from_disk_cache(etag):
+    path = get_model_cache_path(etag)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        return f.read()
+
+def write_model_to_disk_cache(etag, content):
+    os.makedirs(MODEL_CACHE_DIR, exist_ok=True)
+    path = get_model_cache_path(etag)
+    # Write to a temporary name first so a concurrent reader never sees a partial model
+    fd, tmp_path = tempfile.mkstemp(dir=MODEL_CACHE_DIR)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+def get_model_content(bucket, key, revalidate=None):
+    # Returns (etag, content, source), preferring memory, then /tmp, then S3. A cached model is
+    # revalidated with a conditional HEAD once it is older than MODEL_REVALIDATE_SECONDS,
+    # or on every call with revalidate=True; revalidate=False never checks S3.
+    now = time.time()
+    cached = _model_cache.get((bucket, key))
+    if cached:
+        if revalidate is False or (revalidate is None and now - cached['checked_at'] < MODEL_REVALIDATE_SECONDS):
+            return cached['etag'], cached['content'], 'memory'
+        try:
+            etag = s3_client.head_object(Bucket=bucket, Key=key, IfNoneMatch=cached['etag'])['ETag']
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('304', 'NotModified'):
+                raise
+            cached['checked_at'] = now
+            return cached['etag'], cached['content'], 'memory'
+    else:
+        etag = s3_client.head_object(Bucket=bucket, Key=key)['ETag']
+
+    content = read_model_from_disk_cache(etag)
+    source = 'disk'
+    if content is None:
+        content = s3_client.get_object(Bucket=bucket, Key=key, IfMatch=etag)['Body'].read()
+        write_model_to_disk_cache(etag, content)
+        source = 's3'
+    _model_cache[(bucket, key)] = {'etag': etag, 'content': content, 'checked_at': now}
+    return etag, content, source
+
+def get_inference_engine(bucket, key, batch_size=INFERENCE_BATCH_SIZE, num_threads=INFERENCE_NUM_THREADS,
+                         num_interpreters=INFERENCE_NUM_INTERPRETERS, revalidate=None):
+    start = time.perf_counter()
+    etag, model_content, source = get_model_content(bucket, key, revalidate)
+    cache_key = (bucket, key, etag, batch_size, num_threads, num_interpreters)
+    engine = _engine_cache.get(cache_key)
+    if engine is None:
+        # Drop engines built from an older version of this model
+        for stale_key in [k for k in _engine_cache if k[:2] == (bucket, key) and k[2] != etag]:
+            del _engine_cache[stale_key]
+        engine = InferenceEngine(model_content, batch_size, num_threads, num_interpreters)
+        _engine_cache[cache_key] = engine
+        start_type = 'Cold'
+    else:
+        start_type = 'Warm'
+    print(f"{start_type} start: model {key} {etag} from {source} ready in {time.perf_counter() - start:.3f}s")
+    return engine
 
-        # Download and load the model
-        model_content = download_from_s3(model_bucket, model_key)
-        interpreter = load_tflite_model(model_content)
+def get_model_key(precision=None):
+    precision = precision or MODEL_PRECISION
+    if precision not in MODEL_KEYS:
+        raise ValueError(f"Unknown model precision {precision}, expected one of {sorted(MODEL_KEYS)}")
+    return MODEL_KEYS[precision]
 
-        # Download and preprocess the image
-        image_content = download_from_s3(input_bucket, input_key)
-        image = Image.open(io.BytesIO(image_content))
+def get_model_version(bucket, key, revalidate=None):
+    # ETag of the model, from the warm cache while it is fresh, without loading the model.
+    # revalidate works as in get_model_content.
+    cached = _model_cache.get((bucket, key))
+    fresh = cached and time.time() - cached['checked_at'] < MODEL_REVALIDATE_SECONDS
+    if cached and (revalidate is False or (revalidate is None and fresh)):
+        return cached['etag']
+    return s3_client.head_object(Bucket=bucket, Key=key)['ETag']
+
+def segmentation_variant(model_etag, event):
+    # Segmentations are only interchangeable for the same model and window/cleanup settings
+    settings = [model_etag.strip('"'), event.get('stride'), event.get('overlap', 0), event.get('min_area', 100),
+                event.get('skip_empty', SKIP_EMPTY_TILES)]
+    return hashlib.sha1(json.dumps(settings).encode('utf-8')).hexdigest()[:12]
+
+def load_image(image_content, skip_empty=True):
+    # Returns the RGB image and its valid-pixel mask (None when not screening or all valid). 8-bit
+    # images stay uint8 and are normalized patch by patch in the engine; others become 0-1 floats.
+    image = Image.open(io.BytesIO(image_content))
+    full_image = np.asarray(image)
+    if full_image.dtype != np.uint8:
         full_image = preprocess_image(image)
+    full_image = full_image[..., :3]  # An alpha band only feeds the mask
+    return full_image, read_valid_mask(image_content) if skip_empty else None
+
+def predict_stored_tiles(patches, padded_shape, original_shape, mask, engine, tile_entry, skip_empty=True,
+                         top_k=TILE_STORE_TOP_K):
+    # Runs only the tiles missing from the tile store entry and adds them to it. An empty
+    # entry is filled in from scratch; tiles are always screened so later requests with
+    # either skip_empty setting can be served from it.
+    if not tile_entry:
+        tile_entry.update(new_tile_entry(original_shape, engine.patch_size,
+                                         screen_patches(patches, padded_shape, mask, engine.patch_size)))
+    missing = missing_tiles(tile_entry, skip_empty)
+    if missing:
+        batch = [patches[i] for i in missing]
+        if top_k:
+            logits = engine.predict_logits(batch)
+            predictions = np.argmax(logits, axis=-1).astype(np.uint8)
+            classes, scores = top_k_scores(logits, top_k)
+            tile_entry['top_k'].update(zip(missing, zip(classes, scores)))
+        else:
+            predictions = engine.predict_patches(batch)
+        tile_entry['labels'].update(zip(missing, predictions))
+    skipped = int(tile_entry['empty'].sum()) if skip_empty else 0
+    tile_stats = {'tiles': len(patches), 'skipped_tiles': skipped, 'computed_tiles': len(missing),
+                  'cached_tiles': len(patches) - skipped - len(missing)}
+    return tile_labels(tile_entry, skip_empty, UNLABELED_CLASS), tile_stats
+
+def segment_from_tile_entry(tile_entry, min_area=100, skip_empty=True):
+    # Cleanup, colours and counts from stored tiles alone, without the image or the model
+    h, w = tile_entry['shape']
+    ph, pw = tile_entry['patch_size']
+    padded_shape = (math.ceil(h / ph) * ph, math.ceil(w / pw) * pw, 3)
+    full_segmentation = stitch_patches(tile_labels(tile_entry, skip_empty, UNLABELED_CLASS), padded_shape, (h, w),
+                                       (ph, pw))
+    skipped = int(tile_entry['empty'].sum()) if skip_empty else 0
+    tile_stats = {'tiles': len(tile_entry['empty']), 'skipped_tiles': skipped, 'computed_tiles': 0,
+                  'cached_tiles': len(tile_entry['empty']) - skipped}
+    cleaned_segmentation = clean_segmentation(full_segmentation, min_area)
+    return encode_paletted_png(cleaned_segmentation), count_classes(cleaned_segmentation), tile_stats
+
+def segment_in_memory(image_content, engine, stride=None, min_area=100, skip_empty=True, tile_entry=None):
+    # tile_entry, when given, is a tile store entry (possibly empty) that is used and updated
+    full_image, mask = load_image(image_content, skip_empty or tile_entry is not None)
+    tile_stats = {}
 
+    # Overlapping windows are used when the stride is smaller than the patch
+    ph, pw = engine.patch_size
+    if stride is not None and (stride[0] < ph or stride[1] < pw):
+        full_segmentation = sliding_window_segmentation(full_image, engine, stride, mask=mask,
+                                                        skip_empty=skip_empty, tile_stats=tile_stats)
+    else:
         # Pad the image and create patches
-        padded_image = pad_image(full_image)
-        patches, original_height, original_width = create_patches(padded_image)
+        padded_image = pad_image(full_image, engine.patch_size)
+        patches, original_height, original_width = create_patches(padded_image, engine.patch_size)
 
         # Debug statements
         print(f"Original height: {original_height}, Original width: {original_width}")
         print(f"Padded shape: {padded_image.shape}")
         print(f"Number of patches: {len(patches)}")
 
-        # Predict segmentation mask for each patch
-        segmented_patches = []
-        for i, patch in enumerate(patches):
-            prediction = predict(np.expand_dims(patch, axis=0), interpreter)
-            segmented_patches.append(prediction)
-            print(f"Patch {i}: Prediction shape: {prediction.shape}")
+        # Predict segmentation masks for all non-empty patches in batches
+        if tile_entry is not None:
+            segmented_patches, stored_stats = predict_stored_tiles(patches, padded_image.shape, full_image.shape[:2],
+                                                                   mask, engine, tile_entry, skip_empty)
+            tile_stats.update(stored_stats)
+        else:
+            empty = screen_patches(patches, padded_image.shape, mask, engine.patch_size) if skip_empty else None
+            segmented_patches = engine.predict_patches(patches, empty)
+            tile_stats.update(tiles=len(patches), skipped_tiles=0 if empty is None else int(empty.sum()))
+        print(f"Predicted {len(segmented_patches)} patches with batch size {engine.batch_size}, "
+              f"{tile_stats['skipped_tiles']} skipped as empty")
 
         # Stitch the segmented patches back together
-        full_segmentation = stitch_patches(segmented_patches, padded_image.shape, full_image.shape)
-        print(f"Full segmentation shape: {full_segmentation.shape}")
+        full_segmentation = stitch_patches(segmented_patches, padded_image.shape, full_image.shape, engine.patch_size)
+    print(f"Full segmentation shape: {full_segmentation.shape}")
+
+    # Clean up the segmentation
+    cleaned_segmentation = clean_segmentation(full_segmentation, min_area)
+
+    # Colorize the cleaned segmentation and count pixels per class
+    return encode_paletted_png(cleaned_segmentation), count_classes(cleaned_segmentation), tile_stats
+
+def vectorize_segmentation(png_content, bounds, vector_format=VECTOR_FORMAT, tolerance=VECTOR_SIMPLIFY_TOLERANCE):
+    # Class polygons of the cleaned PNG, georeferenced with its _bounds.json box (EPSG:4326)
+    labels = np.asarray(Image.open(io.BytesIO(png_content)))
+    transform = from_bounds(bounds['left'], bounds['bottom'], bounds['right'], bounds['top'],
+                            labels.shape[1], labels.shape[0])
+    class_names = {class_id: name for class_id, (name, _) in CLASS_INFO.items()}
+    buffer = io.BytesIO()
+    start = time.perf_counter()
+    count = write_vectors(polygonize_labels(labels, transform, tolerance, (UNLABELED_CLASS,)), buffer, vector_format,
+                          class_names)
+    elapsed = time.perf_counter() - start
+    print(f"Vectorized {count} polygons to {vector_format} in {elapsed:.3f}s ({len(buffer.getvalue())} bytes)")
+    return buffer.getvalue(), count
+
+def get_vector_key(output_key_prefix, input_key, vector_format):
+    file_name = os.path.splitext(os.path.basename(input_key))[0]
+    return f"{output_key_prefix}{file_name}_classified.{vector_format}"
+
+def get_output_keys(output_key_prefix, input_key):
+    # Classified PNG, bounds and stats keys for one input image
+    file_name = os.path.splitext(os.path.basename(input_key))[0]
+    return (f"{output_key_prefix}{file_name}_classified.png",
+            f"{output_key_prefix}{file_name}_bounds.json",
+            f"{output_key_prefix}{file_name}_stats.csv")
+
+def segmentation_targets(variant, output_key, bounds_key, stats_key):
+    return {
+        f'segmentation-{variant}': output_key,
+        f'segmentation-bounds-{variant}': bounds_key,
+        f'segmentation-stats-{variant}': stats_key
+    }
+
+def build_stats_csv(class_counts):
+    # Create a simple CSV with class statistics
+    class_stats = pd.DataFrame([
+        {'class': CLASS_INFO[i][0], 'pixel_count': class_counts[i]}
+        for i in range(len(CLASS_INFO))
+    ])
+    csv_buffer = io.StringIO()
+    class_stats.to_csv(csv_buffer, index=False)
+    return csv_buffer.getvalue()
+
+def list_batch_keys(bucket, event):
+    # An explicit list of keys, or every GeoTIFF under a prefix
+    if event.get('keys'):
+        return list(event['keys'])
+    keys = []
+    for page in s3_client.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=event['prefix']):
+        keys += [obj['Key'] for obj in page.get('Contents', []) if obj['Key'].lower().endswith(('.tif', '.tiff'))]
+    return keys
+
+def prefetch_images(bucket, keys, depth=BATCH_PREFETCH_IMAGES):
+    # Yields (key, image future, bounds future) while up to `depth` further images download
+    pending = deque()
+    for key in keys:
+        file_name = os.path.splitext(os.path.basename(key))[0]
+        pending.append((key, submit_transfer(download_from_s3, bucket, key),
+                        submit_transfer(download_from_s3, bucket, f"png-export/{file_name}_bounds.json")))
+        if len(pending) > depth:
+            yield pending.popleft()
+    while pending:
+        yield pending.popleft()
+
+def distribute_predictions(waiting, predictions):
+    # Hands a run of predictions to the waiting images in order and yields the completed ones
+    offset = 0
+    for entry in waiting:
+        if offset == len(predictions):
+            break
+        take = min(entry[1], len(predictions) - offset)
+        if take:
+            entry[2].append(predictions[offset:offset + take])
+            entry[1] -= take
+            offset += take
+    while waiting and waiting[0][1] == 0:
+        item, _, chunks = waiting.popleft()
+        yield item, np.concatenate(chunks) if chunks else None
+
+def predict_across_images(prepared, engine):
+    # Runs the patches of consecutive images through shared inference batches, so only the
+    # last batch of the whole run can be partly empty. Yields (item, predictions) in order.
+    waiting = deque()  # [item, patches still to predict, prediction chunks]
+    buffer = []
+    for item, patches in prepared:
+        waiting.append([item, len(patches), []])
+        buffer.extend(patches)
+        full = len(buffer) // engine.batch_size * engine.batch_size
+        if full:
+            predictions = engine.predict_patches(buffer[:full])
+            buffer = buffer[full:]
+            yield from distribute_predictions(waiting, predictions)
+    # Images whose patches were all skipped may still be waiting when the buffer is empty
+    yield from distribute_predictions(waiting, engine.predict_patches(buffer) if buffer else [])
+
+def save_segmentation(png_content, class_counts, bounds_future, output_bucket, output_key, bounds_key, stats_key):
+    # Runs on the transfer pool, so the three objects go up one after another
+    save_to_s3(png_content, output_bucket, output_key, 'image/png')
+    save_to_s3(bounds_future.result(), output_bucket, bounds_key, 'application/json')
+    save_to_s3(build_stats_csv(class_counts), output_bucket, stats_key, 'text/csv')
+
+def write_manifest(manifest, output_bucket, manifest_key):
+    save_to_s3(json.dumps(manifest), output_bucket, manifest_key, 'application/json')
 
-        # Clean up the segmentation
-        cleaned_segmentation = clean_segmentation(full_segmentation)
+def batch_lambda_handler(event):
+    # Segments many images with one model load: downloads run ahead of inference, patches of
+    # neighbouring images share inference batches and results upload in the background.
+    # Per-image status is written to a manifest at the start and end of the run, also when the
+    # run fails.
+    input_bucket = event['bucket']
+    output_bucket = event['output_bucket']
+    output_key_prefix = event['output_key']
+    batch_id = event.get('batch_id') or time.strftime('%Y%m%d-%H%M%S')
+    manifest_key = f"{output_key_prefix}{BATCH_MANIFEST_PREFIX}{batch_id}_manifest.json"
+    min_area = event.get('min_area', 100)
+    dedup = event.get('dedup', PRODUCT_DEDUP)
+    skip_empty = event.get('skip_empty', SKIP_EMPTY_TILES)
+    model_key = get_model_key(event.get('precision'))
 
-        # Colorize the cleaned segmentation
-        colored_segmentation = colorize_segmentation(cleaned_segmentation)
+    keys = list_batch_keys(input_bucket, event)
+    manifest = {
+        'batch_id': batch_id,
+        'status': 'running',
+        'started_at': time.time(),
+        'finished_at': None,
+        'images': {key: {'status': 'queued'} for key in keys}
+    }
+    for key in keys:
+        output_key, bounds_key, stats_key = get_output_keys(output_key_prefix, key)
+        manifest['images'][key].update(colored_image_key=output_key, bounds_key=bounds_key, stats_key=stats_key)
+    write_manifest(manifest, output_bucket, manifest_key)
+
+    uploads = []
+    try:
+        start = time.perf_counter()
+        engine = get_inference_engine(
+            MODEL_BUCKET,
+            model_key,
+            batch_size=event.get('batch_size', INFERENCE_BATCH_SIZE),
+            num_threads=event.get('num_threads', INFERENCE_NUM_THREADS),
+            num_interpreters=event.get('num_interpreters', INFERENCE_NUM_INTERPRETERS),
+            revalidate=event.get('revalidate_model')
+        )
+        manifest['model_load_seconds'] = round(time.perf_counter() - start, 3)
+        variant = segmentation_variant(get_model_version(MODEL_BUCKET, model_key), event) if dedup else None
+
+        # Already segmented images are copied before anything is downloaded
+        to_segment = []
+        for key in keys:
+            image = manifest['images'][key]
+            try:
+                if dedup:
+                    digest = get_source_digest(s3_client, input_bucket, key)
+                    image['digest'] = digest
+                    if restore_products(s3_client, output_bucket, digest, segmentation_targets(
+                            variant, image['colored_image_key'], image['bounds_key'], image['stats_key'])):
+                        manifest['images'][key]['status'] = 'deduplicated'
+                        continue
+            except Exception as e:
+                manifest['images'][key].update(status='failed', error=str(e))
+                continue
+            to_segment.append(key)
+
+        ph, pw = engine.patch_size
+        overlap = event.get('overlap', 0)
+        stride = event.get('stride', max(ph, pw) - overlap)
+
+        def prepare(downloads):
+            # Decodes prefetched images into patches; only non-empty patches go to inference.
+            # Images that fail are recorded and skipped.
+            for key, image_future, bounds_future in downloads:
+                try:
+                    full_image, mask = load_image(image_future.result(), skip_empty)
+                    padded_image = pad_image(full_image, engine.patch_size)
+                    patches, _, _ = create_patches(padded_image, engine.patch_size)
+                    empty = (screen_patches(patches, padded_image.shape, mask, engine.patch_size) if skip_empty
+                             else np.zeros(len(patches), dtype=bool))
+                except Exception as e:
+                    manifest['images'][key].update(status='failed', error=str(e))
+                    continue
+                manifest['images'][key].update(tiles=len(patches), skipped_tiles=int(empty.sum()))
+                yield (key, bounds_future, padded_image.shape, full_image.shape, empty), [
+                    patch for patch, is_empty in zip(patches, empty) if not is_empty]
+
+        def segmented(downloads):
+            # Overlapping windows blend within one image, so they are segmented image by image
+            if stride < ph or stride < pw:
+                for key, image_future, bounds_future in downloads:
+                    try:
+                        png_content, class_counts, tile_stats = segment_in_memory(
+                            image_future.result(), engine, (stride, stride), min_area, skip_empty)
+                        manifest['images'][key].update(tile_stats)
+                        yield key, bounds_future, (png_content, class_counts)
+                    except Exception as e:
+                        manifest['images'][key].update(status='failed', error=str(e))
+                return
+            for (key, bounds_future, padded_shape, image_shape, empty), predictions in predict_across_images(prepare(downloads), engine):
+                try:
+                    predictions = expand_predictions(predictions, empty, engine.patch_size)
+                    segmentation = clean_segmentation(stitch_patches(predictions, padded_shape, image_shape, engine.patch_size), min_area)
+                    yield key, bounds_future, (encode_paletted_png(segmentation), count_classes(segmentation))
+                except Exception as e:
+                    manifest['images'][key].update(status='failed', error=str(e))
+
+        for key, bounds_future, (png_content, class_counts) in segmented(prefetch_images(input_bucket, to_segment)):
+            image = manifest['images'][key]
+            image['class_counts'] = {CLASS_INFO[i][0]: int(class_counts[i]) for i in range(len(CLASS_INFO))}
+            uploads.append((key, submit_transfer(save_segmentation, png_content, class_counts, bounds_future, output_bucket,
+                                                 image['colored_image_key'], image['bounds_key'], image['stats_key'])))
+    except Exception as e:
+        # The model load or the inference shared by the batch failed: the batch fails, and so
+        # does every image it had not finished
+        print(f"Batch {batch_id} failed: {str(e)}")
+        manifest.update(status='failed', error=str(e))
+    finally:
+        for key, future in uploads:
+            image = manifest['images'][key]
+            try:
+                future.result()
+            except Exception as e:
+                image.update(status='failed', error=str(e))
+                continue
+            image['status'] = 'succeeded'
+            if dedup:
+                try:
+                    record_products(s3_client, output_bucket, image['digest'], segmentation_targets(
+                        variant, image['colored_image_key'], image['bounds_key'], image['stats_key']))
+                except Exception as e:
+                    print(f"Could not index the products of {key}: {str(e)}")
+        for image in manifest['images'].values():
+            if image['status'] == 'queued':
+                image.update(status='failed', error=manifest.get('error', 'Batch did not finish'))
+
+        statuses = [image['status'] for image in manifest['images'].values()]
+        manifest.update(status='completed' if manifest['status'] == 'running' else manifest['status'],
+                        finished_at=time.time(), counts={status: statuses.count(status) for status in set(statuses)})
+        write_manifest(manifest, output_bucket, manifest_key)
+    print(f"Batch {batch_id}: {manifest['counts']} in {manifest['finished_at'] - manifest['started_at']:.1f}s")
+    notify_completion(*[
+        completion_event('segmentation', image['colored_image_key'], 'failed' if image['status'] == 'failed' else 'succeeded',
+                         batch_id=batch_id, error=image.get('error'))
+        for image in manifest['images'].values() if 'colored_image_key' in image])
+
+    if manifest['status'] == 'failed':
+        return {
+            'statusCode': 500,
+            'body': json.dumps({
+                'error': manifest['error'],
+                'output_bucket': output_bucket,
+                'batch_id': batch_id,
+                'manifest_key': manifest_key,
+                'counts': manifest['counts']
+            })
+        }
+    return {
+        'statusCode': 200,
+        'body': json.dumps({
+            'message': 'Batch segmentation completed',
+            'output_bucket': output_bucket,
+            'batch_id': batch_id,
+            'manifest_key': manifest_key,
+            'counts': manifest['counts']
+        })
+    }
+
+@contextmanager
+def open_source_raster(bucket, key):
+    # Opens the upload in place on S3, so only the header and the blocks that are read get fetched
+    with rasterio.Env(AWSSession(boto3.Session()), GDAL_DISABLE_READDIR_ON_OPEN='EMPTY_DIR'), \
+            rasterio.open(f'/vsis3/{bucket}/{key}') as src:
+        yield src
+
+def get_roi_tiles(src, bbox, patch_size):
+    # The pixel window of an EPSG:4326 (west, south, east, north) bbox, and the rows/cols of the
+    # create_patches tile grid that overlap it. Raises WindowError when the bbox misses the image.
+    left, bottom, right, top = transform_bounds('EPSG:4326', src.crs, *bbox)
+    window = window_from_bounds(left, bottom, right, top, src.transform)
+    col_off, row_off = math.floor(window.col_off), math.floor(window.row_off)
+    window = Window(col_off, row_off, math.ceil(window.col_off + window.width) - col_off,
+                    math.ceil(window.row_off + window.height) - row_off).intersection(Window(0, 0, src.width, src.height))
+    ph, pw = patch_size
+    rows = range(window.row_off // ph, math.ceil((window.row_off + window.height) / ph))
+    cols = range(window.col_off // pw, math.ceil((window.col_off + window.width) / pw))
+    return window, rows, cols
+
+def read_tile_row(src, row, cols, patch_size, with_mask):
+    # One boundless read per tile row; tiles past the image edge are zero-padded like pad_image
+    ph, pw = patch_size
+    window = Window(cols[0] * pw, row * ph, len(cols) * pw, ph)
+    band = np.moveaxis(src.read(indexes=[1, 2, 3], window=window, boundless=True, fill_value=0), 0, -1)
+    if band.dtype != np.uint8:
+        band = band.astype(np.float32) / 255.0
+    mask = None
+    if with_mask:
+        mask = src.read_masks(1, window=window, boundless=True) > 0
+        for index in src.indexes[1:]:
+            mask |= src.read_masks(index, window=window, boundless=True) > 0
+    tiles = [band[:, k * pw:(k + 1) * pw] for k in range(len(cols))]
+    masks = [None if mask is None else mask[:, k * pw:(k + 1) * pw] for k in range(len(cols))]
+    return tiles, masks
+
+def segment_roi(src, engine, bbox, labels, done, skip_empty=True):
+    # Infers the tiles overlapping bbox that are not in `done` and writes their labels into the
+    # full-image `labels` raster. Returns the bbox window and tile counts.
+    ph, pw = engine.patch_size
+    window, rows, cols = get_roi_tiles(src, bbox, engine.patch_size)
+    stats = {'tiles': len(rows) * len(cols), 'computed_tiles': 0, 'reused_tiles': 0, 'skipped_tiles': 0}
+    with_mask = skip_empty and has_invalid_pixels(src)
+    for row in rows:
+        missing = [col for col in cols if (row, col) not in done]
+        stats['reused_tiles'] += len(cols) - len(missing)
+        if not missing:
+            continue
+        # Missing tiles in a row are read as one contiguous span
+        span = range(missing[0], missing[-1] + 1)
+        tiles, masks = read_tile_row(src, row, span, engine.patch_size, with_mask)
+        picked = [col - span[0] for col in missing]
+        tiles = [tiles[k] for k in picked]
+        empty = (np.array([is_empty_tile(tiles[k], masks[picked[k]]) for k in range(len(tiles))], dtype=bool)
+                 if skip_empty else None)
+        predictions = engine.predict_patches(tiles, empty)
+        for col, prediction in zip(missing, predictions):
+            tile_labels = labels[row * ph:(row + 1) * ph, col * pw:(col + 1) * pw]
+            tile_labels[:] = prediction[:tile_labels.shape[0], :tile_labels.shape[1]]
+            done.add((row, col))
+        stats['computed_tiles'] += len(missing)
+        stats['skipped_tiles'] += 0 if empty is None else int(empty.sum())
+    return window, stats
+
+def get_roi_store_keys(output_key_prefix, file_name):
+    store = f"{output_key_prefix}{ROI_STORE_PREFIX}{file_name}"
+    return f"{store}_labels.tif", f"{store}_labels.json"
+
+def load_label_store(bucket, labels_key, state_key, shape, variant):
+    # (labels, done tiles) of an image's persistent label raster. A raster made with another
+    # model or other settings is discarded, so only the affected image starts over.
+    try:
+        state = json.loads(download_from_s3(bucket, state_key))
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('404', 'NoSuchKey'):
+            raise
+        state = None
+    if state is None or state['variant'] != variant or tuple(state['shape']) != tuple(shape):
+        return np.full(shape, ROI_NO_LABEL, dtype=np.uint8), set()
+    with MemoryFile(download_from_s3(bucket, labels_key)) as memfile, memfile.open() as dataset:
+        labels = dataset.read(1)
+    return labels, {tuple(tile) for tile in state['tiles']}
+
+def save_label_store(bucket, labels_key, state_key, src, labels, done, variant):
+    profile = {'driver': 'GTiff', 'dtype': 'uint8', 'count': 1, 'height': labels.shape[0], 'width': labels.shape[1],
+               'crs': src.crs, 'transform': src.transform, 'nodata': ROI_NO_LABEL,
+               'tiled': True, 'blockxsize': 256, 'blockysize': 256, 'compress': 'DEFLATE'}
+    with MemoryFile() as memfile:
+        with memfile.open(**profile) as dataset:
+            dataset.write(labels, 1)
+        raster = memfile.read()
+    state = {'variant': variant, 'shape': list(labels.shape), 'tiles': sorted(done), 'updated_at': time.time()}
+    run_concurrently(
+        (save_to_s3, raster, bucket, labels_key, 'image/tiff'),
+        (save_to_s3, json.dumps(state), bucket, state_key, 'application/json')
+    )
+
+def encode_roi_labels(labels, min_area):
+    # Cleans computed labels; pixels that were never computed are shown as Unlabeled
+    cleaned = clean_segmentation(labels, min_area)
+    cleaned[labels == ROI_NO_LABEL] = UNLABELED_CLASS
+    return encode_paletted_png(cleaned)
+
+def roi_lambda_handler(event):
+    # Segments only the tiles of the input that overlap event['bbox'] (EPSG:4326, like the saved
+    # _bounds.json), merging them into the image's persistent label raster. Tiles computed by
+    # earlier requests are reused. The ROI crop and the merged full mask are both written.
+    input_bucket = event['bucket']
+    input_key = event['key']
+    output_bucket = event['output_bucket']
+    output_key_prefix = event['output_key']
+    bbox = [float(v) for v in event['bbox']]
+    min_area = event.get('min_area', 100)
+    skip_empty = event.get('skip_empty', SKIP_EMPTY_TILES)
+    file_name = os.path.splitext(os.path.basename(input_key))[0]
+    # The merged mask gets its own key so indexed full segmentations at _classified.png stay intact
+    roi_key = f"{output_key_prefix}{file_name}_roi_classified.png"
+    roi_bounds_key = f"{output_key_prefix}{file_name}_roi_bounds.json"
+    merged_key = f"{output_key_prefix}{file_name}_merged_classified.png"
+    merged_bounds_key = f"{output_key_prefix}{file_name}_merged_bounds.json"
+    labels_key, state_key = get_roi_store_keys(output_key_prefix, file_name)
+
+    model_key = get_model_key(event.get('precision'))
+    engine = get_inference_engine(
+        MODEL_BUCKET,
+        model_key,
+        batch_size=event.get('batch_size', INFERENCE_BATCH_SIZE),
+        num_threads=event.get('num_threads', INFERENCE_NUM_THREADS),
+        num_interpreters=event.get('num_interpreters', INFERENCE_NUM_INTERPRETERS),
+        revalidate=event.get('revalidate_model')
+    )
+    variant = segmentation_variant(get_model_version(MODEL_BUCKET, model_key), dict(event, stride=None, overlap=0))
+
+    with open_source_raster(input_bucket, input_key) as src:
+        labels, done = load_label_store(output_bucket, labels_key, state_key, (src.height, src.width), variant)
+        try:
+            window, stats = segment_roi(src, engine, bbox, labels, done, skip_empty)
+        except WindowError:
+            return {'statusCode': 400, 'body': json.dumps({'error': f'Bounding box {bbox} does not overlap {input_key}'})}
+        roi_bounds = transform_bounds(src.crs, 'EPSG:4326', *window_bounds(window, src.transform))
+        if stats['computed_tiles']:
+            save_label_store(output_bucket, labels_key, state_key, src, labels, done, variant)
+    print(f"ROI {bbox} of {input_key}: {stats}")
+
+    roi_labels = labels[window.row_off:window.row_off + window.height, window.col_off:window.col_off + window.width]
+    run_concurrently(
+        (save_to_s3, encode_roi_labels(roi_labels, min_area), output_bucket, roi_key, 'image/png'),
+        (save_to_s3, json.dumps(dict(zip(('left', 'bottom', 'right', 'top'), roi_bounds))), output_bucket,
+         roi_bounds_key, 'application/json'),
+        (save_to_s3, encode_roi_labels(labels, min_area), output_bucket, merged_key, 'image/png'),
+        (copy_object, s3_client, output_bucket, f"png-export/{file_name}_bounds.json", merged_bounds_key)
+    )
+    notify_completion(completion_event('segmentation', merged_key, roi_image_key=roi_key,
+                                       computed_tiles=stats['computed_tiles']))
+
+    return {
+        'statusCode': 200,
+        'body': json.dumps(dict(stats, **{
+            'message': 'Region of interest segmented and merged into the label raster',
+            'output_bucket': output_bucket,
+            'roi_image_key': roi_key,
+            'roi_bounds_key': roi_bounds_key,
+            'merged_image_key': merged_key,
+            'labels_key': labels_key
+        }))
+    }
+
+def lambda_handler(event, context):
+    try:
+        if 'keys' in event or 'prefix' in event:
+            return batch_lambda_handler(event)
+        if event.get('bbox'):
+            return roi_lambda_handler(event)
+
+        # Configuration
+        input_bucket = event['bucket']
+        input_key = event['key']
+        output_bucket = event['output_bucket']
+        output_key_prefix = event['output_key']
 
         # Define the new filename
         file_base = os.path.basename(input_key)
         file_name, file_ext = os.path.splitext(file_base)
-        output_key = f"{output_key_prefix}{file_name}_classified.png"
-
-        # Save the colored segmentation to S3
-        colored_seg_image = Image.fromarray(colored_segmentation)
-        colored_seg_buffer = io.BytesIO()
-        colored_seg_image.save(colored_seg_buffer, format="PNG")
-        colored_seg_buffer.seek(0)
-        save_to_s3(colored_seg_buffer.getvalue(), output_bucket, output_key, 'image/png')
-
-        # Fetch bounds from png-export
-        bounds_key = f"png-export/{file_name}_bounds.json"
-        bounds_content = download_from_s3(input_bucket, bounds_key)
-        bounds = json.loads(bounds_content)
-
-        # Save the bounds JSON file to segment-upload folder
-        save_to_s3(json.dumps(bounds), output_bucket, f"{output_key_prefix}{file_name}_bounds.json", 'application/json')
-
-        # Create a simple CSV with class statistics
-        class_stats = pd.DataFrame([
-            {'class': CLASS_INFO[i][0], 'pixel_count': np.sum(cleaned_segmentation == i)}
-            for i in range(len(CLASS_INFO))
-        ])
-        csv_buffer = io.StringIO()
-        class_stats.to_csv(csv_buffer, index=False)
-        save_to_s3(csv_buffer.getvalue(), output_bucket, f"{output_key_prefix}{file_name}_stats.csv", 'text/csv')
+        output_key, bounds_key, stats_key = get_output_keys(output_key_prefix, input_key)
+        model_key = get_model_key(event.get('precision'))
+
+        # Optional class polygons next to the PNG, for clients that load features in view
+        vectorize = event.get('vectorize', VECTORIZE)
+        vector_format = event.get('vector_format', VECTOR_FORMAT)
+        simplify_tolerance = event.get('simplify_tolerance', VECTOR_SIMPLIFY_TOLERANCE)
+        if vectorize and vector_format not in VECTOR_CONTENT_TYPES:
+            raise ValueError(f"Unknown vector format {vector_format}, expected one of {sorted(VECTOR_CONTENT_TYPES)}")
+        vector_key = get_vector_key(output_key_prefix, input_key, vector_format) if vectorize else None
+
+        # A re-upload of an already segmented file only needs its products copied
+        dedup = event.get('dedup', PRODUCT_DEDUP)
+        if dedup:
+            digest = get_source_digest(s3_client, input_bucket, input_key)
+            variant = segmentation_variant(get_model_version(MODEL_BUCKET, model_key, event.get('revalidate_model')), event)
+            targets = segmentation_targets(variant, output_key, bounds_key, stats_key)
+            if vectorize:
+                targets[f'segmentation-vectors-{variant}-{vector_format}-{simplify_tolerance}'] = vector_key
+            if restore_products(s3_client, output_bucket, digest, targets):
+                print(f"Reused segmentation {variant} of {digest} for {input_key}")
+                notify_completion(completion_event('segmentation', output_key, deduplicated=True))
+                return {
+                    'statusCode': 200,
+                    'body': json.dumps({
+                        'message': 'Segmentation reused, colored image and statistics copied in S3',
+                        'output_bucket': output_bucket,
+                        'colored_image_key': output_key,
+                        'bounds_key': f"{output_key_prefix}{file_name}_classified_bounds.json",
+                        'stats_key': stats_key,
+                        'vector_key': vector_key,
+                        'deduplicated': True
+                    })
+                }
+
+        min_area = event.get('min_area', 100)
+        skip_empty = event.get('skip_empty', SKIP_EMPTY_TILES)
+
+        # Raw tile labels of this image and model are kept in the tile store, so a new min_area
+        # or palette only redoes cleanup. Overlapping windows blend logits and are not stored.
+        tile_entry = None
+        use_tile_store = (event.get('tile_store', TILE_STORE) and not event.get('streaming')
+                          and event.get('stride') is None and not event.get('overlap'))
+        if use_tile_store:
+            tile_digest = digest if dedup else get_source_digest(s3_client, input_bucket, input_key)
+            tile_key = tile_store_key(tile_digest, get_model_version(MODEL_BUCKET, model_key,
+                                                                     event.get('revalidate_model')))
+            tile_entry = load_tile_entry(s3_client, output_bucket, tile_key) or {}
+
+        bounds_future = submit_transfer(download_from_s3, input_bucket, f"png-export/{file_name}_bounds.json")
+        if tile_entry and not missing_tiles(tile_entry, skip_empty):
+            # Every tile is stored: no image download, model load or inference
+            png_content, class_counts, tile_stats = segment_from_tile_entry(tile_entry, min_area, skip_empty)
+            print(f"Segmentation of {input_key} rebuilt from {tile_key}")
+        else:
+            # Fetch the image while the model loads
+            image_future = submit_transfer(download_from_s3, input_bucket, input_key)
+
+            # Load the model, reusing the interpreters of a warm container
+            engine = get_inference_engine(
+                MODEL_BUCKET,
+                model_key,
+                batch_size=event.get('batch_size', INFERENCE_BATCH_SIZE),
+                num_threads=event.get('num_threads', INFERENCE_NUM_THREADS),
+                num_interpreters=event.get('num_interpreters', INFERENCE_NUM_INTERPRETERS),
+                revalidate=event.get('revalidate_model')
+            )
+
+            # Segment the image, streaming row bands if requested
+            image_content = image_future.result()
+            ph, pw = engine.patch_size
+            overlap = event.get('overlap', 0)
+            stride = event.get('stride', max(ph, pw) - overlap)
+            if event.get('streaming'):
+                png_content, class_counts, tile_stats = segment_streaming(image_content, engine, (stride, stride),
+                                                                          min_area, skip_empty=skip_empty)
+            else:
+                png_content, class_counts, tile_stats = segment_in_memory(image_content, engine, (stride, stride),
+                                                                          min_area, skip_empty, tile_entry)
+
+        bounds = json.loads(bounds_future.result())
+
+        # Save the colored segmentation, the bounds (to the segment-upload folder), the stats and any new tiles together
+        uploads = [
+            (save_to_s3, png_content, output_bucket, output_key, 'image/png'),
+            (save_to_s3, json.dumps(bounds), output_bucket, bounds_key, 'application/json'),
+            (save_to_s3, build_stats_csv(class_counts), output_bucket, stats_key, 'text/csv')
+        ]
+        if tile_stats.get('computed_tiles'):
+            uploads.append((save_tile_entry, s3_client, output_bucket, tile_key, tile_entry))
+        polygons = None
+        if vectorize:
+            vector_content, polygons = vectorize_segmentation(png_content, bounds, vector_format, simplify_tolerance)
+            uploads.append((save_to_s3, vector_content, output_bucket, vector_key, VECTOR_CONTENT_TYPES[vector_format]))
+        run_concurrently(*uploads)
+        if dedup:
+            record_products(s3_client, output_bucket, digest, targets)
+        print(f"S3 latency since container start: {json.dumps(s3_latency.snapshot())}")
+        notify_completion(completion_event('segmentation', output_key, vector_key=vector_key, deduplicated=False))
 
         return {
             'statusCode': 200,
@@ -210,11 +1347,21 @@ def lambda_handler(event, context):
                 'output_bucket': output_bucket,
                 'colored_image_key': output_key,
                 'bounds_key': f"{output_key_prefix}{file_name}_classified_bounds.json",
-                'stats_key': f"{output_key_prefix}{file_name}_stats.csv"
+                'stats_key': stats_key,
+                'vector_key': vector_key,
+                'polygons': polygons,
+                'deduplicated': False,
+                'tiles': tile_stats.get('tiles'),
+                'skipped_tiles': tile_stats.get('skipped_tiles'),
+                'cached_tiles': tile_stats.get('cached_tiles', 0)
             })
         }
     except Exception as e:
         print(f"Error: {str(e)}")
+        # Clients waiting on a single image learn of the failure instead of waiting it out
+        if 'key' in event and 'output_key' in event and not event.get('bbox'):
+            notify_completion(completion_event('segmentation', get_output_keys(event['output_key'], event['key'])[0],
+                                               'failed', error=str(e)))
         return {
             'statusCode': 500,
             'body': json.dumps({'error': str(e)})
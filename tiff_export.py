@@ -0,0 +1,83 @@
+import io
+import os
+import numpy as np
+import rasterio
+from PIL import Image
+
+# GeoTIFF export of classified masks. A mask is a single band of class indices plus a colour
+# table, so it is written as one paletted uint8 band instead of four RGBA bands, in Cloud
+# Optimized GeoTIFF layout: internal tiles, nearest-neighbour overviews and the header first,
+# so viewers can fetch only the blocks and zoom level they show.
+
+EXPORT_CODEC = os.environ.get('EXPORT_CODEC', 'DEFLATE').upper()
+EXPORT_PREDICTOR = os.environ.get('EXPORT_PREDICTOR', '0') == '1'
+EXPORT_BLOCK_SIZE = int(os.environ.get('EXPORT_BLOCK_SIZE', '512'))
+EXPORT_CODECS = ('LZW', 'DEFLATE', 'ZSTD')
+PREDICTOR_VALUES = {'1': True, 'true': True, '0': False, 'false': False}
+
+def parse_predictor(value):
+    # Request values: a JSON bool, or the strings EXPORT_PREDICTOR accepts; any other string
+    # (even a truthy one like "false") is rejected instead of silently enabling the predictor
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, str) and value.strip().lower() in PREDICTOR_VALUES:
+        return PREDICTOR_VALUES[value.strip().lower()]
+    raise ValueError(f"predictor must be true or false, got {value!r}")
+
+def export_product(codec=EXPORT_CODEC, predictor=EXPORT_PREDICTOR):
+    # Product index name, so exports with other settings (or the older RGBA TIFFs) are not reused
+    return f"tiff-export-cog-{codec.lower()}{'-predictor' if predictor else ''}"
+
+def export_file_name(png_file_name, codec=EXPORT_CODEC, predictor=EXPORT_PREDICTOR):
+    # Default settings keep the plain name; others get a suffix so exports never overwrite each other
+    base = png_file_name.rsplit('.', 1)[0]
+    if codec == EXPORT_CODEC and predictor == EXPORT_PREDICTOR:
+        return base + '.tif'
+    return f"{base}_{codec.lower()}{'_predictor' if predictor else ''}.tif"
+
+def palettize(rgb):
+    # Class indices and colours of an RGB(A) mask; None when it has more than 256 colours
+    rgb = rgb[..., :3]
+    packed = (rgb[..., 0].astype(np.uint32) << 16) | (rgb[..., 1].astype(np.uint32) << 8) | rgb[..., 2]
+    colors, labels = np.unique(packed, return_inverse=True)
+    if len(colors) > 256:
+        return None
+    palette = np.stack([colors >> 16, (colors >> 8) & 0xFF, colors & 0xFF], axis=1).astype(np.uint8)
+    return labels.reshape(packed.shape).astype(np.uint8), palette
+
+def read_png_labels(png_content):
+    # Label array and (n, 3) palette of a classified PNG. Paletted PNGs, as segmentFunction
+    # writes them, are read as their index array; older RGB masks are palettized.
+    with Image.open(io.BytesIO(png_content)) as img:
+        if img.mode == 'P':
+            labels = np.asarray(img)
+            palette = np.array(img.getpalette(), dtype=np.uint8).reshape(-1, 3)
+            return labels, palette
+        rgb = np.asarray(img.convert('RGB'))
+    palettized = palettize(rgb)
+    if palettized is None:
+        raise ValueError('Classified PNG has more than 256 colours and cannot be written as a paletted GeoTIFF')
+    return palettized
+
+def write_label_cog(path, labels, palette, transform, crs='EPSG:4326', codec=EXPORT_CODEC,
+                    predictor=EXPORT_PREDICTOR, block_size=EXPORT_BLOCK_SIZE):
+    # One uint8 band with a colour table; the array is handed to GDAL as is
+    if codec not in EXPORT_CODECS:
+        raise ValueError(f"Unknown export codec {codec}, expected one of {list(EXPORT_CODECS)}")
+    profile = {
+        'driver': 'COG',
+        'dtype': 'uint8',
+        'count': 1,
+        'height': labels.shape[0],
+        'width': labels.shape[1],
+        'crs': crs,
+        'transform': transform,
+        'compress': codec,
+        'predictor': 'YES' if predictor else 'NO',
+        'blocksize': block_size,
+        'overview_resampling': 'NEAREST',
+        'num_threads': 'ALL_CPUS'
+    }
+    with rasterio.open(path, 'w', **profile) as dst:
+        dst.write(labels, 1)
+        dst.write_colormap(1, {index: (*color, 255) for index, color in enumerate(palette.tolist())})
@@ -0,0 +1,84 @@
+import io
+import os
+import numpy as np
+from botocore.exceptions import ClientError
+
+# Raw per-tile model output, kept so that cleanup, colours and statistics can be redone without
+# running the model again. An entry holds the tiles of one source (by content digest) under one
+# model version (the model's ETag), at tile-store/<digest>/<model version>.npz. Inside, tiles are
+# indexed like create_patches (row-major over the padded image). A new model version simply
+# misses, leaving the entries of other versions and other images in place.
+
+TILE_STORE_PREFIX = 'tile-store'
+TILE_STORE = os.environ.get('TILE_STORE', '1') == '1'
+# Number of top classes per pixel whose scores are stored alongside the labels (0 = labels only)
+TILE_STORE_TOP_K = int(os.environ.get('TILE_STORE_TOP_K', '0'))
+
+def tile_store_key(digest, model_version):
+    version = model_version.strip('"')
+    return f"{TILE_STORE_PREFIX}/{digest}/{version}.npz"
+
+def new_tile_entry(shape, patch_size, empty):
+    # empty flags every tile the screening found empty; their labels are only stored once a
+    # request without screening has inferred them
+    return {'shape': tuple(shape), 'patch_size': tuple(patch_size), 'empty': np.asarray(empty, dtype=bool),
+            'labels': {}, 'top_k': {}}
+
+def missing_tiles(entry, skip_empty):
+    return [index for index, empty in enumerate(entry['empty'])
+            if index not in entry['labels'] and not (skip_empty and empty)]
+
+def tile_labels(entry, skip_empty, unlabeled_class):
+    # Per-tile labels as the model run would return them; screened tiles get the Unlabeled class
+    ph, pw = entry['patch_size']
+    unlabeled = np.full((ph, pw), unlabeled_class, dtype=np.uint8)
+    return [unlabeled if skip_empty and empty else entry['labels'][index]
+            for index, empty in enumerate(entry['empty'])]
+
+def top_k_scores(logits, k):
+    # Classes and scores of the k best classes per pixel, best first, as uint8 / float16
+    k = min(k, logits.shape[-1])
+    classes = np.argsort(-logits, axis=-1, kind='stable')[..., :k]
+    scores = np.take_along_axis(logits, classes, axis=-1)
+    return classes.astype(np.uint8), scores.astype(np.float16)
+
+def encode_tile_entry(entry):
+    indices = np.array(sorted(entry['labels']), dtype=np.int32)
+    ph, pw = entry['patch_size']
+    arrays = {
+        'shape': np.array(entry['shape'], dtype=np.int64),
+        'patch_size': np.array(entry['patch_size'], dtype=np.int64),
+        'empty': entry['empty'],
+        'indices': indices,
+        'labels': (np.stack([entry['labels'][i] for i in indices]) if len(indices)
+                   else np.zeros((0, ph, pw), dtype=np.uint8))
+    }
+    top_k_indices = np.array(sorted(entry['top_k']), dtype=np.int32)
+    if len(top_k_indices):
+        arrays['top_k_indices'] = top_k_indices
+        arrays['top_k_classes'] = np.stack([entry['top_k'][i][0] for i in top_k_indices])
+        arrays['top_k_scores'] = np.stack([entry['top_k'][i][1] for i in top_k_indices])
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, **arrays)
+    return buffer.getvalue()
+
+def decode_tile_entry(content):
+    with np.load(io.BytesIO(content)) as arrays:
+        entry = new_tile_entry(arrays['shape'], arrays['patch_size'], arrays['empty'])
+        entry['labels'] = dict(zip(arrays['indices'].tolist(), arrays['labels']))
+        if 'top_k_indices' in arrays:
+            entry['top_k'] = dict(zip(arrays['top_k_indices'].tolist(),
+                                      zip(arrays['top_k_classes'], arrays['top_k_scores'])))
+    return entry
+
+def load_tile_entry(s3_client, bucket, key):
+    try:
+        response = s3_client.get_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return None
+        raise
+    return decode_tile_entry(response['Body'].read())
+
+def save_tile_entry(s3_client, bucket, key, entry):
+    s3_client.put_object(Bucket=bucket, Key=key, Body=encode_tile_entry(entry), ContentType='application/octet-stream')
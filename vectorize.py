@@ -0,0 +1,384 @@
+import json
+import math
+from bisect import bisect_left
+import os
+import struct
+import numpy as np
+from rasterio import features
+
+# Polygonization of class masks into vector features. Regions are traced with GDAL's
+# polygonizer (rasterio.features.shapes) in pixel space, simplified with Douglas-Peucker,
+# then georeferenced. Boundaries are simplified once per pair of neighbouring regions, between
+# the nodes where three or more regions meet, so neighbours keep identical edges and the
+# polygons still tile the mask without gaps or overlaps. A simplified edge can still cross a
+# nearby one where a region is narrower than the tolerance; tolerance 0 keeps exact outlines.
+# Output is line-delimited GeoJSON, or FlatGeobuf with a packed Hilbert R-tree so clients can
+# fetch only the features in view. FlatGeobuf is encoded here with struct, like the PNG
+# writer in segmentFunction, so no OGR bindings are needed.
+
+VECTORIZE = os.environ.get('VECTORIZE', '0') == '1'
+VECTOR_FORMAT = os.environ.get('VECTOR_FORMAT', 'fgb')
+VECTOR_SIMPLIFY_TOLERANCE = float(os.environ.get('VECTOR_SIMPLIFY_TOLERANCE', '1.0'))  # Pixels
+VECTOR_COORDINATE_PRECISION = 7  # Decimal places in GeoJSON, about 1 cm in degrees
+VECTOR_CONTENT_TYPES = {'fgb': 'application/flatgeobuf', 'geojsonl': 'application/geo+json-seq'}
+
+FGB_MAGIC = b'fgb\x03fgb\x00'
+FGB_NODE_SIZE = 16
+FGB_POLYGON = 3
+FGB_COLUMN_INT = 5
+FGB_COLUMN_STRING = 11
+FGB_NODE_DTYPE = np.dtype([('min_x', '<f8'), ('min_y', '<f8'), ('max_x', '<f8'), ('max_y', '<f8'), ('offset', '<u8')])
+
+def farthest_from_chord(ring, start, end):
+    # Index and distance of the point of ring[start + 1:end] farthest from the chord start-end.
+    # Short chains (most of them, around small regions) skip the numpy call overhead.
+    (ax, ay), (bx, by) = ring[start], ring[end]
+    dx, dy = bx - ax, by - ay
+    length = math.hypot(dx, dy)
+    if end - start <= 16:
+        best, best_distance = start + 1, -1.0
+        for index in range(start + 1, end):
+            px, py = ring[index]
+            distance = abs(dx * (py - ay) - dy * (px - ax)) / length if length else math.hypot(px - ax, py - ay)
+            if distance > best_distance:
+                best, best_distance = index, distance
+        return best, best_distance
+    chain = np.asarray(ring[start + 1:end])
+    if length:
+        distances = np.abs(dx * (chain[:, 1] - ay) - dy * (chain[:, 0] - ax)) / length
+    else:
+        distances = np.hypot(chain[:, 0] - ax, chain[:, 1] - ay)
+    index = int(np.argmax(distances))
+    return start + 1 + index, float(distances[index])
+
+def douglas_peucker(points, keep, tolerance):
+    # Sorted indices of the points Douglas-Peucker keeps, refining between consecutive indices
+    # of keep, which are always kept
+    stack = list(zip(keep[:-1], keep[1:]))
+    keep = list(keep)
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        split, distance = farthest_from_chord(points, start, end)
+        if distance > tolerance:
+            keep.append(split)
+            stack.extend([(start, split), (split, end)])
+    return sorted(set(keep))
+
+def simplify_ring(ring, tolerance):
+    # Douglas-Peucker on a closed ring (last point == first), given as a list of (x, y). The
+    # ring is split at the point farthest from its start so both halves are open chains.
+    # Returns an (n, 2) array, or None when the ring collapses.
+    if tolerance <= 0 or len(ring) < 5:
+        return np.asarray(ring, dtype=np.float64)
+    x0, y0 = ring[0]
+    far = max(range(len(ring) - 1), key=lambda k: (ring[k][0] - x0) ** 2 + (ring[k][1] - y0) ** 2)
+    keep = douglas_peucker(ring, [0, far, len(ring) - 1], tolerance)
+    if len(keep) < 4:
+        return None
+    return np.asarray([ring[k] for k in keep], dtype=np.float64)
+
+def boundary_nodes(labels):
+    # The pixel corners where three or more boundary edges meet, plus the corners of the
+    # raster; between two nodes a boundary separates the same two regions. Returned as a set
+    # of (x, y) and as sorted x per row and sorted y per column.
+    h, w = labels.shape
+    padded = np.full((h + 2, w + 2), -1, dtype=np.promote_types(labels.dtype, np.int16))
+    padded[1:-1, 1:-1] = labels
+    top_left, top_right, bottom_left, bottom_right = padded[:-1, :-1], padded[:-1, 1:], padded[1:, :-1], padded[1:, 1:]
+    degree = ((top_left != top_right).astype(np.uint8) + (bottom_left != bottom_right)
+              + (top_left != bottom_left) + (top_right != bottom_right))
+    nodes = degree >= 3
+    nodes[[0, 0, -1, -1], [0, -1, 0, -1]] = True
+    rows, columns = np.nonzero(nodes)  # Row-major, so both groupings come out sorted
+    by_row, by_column = {}, {}
+    for y, x in zip(rows.tolist(), columns.tolist()):
+        by_row.setdefault(y, []).append(x)
+        by_column.setdefault(x, []).append(y)
+    return set(zip(map(float, columns.tolist()), map(float, rows.tolist()))), by_row, by_column
+
+def insert_nodes(ring, nodes):
+    # GDAL emits only the turns of a ring, so nodes inside its straight, axis-aligned edges
+    # (where a third region meets the boundary) are added as vertices. Returns the points and
+    # the indices of the nodes among them.
+    node_points, by_row, by_column = nodes
+    points, node_at = [], []
+    for (x0, y0), (x1, y1) in zip(ring[:-1], ring[1:]):
+        if (x0, y0) in node_points:
+            node_at.append(len(points))
+        points.append((x0, y0))
+        if abs(x1 - x0) + abs(y1 - y0) < 2:
+            continue
+        if y0 == y1:
+            xs = by_row.get(int(y0), ())
+            on_edge = xs[bisect_left(xs, min(x0, x1) + 1):bisect_left(xs, max(x0, x1))]
+            added = [(float(x), y0) for x in (on_edge if x1 > x0 else reversed(on_edge))]
+        else:
+            ys = by_column.get(int(x0), ())
+            on_edge = ys[bisect_left(ys, min(y0, y1) + 1):bisect_left(ys, max(y0, y1))]
+            added = [(x0, float(y)) for y in (on_edge if y1 > y0 else reversed(on_edge))]
+        node_at.extend(range(len(points), len(points) + len(added)))
+        points.extend(added)
+    points.append(ring[-1])
+    return points, node_at
+
+def simplify_shared(points, tolerance, simplified, simplify):
+    # Simplifies a chain of points the same way from either side: the chain is keyed and
+    # simplified in its canonical direction, and the result is kept until the neighbour on
+    # the other side asks for it
+    reverse = (points[-1], points[-2]) < (points[0], points[1])
+    if reverse:
+        points = points[::-1]
+    key = (points[0], points[1])
+    result = simplified.pop(key, False)
+    if result is False:
+        result = simplified[key] = simplify(points, tolerance)
+    if result is None or not reverse:
+        return result
+    return result[::-1]
+
+def simplify_chain(chain, tolerance):
+    return [chain[k] for k in douglas_peucker(chain, [0, len(chain) - 1], tolerance)]
+
+def simplify_coverage_ring(ring, nodes, tolerance, simplified):
+    # simplify_ring for a ring of a coverage: the ring is cut at its nodes and every chain
+    # between two nodes is simplified once for both regions it separates. A ring without
+    # nodes is a loop around a region inside a single neighbour, shared whole with its hole.
+    points, node_at = insert_nodes(ring, nodes)
+    if not node_at:
+        start = min(range(len(points) - 1), key=points.__getitem__)
+        return simplify_shared(points[start:-1] + points[:start + 1], tolerance, simplified, simplify_ring)
+    first = node_at[0]
+    points = points[first:-1] + points[:first + 1]
+    node_at = [k - first for k in node_at] + [len(points) - 1]
+    result = []
+    for start, end in zip(node_at[:-1], node_at[1:]):
+        result.extend(simplify_shared(points[start:end + 1], tolerance, simplified, simplify_chain)[:-1])
+    if len(result) < 3:
+        return None
+    result.append(result[0])
+    return np.asarray(result, dtype=np.float64)
+
+def polygonize_labels(labels, transform, tolerance=VECTOR_SIMPLIFY_TOLERANCE, skip_classes=()):
+    # Yields (class_id, rings) per 4-connected region; rings are (n, 2) arrays in the CRS of
+    # transform, exterior first. Holes that collapse under simplification are dropped.
+    mask = ~np.isin(labels, skip_classes) if len(skip_classes) else None
+    nodes = boundary_nodes(labels) if tolerance > 0 else None
+    shared = {}  # Simplified chains waiting for the region on their other side
+    for geometry, value in features.shapes(labels, mask=mask, connectivity=4):
+        rings = []
+        for ring in geometry['coordinates']:
+            if nodes is None:
+                simplified = np.asarray(ring, dtype=np.float64)
+            else:
+                simplified = simplify_coverage_ring(ring, nodes, tolerance, shared)
+            if simplified is None:
+                if not rings:
+                    break
+                continue
+            xs, ys = transform * (simplified[:, 0], simplified[:, 1])
+            rings.append(np.column_stack([xs, ys]))
+        if rings:
+            yield int(value), rings
+
+def write_geojson_seq(polygons, fileobj, class_names):
+    # One Feature per line, written as the polygons are traced. Returns the feature count.
+    count = 0
+    for class_id, rings in polygons:
+        feature = {
+            'type': 'Feature',
+            'properties': {'class_id': class_id, 'class_name': class_names.get(class_id)},
+            'geometry': {'type': 'Polygon',
+                         'coordinates': [np.round(ring, VECTOR_COORDINATE_PRECISION).tolist() for ring in rings]}
+        }
+        fileobj.write(json.dumps(feature, separators=(',', ':')).encode('utf-8') + b'\n')
+        count += 1
+    return count
+
+class FlatBufferBuilder:
+    # Minimal forward-writing FlatBuffers encoder for the FlatGeobuf header and features. A
+    # table is written as vtable, inline fields, then the objects its offset fields point to,
+    # which keeps every uoffset positive. Fields are given by id as (kind, value) or None.
+    # Alignment is relative to the start of the size prefix, as FinishSizePrefixed does.
+    SCALARS = {'u8': '<B', 'bool': '<?', 'u16': '<H', 'i32': '<i', 'u64': '<Q'}
+    VECTORS = {'u8s': '<u1', 'u32s': '<u4', 'f64s': '<f8'}
+
+    def __init__(self):
+        self.buf = bytearray(8)  # Size prefix and root offset
+
+    def pad(self, alignment, extra=0):
+        self.buf.extend(b'\0' * (-(len(self.buf) + extra) % alignment))
+
+    def patch_offset(self, at, target):
+        struct.pack_into('<I', self.buf, at, target - at)
+
+    def table(self, fields):
+        present = [(field_id, field[0], field[1]) for field_id, field in enumerate(fields) if field is not None]
+        # Inline layout: the soffset, then the fields largest first so none needs padding
+        sizes = [struct.calcsize(self.SCALARS[kind]) if kind in self.SCALARS else 4 for _, kind, _ in present]
+        order = sorted(range(len(present)), key=lambda k: -sizes[k])
+        field_offsets, inline_size = {}, 4
+        for k in order:
+            inline_size += -inline_size % sizes[k]
+            field_offsets[k] = inline_size
+            inline_size += sizes[k]
+        inline_size += -inline_size % 4
+
+        self.pad(2)
+        vtable_pos = len(self.buf)
+        vtable = [0] * len(fields)
+        for k, (field_id, _, _) in enumerate(present):
+            vtable[field_id] = field_offsets[k]
+        self.buf.extend(struct.pack(f'<HH{len(fields)}H', 4 + 2 * len(fields), inline_size, *vtable))
+        self.pad(8)  # An 8-aligned table start keeps the inline fields aligned too
+        table_pos = len(self.buf)
+        self.buf.extend(b'\0' * inline_size)
+        struct.pack_into('<i', self.buf, table_pos, table_pos - vtable_pos)
+
+        children = []
+        for k, (_, kind, value) in enumerate(present):
+            at = table_pos + field_offsets[k]
+            if kind in self.SCALARS:
+                struct.pack_into(self.SCALARS[kind], self.buf, at, value)
+            else:
+                children.append((at, kind, value))
+        for at, kind, value in children:
+            self.patch_offset(at, self.child(kind, value))
+        return table_pos
+
+    def child(self, kind, value):
+        if kind == 'table':
+            return self.table(value)
+        if kind == 'tables':
+            self.pad(4)
+            pos = len(self.buf)
+            self.buf.extend(struct.pack('<I', len(value)) + b'\0' * (4 * len(value)))
+            for k, fields in enumerate(value):
+                self.patch_offset(pos + 4 + 4 * k, self.table(fields))
+            return pos
+        if kind == 'string':
+            data = value.encode('utf-8')
+            self.pad(4)
+            pos = len(self.buf)
+            self.buf.extend(struct.pack('<I', len(data)) + data + b'\0')
+            return pos
+        data = np.ascontiguousarray(value, dtype=self.VECTORS[kind])
+        self.pad(max(4, data.itemsize), extra=4)
+        pos = len(self.buf)
+        self.buf.extend(struct.pack('<I', len(data)) + data.tobytes())
+        return pos
+
+    def finish(self, root_fields):
+        self.patch_offset(4, self.table(root_fields))
+        self.pad(8)
+        struct.pack_into('<I', self.buf, 0, len(self.buf) - 4)
+        return bytes(self.buf)
+
+def encode_fgb_feature(class_id, class_name, rings):
+    xy = np.concatenate(rings)
+    properties = struct.pack('<Hi', 0, class_id)
+    if class_name is not None:
+        name = class_name.encode('utf-8')
+        properties += struct.pack('<HI', 1, len(name)) + name
+    geometry = [None, ('f64s', xy.ravel()), None, None, None, None, ('u8', FGB_POLYGON)]
+    if len(rings) > 1:
+        geometry[0] = ('u32s', np.cumsum([len(ring) for ring in rings]))
+    return FlatBufferBuilder().finish([('table', geometry), ('u8s', np.frombuffer(properties, dtype=np.uint8))])
+
+def hilbert(x, y):
+    # Hilbert curve index of 16-bit coordinates, as used by FlatGeobuf to order features
+    x = x.astype(np.uint32)
+    y = y.astype(np.uint32)
+    a = x ^ y
+    b = 0xFFFF ^ a
+    c = 0xFFFF ^ (x | y)
+    d = x & (y ^ 0xFFFF)
+    A = a | (b >> 1)
+    B = (a >> 1) ^ a
+    C = ((c >> 1) ^ (b & (d >> 1))) ^ c
+    D = ((a & (c >> 1)) ^ (d >> 1)) ^ d
+    for shift in (2, 4):
+        a, b, c, d = A, B, C, D
+        A = (a & (a >> shift)) ^ (b & (b >> shift))
+        B = (a & (b >> shift)) ^ (b & ((a ^ b) >> shift))
+        C = C ^ ((a & (c >> shift)) ^ (b & (d >> shift)))
+        D = D ^ ((b & (c >> shift)) ^ ((a ^ b) & (d >> shift)))
+    a, b, c, d = A, B, C, D
+    C = C ^ ((a & (c >> 8)) ^ (b & (d >> 8)))
+    D = D ^ ((b & (c >> 8)) ^ ((a ^ b) & (d >> 8)))
+    a = C ^ (C >> 1)
+    b = D ^ (D >> 1)
+    i0 = x ^ y
+    i1 = b | (0xFFFF ^ (i0 | a))
+    for shift, bits in ((8, 0x00FF00FF), (4, 0x0F0F0F0F), (2, 0x33333333), (1, 0x55555555)):
+        i0 = (i0 | (i0 << shift)) & bits
+        i1 = (i1 | (i1 << shift)) & bits
+    return (i1 << 1) | i0
+
+def hilbert_order(boxes, extent):
+    min_x, min_y, max_x, max_y = extent
+    centers_x = (boxes[:, 0] + boxes[:, 2]) / 2
+    centers_y = (boxes[:, 1] + boxes[:, 3]) / 2
+    x = np.floor(0xFFFF * (centers_x - min_x) / (max_x - min_x)) if max_x > min_x else np.zeros(len(boxes))
+    y = np.floor(0xFFFF * (centers_y - min_y) / (max_y - min_y)) if max_y > min_y else np.zeros(len(boxes))
+    return np.argsort(-hilbert(x, y).astype(np.int64), kind='stable')
+
+def packed_rtree(boxes, offsets, node_size=FGB_NODE_SIZE):
+    # Static R-tree over boxes already in Hilbert order, root first and leaves last. Leaves hold
+    # the byte offset of their feature, parents the node index of their first child.
+    level_sizes = [len(boxes)]
+    while True:  # At least one parent level, even for a single feature
+        level_sizes.append(-(-level_sizes[-1] // node_size))
+        if level_sizes[-1] == 1:
+            break
+    level_starts = [sum(level_sizes[k + 1:]) for k in range(len(level_sizes))]
+    nodes = np.zeros(sum(level_sizes), dtype=FGB_NODE_DTYPE)
+    leaves = nodes[level_starts[0]:]
+    for k, name in enumerate(('min_x', 'min_y', 'max_x', 'max_y')):
+        leaves[name] = boxes[:, k]
+    leaves['offset'] = offsets
+    for level in range(len(level_sizes) - 1):
+        children = nodes[level_starts[level]:level_starts[level] + level_sizes[level]]
+        parents = nodes[level_starts[level + 1]:level_starts[level + 1] + level_sizes[level + 1]]
+        groups = np.arange(0, len(children), node_size)
+        for name, reduce in (('min_x', np.minimum), ('min_y', np.minimum), ('max_x', np.maximum), ('max_y', np.maximum)):
+            parents[name] = reduce.reduceat(children[name], groups)
+        parents['offset'] = level_starts[level] + groups
+    return nodes.tobytes()
+
+def write_flatgeobuf(polygons, fileobj, class_names, name='segmentation'):
+    # The index needs every feature's box before the first feature is written, so features are
+    # encoded up front and written in Hilbert order. Returns the feature count.
+    encoded, boxes = [], []
+    for class_id, rings in polygons:
+        encoded.append(encode_fgb_feature(class_id, class_names.get(class_id), rings))
+        exterior = rings[0]
+        boxes.append((*exterior.min(axis=0), *exterior.max(axis=0)))
+    boxes = np.array(boxes, dtype=np.float64).reshape(-1, 4)
+    extent = (*boxes[:, :2].min(axis=0), *boxes[:, 2:].max(axis=0)) if len(boxes) else (0.0, 0.0, 0.0, 0.0)
+
+    columns = [
+        [('string', 'class_id'), ('u8', FGB_COLUMN_INT), None, None, None, None, None, ('bool', False)],
+        [('string', 'class_name'), ('u8', FGB_COLUMN_STRING)]
+    ]
+    header = [('string', name), ('f64s', extent), ('u8', FGB_POLYGON), None, None, None, None, ('tables', columns),
+              ('u64', len(encoded)), ('u16', FGB_NODE_SIZE if encoded else 0),
+              ('table', [('string', 'EPSG'), ('i32', 4326)])]
+    fileobj.write(FGB_MAGIC)
+    fileobj.write(FlatBufferBuilder().finish(header))
+    if encoded:
+        order = hilbert_order(boxes, extent)
+        sizes = np.array([len(encoded[k]) for k in order], dtype=np.uint64)
+        offsets = np.concatenate([[0], np.cumsum(sizes)[:-1]]).astype(np.uint64)
+        fileobj.write(packed_rtree(boxes[order], offsets))
+        for k in order:
+            fileobj.write(encoded[k])
+    return len(encoded)
+
+def write_vectors(polygons, fileobj, vector_format, class_names):
+    if vector_format == 'fgb':
+        return write_flatgeobuf(polygons, fileobj, class_names)
+    if vector_format == 'geojsonl':
+        return write_geojson_seq(polygons, fileobj, class_names)
+    raise ValueError(f"Unknown vector format {vector_format}, expected one of {sorted(VECTOR_CONTENT_TYPES)}")